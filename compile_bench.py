@@ -0,0 +1,85 @@
+import os, time, copy
+from itertools import islice
+import torch
+import pytorch_lightning as pl
+from torch.utils.data import DataLoader
+
+from src.model import MMRadForPretraining, MMRadForClassification
+from src.data import MMRadDM
+from src.parameters import parse_args
+from src.inference import ClassifierGraph, time_fn
+from src.utils import load_paths_dict
+
+import warnings
+
+warnings.filterwarnings(
+    "ignore", ".*Trying to infer the `batch_size` from an ambiguous collection.*"
+)
+
+def time_task(model, task, batches, warmup=2):
+    """Seconds of the first warmup steps (incl. compilation, or tracing on torch<2.0), the mean
+    of the remaining training steps, and the losses (for a parity check against eager)"""
+    pl.seed_everything(808)
+    times, losses = [], []
+    for batch in batches:
+        batch = copy.deepcopy(batch)
+        start = time.perf_counter()
+        batch = model.pp.tokenize_pad_vectorize(batch, return_word_ids=(task=='oovm'))
+        loss = model.task_step[task](batch, 0)['loss']
+        loss.backward()
+        model.zero_grad(set_to_none=True)
+        times.append(time.perf_counter()-start)
+        losses.append(loss.item())
+    return sum(times[:warmup]), sum(times[warmup:])/len(times[warmup:]), torch.tensor(losses)
+
+# Eager vs compiled (--compile) training steps of each pretraining task, and classifier
+# inference, on CPU:
+#   python compile_bench.py --tasks mlm,mfr,itm,mrc --bench_steps 20 --batch_size 32 --topk 5120
+if __name__=='__main__':
+
+    args = parse_args(stage='compile')
+    path_dict = load_paths_dict()
+
+    # Needed if using TokenizerFast:
+    os.environ["TOKENIZERS_PARALLELISM"] = "true"
+
+    dm = MMRadDM(args, path_dict)
+    dm.setup(stage='fit')
+    loader = DataLoader(dm.train_dset, batch_size=args.batch_size, shuffle=False, drop_last=True)
+    batches = list(islice(loader, args.bench_steps+2))
+    tasks = args.tasks.split(',')
+
+    models = {}
+    for compiled in [False, True]:
+        args.compile = compiled
+        pl.seed_everything(808)
+        # Dropout off so eager and compiled losses are comparable
+        models[compiled] = MMRadForPretraining(args=copy.copy(args), train_size=dm.train_size).eval()
+    models[True].load_state_dict(models[False].state_dict())
+
+    print(f"\nTraining steps ({args.bench_steps} timed, batch size {args.batch_size}, {torch.get_num_threads()} threads)")
+    print(f"{'Task':<8}{'Compile (s)':>13}{'Eager (ms)':>12}{'Compiled (ms)':>15}{'Speedup':>9}{'Max loss diff':>15}")
+    for task in tasks:
+        _, eager, eager_losses = time_task(models[False], task, batches)
+        first, compiled, compiled_losses = time_task(models[True], task, batches)
+        print(f"{task:<8}{first-2*compiled:>13.1f}{1000*eager:>12.1f}{1000*compiled:>15.1f}{eager/compiled:>8.2f}x"
+              f"{float((eager_losses-compiled_losses).abs().max()):>15.2e}")
+
+    ## Classifier inference
+    dm.setup(stage='test')
+    classifiers = {}
+    for compiled in [False, True]:
+        args.compile = compiled
+        pl.seed_everything(808)
+        classifiers[compiled] = MMRadForClassification(args=copy.copy(args), train_size=dm.train_size,
+                                                       n_classes=dm.num_classes, labelset=dm.labelset)
+    classifiers[True].load_state_dict(classifiers[False].state_dict())
+    graphs = {compiled: ClassifierGraph(model).eval() for compiled, model in classifiers.items()}
+
+    batch = classifiers[False].pp.tokenize_pad_vectorize(next(iter(dm.test_dataloader())))
+    inputs = (batch['txt']['input_ids'], batch['txt']['att_mask'], batch['img']['features'], batch['img']['boxes'])
+    with torch.no_grad():
+        diff = float((graphs[False](*inputs) - graphs[True](*inputs)).abs().max())
+    eager, compiled = [time_fn(graphs[c], *inputs, repeats=args.bench_repeats) for c in [False, True]]
+    print(f"\nInference (batch size {len(inputs[0])}): eager {1000*eager:.1f} ms, compiled {1000*compiled:.1f} ms, "
+          f"speedup {eager/compiled:.2f}x, max logit diff {diff:.2e}")
@@ -0,0 +1,121 @@
+import os, copy
+import torch
+import pytorch_lightning as pl
+from pytorch_lightning.loggers import WandbLogger
+from pytorch_lightning.callbacks import LearningRateMonitor
+import wandb
+
+from src.model import MMRadForClassification, MMRadForDistillation
+from src.data import MMRadDM
+from src.parameters import parse_args
+from src.utils import MetricsCallback, load_paths_dict
+from src.inference import ClassifierGraph, predict_dataloader, auroc_scores, time_fn
+
+import warnings
+
+warnings.filterwarnings(
+    "ignore", ".*Trying to infer the `batch_size` from an ambiguous collection.*"
+)
+warnings.filterwarnings(
+    "ignore", ".*DataModule.setup has already been called.*"
+)
+
+# Distil a fine tuned 12 layer classifier into a shallower student, then report AUROC vs latency:
+#   python distil.py --teacher_cp_path [FT pl_framework checkpoint] --student_layers 6 --epochs 6 \
+#       --distil_alpha 0.5 --distil_temperature 2 --hidden_loss_weight 1
+if __name__=='__main__':
+
+    args = parse_args(stage='distil')
+    pl.seed_everything(808, workers=True)
+    assert args.teacher_cp_path is not None, "--teacher_cp_path is required"
+
+    # Needed if using TokenizerFast:
+    os.environ["TOKENIZERS_PARALLELISM"] = "true"
+
+    path_dict = load_paths_dict()
+    log_run_name = f"distil-{args.student_layers}L-{args.run_name}"
+
+    dm = MMRadDM(args, path_dict)
+    dm.setup(stage='fit')
+
+    # Teacher architecture comes from args (num_tx_layers etc.), weights from the checkpoint
+    teacher_args = copy.copy(args)
+    teacher_args.load_model = 'scratch'
+    print(f'Loading teacher from {args.teacher_cp_path}')
+    teacher = MMRadForClassification.load_from_checkpoint(
+        args.teacher_cp_path,
+        args=teacher_args,
+        train_size=dm.train_size,
+        n_classes=dm.num_classes,
+        labelset=dm.labelset
+        )
+
+    model = MMRadForDistillation(
+        args=args,
+        train_size=dm.train_size,
+        n_classes=dm.num_classes,
+        teacher=teacher,
+        labelset=dm.labelset
+        )
+
+    ## Logging & Callbacks
+    wandb_logger = WandbLogger(
+        name=log_run_name,
+        project=args.project,
+        offline=args.log_offline,
+        log_model=False,
+        )
+    wandb_logger.experiment.config.update(args)
+
+    auroc_metrics = MetricsCallback(
+        train_size=dm.train_size,
+        valid_size=dm.valid_size,
+        n_classes=dm.num_classes)
+    callbacks = [LearningRateMonitor(logging_interval='step'), auroc_metrics]
+
+    trainer = pl.Trainer.from_argparse_args(
+        args,
+        gpus=int(torch.cuda.is_available()),
+        callbacks=callbacks,
+        logger=wandb_logger,
+        log_every_n_steps=10,
+        max_epochs=args.epochs,
+        max_steps=args.steps,
+        deterministic=True,
+        )
+    trainer.fit(model, dm)
+
+    if args.save_cp_path != "none":
+        cp_path = os.path.join(args.save_cp_path,'FT',log_run_name,'pl_framework')
+        encoder_path = os.path.join(args.save_cp_path,'FT',log_run_name,'encoder')
+        trainer.save_checkpoint(cp_path)
+        print(f"Student checkpoint saved to {cp_path}")
+        if args.save_encoder:
+            model.model.save_pretrained(save_directory=encoder_path)
+            print(f"Student encoder weights saved to {encoder_path}")
+
+    if not args.no_evaluation:
+        trainer.test(model, dataloaders=dm)
+
+    ## AUROC vs latency tradeoff on the test split
+    dm.setup(stage='test')
+    loader = dm.test_dataloader()
+    batch = model.pp.tokenize_pad_vectorize(next(iter(loader)))
+
+    results = {}
+    for name, module in [('teacher', teacher), ('student', model)]:
+        module.eval()
+        graph = ClassifierGraph(module).eval()
+        inputs = (batch['txt']['input_ids'].to(module.device), batch['txt']['att_mask'].to(module.device),
+                  batch['img']['features'].to(module.device), batch['img']['boxes'].to(module.device))
+        preds, labels = predict_dataloader(graph, loader, module.pp, device=module.device)
+        _, avg_auc = auroc_scores(preds, labels)
+        results[name] = {'layers':module.config.num_hidden_layers, 'avg_auc':avg_auc,
+                         'latency_s':time_fn(graph, *inputs, repeats=args.bench_repeats)}
+
+    print(f"\n{'Model':<10}{'Layers':>8}{'Avg AUROC':>12}{'Latency (ms)':>14}{'Speedup':>10}")
+    for name, r in results.items():
+        speedup = results['teacher']['latency_s']/r['latency_s']
+        print(f"{name:<10}{r['layers']:>8}{r['avg_auc']:>12.4f}{1000*r['latency_s']:>14.1f}{speedup:>9.2f}x")
+    wandb_logger.experiment.config['distil_results'] = results
+    wandb.finish()
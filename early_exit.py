@@ -0,0 +1,66 @@
+import os, time
+import torch
+
+from src.data import MMRadDM
+from src.parameters import parse_args
+from src.inference import load_classifier, auroc_scores
+from src.utils import load_paths_dict
+
+# Early exit evaluation of a classifier fine tuned with exit heads (finetune.py --exit_layers 4,8).
+# Reports average layers run, throughput and AUROC on the --test split per threshold:
+#   python early_exit.py --load_cp_path [FT pl_framework checkpoint] --exit_layers 4,8 \
+#       --exit_criterion entropy --exit_thresholds 0.05,0.1,0.2,0.3
+if __name__=='__main__':
+
+    args = parse_args(stage='early_exit')
+    path_dict = load_paths_dict()
+    thresholds = [float(t) for t in args.exit_thresholds.split(',')]
+    assert args.exit_layers, "--exit_layers must match the fine tuned model"
+
+    # Needed if using TokenizerFast:
+    os.environ["TOKENIZERS_PARALLELISM"] = "true"
+
+    dm = MMRadDM(args, path_dict)
+    dm.setup(stage='test')
+    model = load_classifier(args, labelset=dm.labelset)
+    device = model.device
+
+    # Tokenise once, so the timed loop only covers the forward passes
+    batches = [model.pp.tokenize_pad_vectorize(batch) for batch in dm.test_dataloader()]
+
+    results = []
+    # None: full model, no early exit
+    for threshold in [None] + thresholds:
+        preds, labels, layers = [], [], []
+        elapsed = 0.
+        with torch.no_grad():
+            for batch in batches:
+                inputs = (batch['txt']['input_ids'].to(device), batch['txt']['att_mask'].to(device),
+                          batch['img']['features'].to(device), batch['img']['boxes'].to(device))
+                cls_probs = batch['img'].get('cls_probs')
+                cls_probs = None if cls_probs is None else cls_probs.to(device)
+                start = time.perf_counter()
+                if threshold is None:
+                    probs = torch.sigmoid(model.classify(*inputs, cls_probs=cls_probs))
+                    layers_run = torch.full((len(probs),), model.config.num_hidden_layers)
+                else:
+                    probs, layers_run = model.early_exit_classify(*inputs, threshold=threshold,
+                                                                  criterion=args.exit_criterion,
+                                                                  cls_probs=cls_probs)
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+                elapsed += time.perf_counter()-start
+                preds.append(probs.cpu())
+                labels.append(batch['label'].cpu())
+                layers.append(layers_run.float().cpu())
+
+        _, avg_auc = auroc_scores(torch.cat(preds), torch.cat(labels))
+        results.append({'threshold':threshold, 'avg_auc':avg_auc,
+                        'avg_layers':float(torch.cat(layers).mean()),
+                        'throughput':sum(len(p) for p in preds)/elapsed})
+
+    print(f"\nEarly exit ({args.exit_criterion}, exits after layers {args.exit_layers}) on {args.test}:")
+    print(f"{'Threshold':>10}{'Avg layers':>12}{'Avg AUROC':>12}{'Studies/s':>12}")
+    for r in results:
+        name = 'full' if r['threshold'] is None else f"{r['threshold']:.3f}"
+        print(f"{name:>10}{r['avg_layers']:>12.2f}{r['avg_auc']:>12.4f}{r['throughput']:>12.1f}")
@@ -0,0 +1,67 @@
+import os, json, sys
+import torch
+
+from src.parameters import parse_args
+from src.inference import (
+    ClassifierGraph,
+    load_classifier,
+    example_inputs,
+    export_torchscript,
+    export_onnx,
+    check_parity,
+    EXPORT_INPUT_NAMES
+)
+
+# Exports the tensor part of a fine tuned classifier (token ids, attention mask, features, boxes
+# -> sigmoid probabilities) to a portable graph, and checks parity against the PL model:
+#   python export.py --load_cp_path [pl_framework checkpoint] --export_path classifier --export_format torchscript,onnx
+# The TorchScript graph runs with torch.jit.load(path) alone (no lightning, wandb or transformers import),
+# the ONNX graph with e.g. onnxruntime. Tokenise reports with the same --tokenizer and --max_seq_len.
+if __name__=='__main__':
+
+    args = parse_args(stage='export')
+    formats = args.export_format.split(',')
+
+    # Needed if using TokenizerFast:
+    os.environ["TOKENIZERS_PARALLELISM"] = "true"
+
+    model = load_classifier(args).cpu()
+    graph = ClassifierGraph(model, output_probs=True).eval()
+    input_kwargs = {'ft_dim':model.visual_features_dim, 'vocab_size':model.config.vocab_size}
+
+    # Trace at a small shape, check at others (incl. full max_seq_len) to confirm the dims are dynamic
+    inputs = example_inputs(2, 16, **input_kwargs)
+    shapes = [(1, 8), (3, 40), (8, args.max_seq_len)]
+
+    # Formats whose parity could not be checked (fails the run unless --skip_parity)
+    unchecked = []
+
+    if 'torchscript' in formats:
+        path = args.export_path+'.pt'
+        export_torchscript(graph, path, inputs)
+        if not args.skip_parity:
+            check_parity(graph, torch.jit.load(path), shapes, **input_kwargs)
+
+    if 'onnx' in formats:
+        path = args.export_path+'.onnx'
+        export_onnx(graph, path, inputs)
+        try:
+            import onnxruntime
+        except ImportError:
+            if not args.skip_parity:
+                unchecked.append('onnx (onnxruntime not installed)')
+        else:
+            session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+            run_onnx = lambda *x: session.run(None, {name:t.numpy() for name,t in zip(EXPORT_INPUT_NAMES, x)})[0]
+            if not args.skip_parity:
+                check_parity(graph, run_onnx, shapes, **input_kwargs)
+
+    with open(args.export_path+'.json', 'w') as f:
+        json.dump({'labelset':model.labelset, 'tokenizer':args.tokenizer,
+                   'max_seq_len':args.max_seq_len, 'inputs':EXPORT_INPUT_NAMES}, f, indent=2)
+    print(f"Labels and tokenizer settings saved to {args.export_path+'.json'}")
+
+    if unchecked:
+        print(f"Error: parity not checked for {', '.join(unchecked)}; pass --skip_parity True "
+              f"to export without checking", file=sys.stderr)
+        sys.exit(1)
@@ -1,4 +1,5 @@
-import os, json, sys, shutil
+import os, json, sys, shutil, time
+import torch
 import pytorch_lightning as pl
 from pytorch_lightning.loggers import WandbLogger
 from pytorch_lightning.callbacks import ModelCheckpoint, LearningRateMonitor, StochasticWeightAveraging
@@ -9,6 +10,7 @@ from src.model import MMRadForClassification
 from src.data import MMRadDM
 from src.parameters import parse_args
 from src.utils import MetricsCallback
+from src.inference import load_classifier, test_predictions
 
 ##
 # TODO: This can be removed once pytorch-lightning issue #10408 is merged
@@ -27,6 +29,33 @@ def load_paths_dict(cfg='data_paths.json'):
         pd = json.loads(file.read()) # use `json.loads` to do the reverse
     return pd
 
+def evaluate_zero_epoch(args, dm):
+    """Scores the test split without fine tuning: no Trainer or W&B run, the test
+    loader is streamed under inference mode and the MetricsCallback tables are
+    computed from the predictions directly.
+
+    Returns:
+        avg_AUC, wAvg_AUC and the tables {key: (columns, data)}, see MetricsCallback.test_tables
+    """
+    start = time.time()
+    model = load_classifier(args, labelset=dm.labelset)
+    auroc_metrics = MetricsCallback(
+        train_size=0,
+        valid_size=0,
+        n_classes=1 if args.easy_classification else len(dm.labelset))
+    preds, labels = test_predictions(model, dm.test_dataloader())
+    results = auroc_metrics.test_tables(preds.to(auroc_metrics.device),
+                                        labels.to(auroc_metrics.device), dm.labelset)
+    print(f"Evaluated {len(preds)} test studies in {time.time()-start:.2f} seconds")
+    return results
+
+def print_tables(tables):
+    for key, (columns, data) in tables.items():
+        print(f"\n{key}:")
+        print(f"{columns[0]:<28}" + "".join(f"{c:>14}" for c in columns[1:]))
+        for row in data:
+            print(f"{row[0]:<28}" + "".join(f"{float(v):>14.4g}" for v in row[1:]))
+
 WANDB_DISABLE_CODE = True
 
 if __name__=='__main__':
@@ -55,7 +84,8 @@ if __name__=='__main__':
     # Needed if using TokenizerFast:
     os.environ["TOKENIZERS_PARALLELISM"] = "true"
 
-    stage = 'test' if args.no_finetune else 'fit'
+    # Zero epoch runs are only evaluated, see evaluate_zero_epoch
+    stage = 'test' if (args.no_finetune or args.epochs == 0) else 'fit'
     
     path_dict = load_paths_dict()
 
@@ -83,6 +113,13 @@ if __name__=='__main__':
         models = [(args.load_model,os.path.join(path_dict['pt_checkpoint_root'], args.load_model, "encoder"))]
     else:
         models = [(args.load_model[:10], args.load_model)]
+    ## Load data once, shared by every model run (test data is loaded by the first trainer.test)
+    dm = MMRadDM(args, path_dict)
+    dm.setup(stage=stage)
+    # Generator state after the train/val split, restored for every run (same shuffling
+    # order as a DataModule set up for that run alone)
+    g_state = dm.g.get_state()
+
     ### Main Loop (Train, Test, Save a model):
     for i,(model_name,model_path) in enumerate(models):
 
@@ -116,9 +153,15 @@ if __name__=='__main__':
 
         Learning Rate: {args.lr}
         Using Scheduler: {args.lr_scheduler}\n\n\n""")
-        ## Load data
-        dm = MMRadDM(args, path_dict)
-        dm.setup(stage=stage)
+        if args.epochs == 0:
+            if not args.no_evaluation:
+                avg_AUC, wAvg_AUC, tables = evaluate_zero_epoch(args, dm)
+                print(f"\n{log_run_name}: Avg AUROC {float(avg_AUC):.4f}, wAvg AUROC {float(wAvg_AUC):.4f}")
+                print_tables(tables)
+            continue
+
+        # Same shuffling order for every model
+        dm.g.set_state(g_state)
 
         if args.load_cp_path is None:
             model = MMRadForClassification(
@@ -174,7 +217,7 @@ if __name__=='__main__':
         ## Train
         trainer = pl.Trainer.from_argparse_args(
             args, 
-            gpus=1, 
+            gpus=int(torch.cuda.is_available()),
             callbacks=callbacks,
             logger=wandb_logger,
             log_every_n_steps=10, 
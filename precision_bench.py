@@ -0,0 +1,118 @@
+import os, time, copy
+from itertools import islice
+import torch
+import pytorch_lightning as pl
+from torch.utils.data import DataLoader
+
+from src.model import MMRadForPretraining, MMRadForClassification
+from src.data import MMRadDM
+from src.parameters import parse_args
+from src.inference import load_classifier, ClassifierGraph, predict_dataloader, auroc_scores, autocast
+from src.utils import load_paths_dict
+
+import warnings
+
+warnings.filterwarnings(
+    "ignore", ".*Trying to infer the `batch_size` from an ambiguous collection.*"
+)
+
+def train_curve(model, step_fn, loader, steps, precision, lr):
+    """Losses and samples/s of steps optimiser steps of step_fn(batch, step) -> loss"""
+    pl.seed_everything(808)
+    model.train()
+    optimizer = torch.optim.AdamW(model.parameters(), lr=lr)
+    losses, samples = [], 0
+    start = time.perf_counter()
+    for step, batch in enumerate(islice(loader, steps)):
+        with autocast(precision, model.device):
+            loss = step_fn(batch, step)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        losses.append(loss.item())
+        samples += len(batch['label'])
+    return torch.tensor(losses), samples/(time.perf_counter()-start)
+
+def relative_diff(curve, reference):
+    return float((curve-reference).abs().mean() / reference.abs().mean())
+
+# Compares bf16 autocast against fp32 on CPU: training throughput and loss curves (pretraining
+# tasks and classification fine tuning from the same initialisation), then inference
+# throughput and AUROC of a fine tuned classifier on the test split:
+#   python precision_bench.py --tasks mlm,mfr,itm --load_cp_path [FT pl_framework checkpoint] \
+#       --bench_steps 20 --batch_size 32 --topk 5120
+# Train with bf16 by passing --precision bf16 to pretrain.py / finetune.py (torch>=1.10).
+if __name__=='__main__':
+
+    args = parse_args(stage='precision')
+    if not hasattr(torch, 'autocast'):
+        raise RuntimeError(f"bf16 autocast needs torch>=1.10, found {torch.__version__}")
+    path_dict = load_paths_dict()
+    tasks = args.tasks.split(',')
+
+    # Needed if using TokenizerFast:
+    os.environ["TOKENIZERS_PARALLELISM"] = "true"
+
+    dm = MMRadDM(args, path_dict)
+    dm.setup()
+    # Same batches, in the same order, for both precisions
+    train_loader = DataLoader(dm.train_dset, batch_size=args.batch_size, shuffle=False, drop_last=True)
+
+    pl.seed_everything(808)
+    pretrain_init = MMRadForPretraining(args=copy.copy(args), train_size=dm.train_size)
+    pl.seed_everything(808)
+    finetune_init = MMRadForClassification(args=args, train_size=dm.train_size,
+                                           n_classes=dm.num_classes, labelset=dm.labelset)
+
+    def pretrain_step(model):
+        def step_fn(batch, step):
+            # Tasks in turn (training_step samples one at random)
+            task = tasks[step % len(tasks)]
+            batch = model.pp.tokenize_pad_vectorize(batch, return_word_ids=(task=='oovm'))
+            return model.task_step[task](batch, step)['loss']
+        return step_fn
+
+    results, curves = {}, {}
+    for precision in [32, 'bf16']:
+        model = copy.deepcopy(pretrain_init)
+        curves[('pretrain', precision)], results[('pretrain', precision)] = train_curve(
+            model, pretrain_step(model), train_loader, args.bench_steps, precision, args.lr)
+        model = copy.deepcopy(finetune_init)
+        curves[('finetune', precision)], results[('finetune', precision)] = train_curve(
+            model, lambda batch, step: model.shared_step(batch, step)['loss'],
+            train_loader, args.bench_steps, precision, args.lr)
+
+    print(f"\nTraining ({args.bench_steps} steps, batch size {args.batch_size}, {torch.get_num_threads()} threads)")
+    print(f"{'Stage':<10}{'fp32 samples/s':>16}{'bf16 samples/s':>16}{'Speedup':>9}{'Loss diff':>11}{'':>6}")
+    passed = True
+    for stage in ['pretrain', 'finetune']:
+        fp32, bf16 = results[(stage, 32)], results[(stage, 'bf16')]
+        diff = relative_diff(curves[(stage, 'bf16')], curves[(stage, 32)])
+        ok = diff <= args.loss_tolerance
+        passed = passed and ok
+        print(f"{stage:<10}{fp32:>16.1f}{bf16:>16.1f}{bf16/fp32:>8.2f}x{100*diff:>10.2f}%{'OK' if ok else 'FAIL':>6}")
+    for task in tasks:
+        task_steps = [s for s in range(len(curves[('pretrain', 32)])) if tasks[s % len(tasks)]==task]
+        diff = relative_diff(curves[('pretrain', 'bf16')][task_steps], curves[('pretrain', 32)][task_steps])
+        print(f"  {task:<8} loss diff {100*diff:.2f}%")
+
+    ## Inference on the test split
+    model = load_classifier(args, labelset=dm.labelset)
+    graph = ClassifierGraph(model).eval()
+    inference = {}
+    for precision in [32, 'bf16']:
+        start = time.perf_counter()
+        preds, labels = predict_dataloader(graph, dm.test_dataloader(), model.pp,
+                                           device=model.device, precision=precision)
+        throughput = len(preds)/(time.perf_counter()-start)
+        inference[precision] = {'avg_auc':auroc_scores(preds, labels)[1], 'throughput':throughput}
+
+    auc_diff = abs(inference['bf16']['avg_auc'] - inference[32]['avg_auc'])
+    ok = auc_diff <= args.auc_tolerance
+    passed = passed and ok
+    print(f"\nInference ({args.test} test split)")
+    print(f"{'Precision':<10}{'Avg AUROC':>12}{'Studies/s':>12}")
+    for precision, r in inference.items():
+        print(f"{str(precision):<10}{r['avg_auc']:>12.4f}{r['throughput']:>12.1f}")
+    print(f"AUROC diff {auc_diff:.4f} {'OK' if ok else 'FAIL'}")
+    print(f"\nbf16 {'matches' if passed else 'does NOT match'} fp32 within tolerance")
@@ -1,4 +1,5 @@
-import torch, os, csv, base64, re
+import torch, os, sys, csv, base64, re, time
+from queue import Empty
 import detectron2, cv2
 import json
 import matplotlib.pyplot as plt
@@ -7,7 +8,7 @@ from torch.utils.data import Dataset
 import pandas as pd
 
 # Handle truncated images (e.g. MIMIC-CXR p13/p13187806/s59042749)
-from PIL import ImageFile
+from PIL import Image, ImageFile
 ImageFile.LOAD_TRUNCATED_IMAGES=True
 
 
@@ -15,9 +16,28 @@ from pp_utils import (
     Extractor,
     FeatureWriterTSV,
     PrepareImageInputs,
-    collate_func
+    ResizeImage,
+    ImageCache,
+    AspectRatioBatchSampler,
+    collate_func,
+    load_store_index,
+    image_hash,
+    padding_fraction,
+    Pipeline,
+    read_image_sizes
 )
 
+def load_image(image_fp, img_id, transform=None, image_cache=None):
+    """BGR image from the resized image cache if it holds img_id, else decoded from image_fp"""
+    if image_cache is not None and img_id in image_cache:
+        return image_cache[img_id]
+    image = plt.imread(image_fp)
+    image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR) 
+    if transform is not None:
+        image = transform(image)
+    return image
+
+
 class RawOpenIDataset(Dataset):
     """OpenI Dataset for generating image featuress only
     csv_path: (str) csv path containing image ID and filepath
@@ -26,10 +46,12 @@ class RawOpenIDataset(Dataset):
             if using multi split csv, one of following:
                 '95','5','2.5','1.25','0.6125'
     """
-    def __init__(self, csv_path, image_root, split=None):
+    def __init__(self, csv_path, image_root, split=None, transform=None, image_cache=None):
         # Only extracting for those with findings
         data = pd.read_csv(csv_path)
         self.img_root_dir = image_root
+        self.transform = transform
+        self.image_cache = image_cache
 
         self.valid_data = data[data['split']==split] if split is not None else data
         self.valid_data.reset_index(inplace=True)
@@ -37,14 +59,23 @@ class RawOpenIDataset(Dataset):
     def __len__(self):
         return len(self.valid_data)
 
+    def image_id(self, idx):
+        return self.valid_data['id'][idx]
+
+    def image_size(self, idx):
+        if self.image_cache is not None and self.image_id(idx) in self.image_cache:
+            return self.image_cache.shape(self.image_id(idx))[1:]
+        # (H,W) from the file header, the image is not decoded
+        with Image.open(os.path.join(self.img_root_dir, self.valid_data['path'][idx])) as image:
+            return image.size[::-1]
+
     def __getitem__(self, idx):
         if torch.is_tensor(idx):
             idx = idx.tolist()
 
         image_fp = os.path.join(self.img_root_dir, self.valid_data['path'][idx])
         try:
-            image = plt.imread(image_fp)
-            image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR) 
+            image = load_image(image_fp, self.valid_data['id'][idx], self.transform, self.image_cache)
         except Exception as e:
             print(f"Error reading image: \n{e}\n Path: {image_fp}")
             image = None
@@ -65,10 +96,12 @@ class RawMimicDataset(Dataset):
     split: (str) extract features for [TRAIN/VAL/TEST]  (default 0.9/.05/.05)
     2022 update: if using multi split csv: valid split are in split_dict below
     """
-    def __init__(self, csv_path, image_root, split=''):
+    def __init__(self, csv_path, image_root, split='', transform=None, image_cache=None):
 
         data = pd.read_csv(csv_path, dtype={'split':str})
         self.img_root_dir = image_root
+        self.transform = transform
+        self.image_cache = image_cache
 
        # splits are subsets
         split_dict = {
@@ -87,14 +120,23 @@ class RawMimicDataset(Dataset):
     def __len__(self):
         return len(self.valid_data)
 
+    def image_id(self, idx):
+        return self.valid_data['dicom_id'][idx]
+
+    def image_size(self, idx):
+        if self.image_cache is not None and self.image_id(idx) in self.image_cache:
+            return self.image_cache.shape(self.image_id(idx))[1:]
+        # (H,W) from the file header, the image is not decoded
+        with Image.open(os.path.join(self.img_root_dir, self.valid_data['path'][idx])) as image:
+            return image.size[::-1]
+
     def __getitem__(self, idx):
         if torch.is_tensor(idx):
             idx = idx.tolist()
 
         image_fp = os.path.join(self.img_root_dir, self.valid_data['path'][idx])
         try:
-            image = plt.imread(image_fp)
-            image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR) 
+            image = load_image(image_fp, self.valid_data['dicom_id'][idx], self.transform, self.image_cache)
         except Exception as e:
             print(f"Error reading image: \n{e}\n Path: {image_fp}")
             image = None
@@ -106,30 +148,61 @@ class RawMimicDataset(Dataset):
 
 
 class RawCocoDataset(Dataset):
-    """MS-COCO dataset captions only
-    No transforms here, extractor class handles it"""
-    def __init__(self, json_file, img_dir):
+    """MS-COCO images and captions. Images are resized by transform (ResizeImage,
+    normalisation and batching are left to the extractor), or read from the image_cache
+    if it holds them.
+
+    Image ids / sizes and the captions (utf-8 bytes back to back, grouped by image) are kept
+    in flat numpy arrays instead of the json lists of dicts: O(1) caption lookup per item
+    and little to copy (on write) into the DataLoader workers."""
+    def __init__(self, json_file, img_dir, transform=None, image_cache=None):
         with open(json_file) as f:
-            self.metadata = json.load(f)
+            metadata = json.load(f)
         self.img_dir = img_dir
+        self.transform = transform
+        self.image_cache = image_cache
+
+        self.image_ids = np.array([img['id'] for img in metadata['images']], dtype=np.int64)
+        self.image_hw = np.array([[img['height'], img['width']] for img in metadata['images']], dtype=np.int32)
+
+        # Stable sort, captions of an image keep their annotation order
+        annotations = sorted(metadata['annotations'], key=lambda c: c['image_id'])
+        captions = [c['caption'].encode() for c in annotations]
+        self.caption_bytes = np.frombuffer(b''.join(captions), dtype=np.uint8)
+        self.caption_offsets = np.cumsum([0] + [len(c) for c in captions], dtype=np.int64)
+        caption_image_ids = np.array([c['image_id'] for c in annotations], dtype=np.int64)
+        # Captions of image idx: caption_start[idx] .. caption_end[idx]
+        self.caption_start = np.searchsorted(caption_image_ids, self.image_ids, side='left')
+        self.caption_end = np.searchsorted(caption_image_ids, self.image_ids, side='right')
+        del metadata, annotations, captions
     
     def __len__(self):
-        return len(self.metadata['images'])
+        return len(self.image_ids)
+
+    def image_id(self, idx):
+        return int(self.image_ids[idx])
+
+    def image_size(self, idx):
+        if self.image_cache is not None and self.image_id(idx) in self.image_cache:
+            return self.image_cache.shape(self.image_id(idx))[1:]
+        return tuple(int(x) for x in self.image_hw[idx])
+
+    def captions(self, idx):
+        offsets = self.caption_offsets[self.caption_start[idx]:self.caption_end[idx]+1]
+        return [self.caption_bytes[start:end].tobytes().decode() for start, end in zip(offsets[:-1], offsets[1:])]
     
     def __getitem__(self, idx):
         if torch.is_tensor(idx):
             idx = idx.tolist()
         
         # By list order, not image id order
-        image_id = self.metadata['images'][idx]['id']
+        image_id = self.image_id(idx)
         img_name = os.path.join(self.img_dir,
                                 f'{image_id:012d}.jpg')
-        image = plt.imread(img_name)
         # image = cv2.resize(plt.imread(img_name), self.resize_dim, interpolation=cv2.INTER_AREA)
         # expects BGR
-        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR) 
-        captions = [c['caption'] for c in self.metadata['annotations'] if c['image_id']==image_id]
-        sample = {'image': image, 'caption':captions, 'img_id': image_id}
+        image = load_image(img_name, image_id, self.transform, self.image_cache)
+        sample = {'image': image, 'caption':self.captions(idx), 'img_id': image_id}
         return sample
 
 ROOT = '/media/matt/data21/datasets/'
@@ -157,6 +230,137 @@ CFG_PATH =  "COCO-InstanceSegmentation/mask_rcnn_R_101_FPN_3x.yaml"
 
 BATCH_SIZE=4
 
+
+def parse_output_configs(spec):
+    """'36,10:100:0.2' -> Extractor output configs, None if empty: num_boxes (a fixed number of
+    boxes) or min_boxes:max_boxes:score_thresh (the boxes above score_thresh, at least min_boxes
+    and at most max_boxes of them)"""
+    if not spec:
+        return None
+    configs = []
+    for config in spec.split(','):
+        values = config.split(':')
+        if len(values) == 1:
+            configs.append({'min_boxes': int(values[0]), 'max_boxes': int(values[0]), 'score_thresh': None})
+        elif len(values) == 3:
+            configs.append({'min_boxes': int(values[0]), 'max_boxes': int(values[1]), 'score_thresh': float(values[2])})
+        else:
+            raise ValueError(f"output config {config!r}: expected num_boxes or min_boxes:max_boxes:score_thresh")
+    return configs
+
+
+def output_paths(output, output_configs):
+    """One .tsv per output config, e.g. features.tsv -> features_36boxes.tsv, features_10-100boxes_t0.2.tsv"""
+    if output_configs is None or len(output_configs) == 1:
+        return [output]
+    root, ext = os.path.splitext(output)
+    paths = []
+    for config in output_configs:
+        if config['score_thresh'] is None:
+            paths.append(f"{root}_{config['max_boxes']}boxes{ext}")
+        else:
+            paths.append(f"{root}_{config['min_boxes']}-{config['max_boxes']}boxes_t{config['score_thresh']}{ext}")
+    return paths
+
+
+def feature_rows(batch, samples, outputs):
+    """FeatureWriterTSV rows of one batch of Extractor outputs"""
+    visual_embeds, output_boxes, num_boxes, cls_probs = outputs
+    # img dim is resized to have shortest edge a multiple
+    # of allowable detectron2 inputs, e.g. 800px
+    return [{'img_id': batch['img_ids'][i],
+             'img_h': samples[1][i]['height'],
+             'img_w': samples[1][i]['width'],
+             'num_boxes': num_boxes[i],
+             'boxes': base64.b64encode(output_boxes[i].detach().cpu().numpy()),
+             'features': base64.b64encode(visual_embeds[i].detach().cpu().numpy()),
+             'cls_probs': base64.b64encode(cls_probs[i].detach().cpu().numpy())}
+             for i in range(len(samples[0]))]
+
+
+def extract_shard(rank, num_procs, dataset, batches, num_threads, args, queue, send_rows=True):
+    """Worker process of extract_parallel: its own Extractor replica over batches
+    rank, rank+num_procs, ... Rows (a list per output config) are sent to the writer as
+    ('rows', batch number, rows),
+    then ('done', rank, (images, seconds)) timed from the second batch (first is warmup).
+    """
+    torch.set_num_threads(num_threads)
+    torch.set_num_interop_threads(1)
+    d2_rcnn = Extractor(CFG_PATH, batch_size=args.batch_size,
+                        output_configs=parse_output_configs(args.output_configs))
+    prepare = PrepareImageInputs(d2_rcnn)
+    loader = torch.utils.data.DataLoader(dataset, 
+                                         batch_sampler=batches[rank::num_procs],
+                                         collate_fn=collate_func,
+                                         num_workers=args.num_workers)
+    num_images, start = 0, time.perf_counter()
+    for shard_idx, batch in enumerate(loader):
+        samples = prepare(batch)
+        rows = [feature_rows(batch, samples, outputs) for outputs in d2_rcnn.extract_all(samples)]
+        if send_rows:
+            queue.put(('rows', shard_idx*num_procs + rank, rows))
+        if shard_idx == 0:
+            start = time.perf_counter()
+        else:
+            num_images += len(batch['img_ids'])
+    queue.put(('done', rank, (num_images, time.perf_counter()-start)))
+
+
+def extract_parallel(dataset, batches, num_procs, args, tsv_writers=None):
+    """Shards the batches over num_procs processes, each with its own Extractor and
+    os.cpu_count()//num_procs intra-op threads (or --threads_per_proc). This process is
+    the only writer: batches are committed in batch order (same file as a single process run).
+
+    Args:
+        dataset (Dataset): Raw* dataset (with its transform set)
+        batches (list): lists of dataset indices
+        num_procs (int)
+        args (Namespace): script args
+        tsv_writers (list, optional): FeatureWriterTSV per output config, None only times the extraction
+
+    Returns:
+        (int, float): images and seconds (slowest process) after warmup
+    """
+    num_threads = args.threads_per_proc or max(1, os.cpu_count()//num_procs)
+    ctx = torch.multiprocessing.get_context('spawn')
+    # Bounded, so fast workers wait for the writer instead of buffering features
+    queue = ctx.Queue(maxsize=4*num_procs)
+    procs = [ctx.Process(target=extract_shard,
+                         args=(rank, num_procs, dataset, batches, num_threads, args, queue, tsv_writers is not None))
+             for rank in range(num_procs)]
+    for proc in procs:
+        proc.start()
+
+    pending, next_batch, timings = {}, 0, {}
+    start_time = time.time()
+    while len(timings) < num_procs:
+        try:
+            kind, key, value = queue.get(timeout=30)
+        except Empty:
+            failed = [proc.exitcode for proc in procs if proc.exitcode not in (None, 0)]
+            if failed:
+                raise RuntimeError(f"Extraction process failed (exit codes {failed})")
+            continue
+        if kind == 'done':
+            timings[key] = value
+            continue
+        pending[key] = value
+        while next_batch in pending:
+            for tsv_writer, rows in zip(tsv_writers, pending.pop(next_batch)):
+                tsv_writer(rows)
+            if next_batch%100==0:
+                print(f'Batch {next_batch} of {len(batches)} ({round((next_batch/len(batches))*100,2)}%), time (min): {round((time.time()-start_time)/60, 2)}')
+            next_batch += 1
+    for proc in procs:
+        proc.join()
+    for tsv_writer in tsv_writers or []:
+        tsv_writer.commit()
+
+    print(f"{num_procs} processes x {num_threads} threads: " +
+          ", ".join(f"{images/seconds:.2f}" for images, seconds in timings.values()) + " images/sec per process")
+    return sum(images for images, _ in timings.values()), max(seconds for _, seconds in timings.values())
+
+
 if __name__=='__main__':
     
     from argparse import ArgumentParser
@@ -165,12 +369,37 @@ if __name__=='__main__':
     parser.add_argument('--output', default='/media/matt/data21/mmRad/img_features/delme.tsv')
     parser.add_argument('--visualise', dest='visualise_examples', default=False)
     parser.add_argument('--data_root', default='/media/matt/data21/datasets/')
+    # 'all': every row of --csv_file
     parser.add_argument('--split', default=r'0.6125', type=str)
     parser.add_argument('--csv_file', default='studies_with_splits_multi.csv')
+    parser.add_argument('--batch_size', default=BATCH_SIZE, type=int)
+    # Several outputs from one detector pass, num_boxes or min_boxes:max_boxes:score_thresh
+    # (e.g. 36,10:100:0.2), each written to its own .tsv (--output with a _[num_boxes]boxes or
+    # _[min_boxes]-[max_boxes]boxes_t[score_thresh] suffix)
+    parser.add_argument('--output_configs', default='', type=str)
+    # Processes decoding and resizing images ahead of the detector
+    parser.add_argument('--num_workers', default=4, type=int)
+    # CPU extraction: processes, each with its own detector replica (and threads, 0: cores/processes)
+    parser.add_argument('--num_procs', default=1, type=int)
+    parser.add_argument('--threads_per_proc', default=0, type=int)
+    # Read resized images from (or with --build_cache True, write them to) this directory
+    parser.add_argument('--image_cache', default=None, type=str)
+    parser.add_argument('--build_cache', default=False, type=bool)
+    # Batch images of the same resized shape together (less padding in the backbone)
+    parser.add_argument('--group_aspect', default=False, type=bool)
+    # Run the detector once per unique image (exact: decoded pixels, phash: near duplicates),
+    # duplicate ids become aliases in the store index
+    parser.add_argument('--dedup', default='', type=str, choices=['', 'exact', 'phash'])
+    # Only extract the images not yet in --output, appended to it (new studies in --csv_file)
+    parser.add_argument('--incremental', default=False, type=bool)
+    # Batches buffered between the load / prepare / detect / write threads
+    parser.add_argument('--queue_size', default=4, type=int)
+    # Time this many batches (images/sec of input preparation and the detector), nothing is written
+    parser.add_argument('--benchmark_batches', default=0, type=int)
 
 
     args = parser.parse_args()
-    
+    split = None if args.split == 'all' else args.split
     
 
     print(f"Building tsv dataset for {args.dataset} dataset. File locations given:")
@@ -184,56 +413,202 @@ if __name__=='__main__':
         print(f"OpenI path: {os.path.join(OPENI_ROOT, args.csv_file)}")
         # Only extracting for those with findings & AP View.
         dataset = RawOpenIDataset(os.path.join(OPENI_ROOT,args.csv_file), 
-                                               OPENI_ROOT, split=args.split)
+                                               OPENI_ROOT, split=split)
         print("done")        
 
     elif args.dataset=='mimic':
         print(f"Mimic path: {MIMIC_ROOT}")
         # Only extracting for those with findings & AP View.
         dataset = RawMimicDataset(os.path.join(MIMIC_ROOT, args.csv_file), 
-                                               MIMIC_IMAGE_ROOT, split=args.split)
+                                               MIMIC_IMAGE_ROOT, split=split)
         print("done")
 
-    d2_rcnn = Extractor(CFG_PATH, batch_size=BATCH_SIZE)
+    output_configs = parse_output_configs(args.output_configs)
+    d2_rcnn = Extractor(CFG_PATH, batch_size=args.batch_size, output_configs=output_configs)
+    # Decode + resize in the loader workers, the main process only normalizes and runs the detector
+    dataset.transform = ResizeImage(d2_rcnn.cfg)
+    if args.image_cache is not None:
+        dataset.image_cache = ImageCache(args.image_cache, dataset.transform)
+        print(f"{len(dataset.image_cache)} resized images in {args.image_cache}")
     
-    loader = torch.utils.data.DataLoader(dataset, 
-                                         batch_size=BATCH_SIZE, 
-                                         collate_fn=collate_func, 
-                                         drop_last=True)
+    def batch_indices(indices):
+        # The extractor handles partial batches, so the last images are not dropped
+        return [indices[i:i+args.batch_size] for i in range(0, len(indices), args.batch_size)]
+
+    def make_loader(batches):
+        return torch.utils.data.DataLoader(dataset, 
+                                           batch_sampler=batches,
+                                           collate_fn=collate_func, 
+                                           num_workers=args.num_workers,
+                                           pin_memory=torch.cuda.is_available(),
+                                           persistent_workers=args.num_workers > 0)
 
-    assert not os.path.exists(args.output), "output tsv file exists"
-    tsv_writer = FeatureWriterTSV(args.output)
-    
     prepare = PrepareImageInputs(d2_rcnn)
-    
-    import time
-    start_time = time.time()
-    num_batches = len(dataset)/BATCH_SIZE
 
-    for batch_idx, batch in enumerate(loader):
-        samples = prepare(batch)
-        
-        if args.visualise_examples:
-            d2_rcnn.show_sample(samples)
-            d2_rcnn.visualise_features(samples)
-            args.visualise_examples=False
-        
-        visual_embeds, output_boxes, num_boxes, cls_probs = d2_rcnn(samples)
-        
-        # write current batch to file
-        # img dim is resized to have shortest edge a multiple
-        # of allowable detectron2 inputs, e.g. 800px
-        items_dict = [{'img_id': batch['img_ids'][i],
-                       'img_h': samples[1][i]['height'],
-                       'img_w': samples[1][i]['width'],
-                       'num_boxes': num_boxes,
-                       'boxes': base64.b64encode(output_boxes[i].detach().cpu().numpy()),
-                       'features': base64.b64encode(visual_embeds[i].detach().cpu().numpy()),
-                       'cls_probs': base64.b64encode(cls_probs[i].detach().cpu().numpy())}
-                       for i in range(len(samples[0]))]
-        tsv_writer(items_dict)
-
-        if batch_idx%100==0:
-            print(f'Batch {batch_idx} of {num_batches} ({round((batch_idx/num_batches)*100,2)}%), time (min): {round((time.time()-start_time)/60, 2)}')
-    elapsed_time = time.time()-start_time
-    print(f"Fin. Extracted features from {len(loader)*BATCH_SIZE} images in {elapsed_time/60:.2f} mins..")
+    if args.build_cache:
+        # One time decode + resize of the images not yet in the cache
+        assert args.image_cache is not None, "--build_cache needs --image_cache"
+        cache = dataset.image_cache
+        start_time = time.time()
+        for batch_idx, batch in enumerate(make_loader(batch_indices(list(range(len(dataset)))))):
+            cached = [(img_id, image) for img_id, image in zip(batch['img_ids'], batch['images'])
+                      if image is not None and img_id not in cache]
+            cache.write([img_id for img_id, _ in cached], [image for _, image in cached])
+            if batch_idx%100==0:
+                cache.save()
+                print(f'Batch {batch_idx}, {len(cache)} images cached, time (min): {round((time.time()-start_time)/60, 2)}')
+        cache.save()
+        print(f"Fin. {len(cache)} resized images in {args.image_cache} ({os.path.getsize(cache.data_path)/1024**3:.2f} GB)")
+        sys.exit(0)
+
+    indices = list(range(len(dataset)))
+    if args.incremental:
+        # Images missing from any of the stores (duplicate ids once)
+        stored = []
+        for output in output_paths(args.output, output_configs):
+            index = load_store_index(output)
+            stored.append(set(index['ids']) | set(index.get('aliases', {})))
+        indices, seen = [], set()
+        for idx in range(len(dataset)):
+            img_id = str(dataset.image_id(idx))
+            if img_id not in seen and not all(img_id in ids for ids in stored):
+                indices.append(idx)
+            seen.add(img_id)
+        print(f"Incremental: {len(dataset)-len(indices)} of {len(dataset)} images already in the store, "
+              f"{len(indices)} to extract")
+        if not indices:
+            sys.exit(0)
+
+    aliases, hashes = {}, {}
+    if args.dedup:
+        # Hash pre-pass (decodes every image; fast with --image_cache)
+        start_time = time.time()
+        known = load_store_index(output_paths(args.output, output_configs)[0]).get('hashes', {}) \
+            if args.incremental else {}
+        unique, position = [], iter(indices)
+        for batch in make_loader(batch_indices(indices)):
+            for img_id, image in zip(batch['img_ids'], batch['images']):
+                idx = next(position)
+                if image is None:
+                    unique.append(idx)
+                    continue
+                key = image_hash(image, args.dedup)
+                if key in known or key in hashes:
+                    aliases[str(img_id)] = known.get(key, hashes.get(key))
+                else:
+                    hashes[key] = str(img_id)
+                    unique.append(idx)
+        print(f"Dedup ({args.dedup}): {len(aliases)} of {len(indices)} images are duplicates, the detector runs on "
+              f"{len(unique)} ({len(aliases)/len(indices):.2%} of the extraction skipped), "
+              f"hashing took {(time.time()-start_time)/60:.2f} mins")
+        indices = unique
+
+    def open_writers():
+        if not args.incremental:
+            for output in output_paths(args.output, output_configs):
+                assert not os.path.exists(output), f"output tsv file exists: {output}"
+        # Appends to existing stores (incremental), the index is committed every 100 batches and at the end
+        tsv_writers = [FeatureWriterTSV(output) for output in output_paths(args.output, output_configs)]
+        for tsv_writer in tsv_writers:
+            tsv_writer.add_aliases(aliases, hashes)
+        return tsv_writers
+
+    batch_sampler = None
+    sequential = batch_indices(indices)
+    if args.group_aspect:
+        shapes = {idx: dataset.transform.output_shape(h, w)
+                  for idx, (h, w) in read_image_sizes(dataset, indices, args.num_workers).items()}
+        batch_sampler = AspectRatioBatchSampler(shapes, args.batch_size, prepare.size_divisibility)
+        print(f"Padding (fraction of backbone input): "
+              f"sequential {padding_fraction(shapes, sequential, prepare.size_divisibility):.2%}, "
+              f"aspect grouped {padding_fraction(shapes, batch_sampler, prepare.size_divisibility):.2%}")
+    loader = make_loader(batch_sampler if batch_sampler is not None else sequential)
+
+    def benchmark(loader):
+        num_images, prepare_time, extract_time = 0, 0., 0.
+        for batch_idx, batch in enumerate(loader):
+            if batch_idx == args.benchmark_batches+1:
+                break
+            start = time.perf_counter()
+            samples = prepare(batch)
+            prepared = time.perf_counter()
+            d2_rcnn.extract_all(samples)
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            # First batch is warmup
+            if batch_idx > 0:
+                num_images += len(batch['img_ids'])
+                prepare_time += prepared-start
+                extract_time += time.perf_counter()-prepared
+        print(f"{num_images} images, batch size {args.batch_size}: "
+              f"prepare {num_images/prepare_time:.2f} images/sec, extractor {num_images/extract_time:.2f} images/sec, "
+              f"total {num_images/(prepare_time+extract_time):.2f} images/sec")
+        return num_images/(prepare_time+extract_time)
+
+    if args.num_procs > 1:
+        # Each process builds its own replica
+        batches = batch_sampler.batches if batch_sampler is not None else sequential
+        del d2_rcnn, prepare, loader
+        if args.benchmark_batches > 0:
+            # Same batches for every process count
+            batches = batches[:(args.benchmark_batches+1)*args.num_procs]
+            scaling = [n for n in (1, 2, 4, 8, 16, 32, 64) if n < args.num_procs] + [args.num_procs]
+            rates = {}
+            for num_procs in scaling:
+                num_images, seconds = extract_parallel(dataset, batches, num_procs, args)
+                rates[num_procs] = num_images/seconds
+            print(f"{'Processes':>10} {'images/sec':>12} {'speedup':>8}")
+            for num_procs, rate in rates.items():
+                print(f"{num_procs:>10} {rate:>12.2f} {rate/rates[1]:>8.2f}")
+            sys.exit(0)
+
+        start_time = time.time()
+        num_images, seconds = extract_parallel(dataset, batches, args.num_procs, args, open_writers())
+        print(f"Fin. Extracted features from {len(indices)} images in {(time.time()-start_time)/60:.2f} mins "
+              f"({num_images/seconds:.2f} images/sec)..")
+        sys.exit(0)
+
+    if args.benchmark_batches > 0:
+        if args.group_aspect:
+            print("Sequential batches:")
+            sequential_rate = benchmark(make_loader(sequential))
+            print("Aspect grouped batches:")
+            grouped_rate = benchmark(loader)
+            print(f"Aspect grouping: {grouped_rate/sequential_rate:.2f}x images/sec")
+        else:
+            benchmark(loader)
+        sys.exit(0)
+
+    tsv_writers = open_writers()
+
+    if args.visualise_examples:
+        samples = prepare(next(iter(loader)))
+        d2_rcnn.show_sample(samples)
+        d2_rcnn.visualise_features(samples)
+
+    num_batches = len(loader)
+
+    def detect(prepared):
+        batch, samples = prepared
+        return batch, samples, d2_rcnn.extract_all(samples)
+
+    def write(detected):
+        batch, samples, outputs = detected
+        # write current batch to file (one per output config)
+        for tsv_writer, config_outputs in zip(tsv_writers, outputs):
+            tsv_writer(feature_rows(batch, samples, config_outputs))
+        written = pipeline.stats['write']['items'] + 1
+        if written%100==0:
+            print(f'Batch {written} of {num_batches} ({round((written/num_batches)*100,2)}%)\n{pipeline.report()}')
+
+    # Decode (loader workers) -> prepare -> detector -> serialize + write, overlapped in threads
+    pipeline = Pipeline([('prepare', lambda batch: (batch, prepare(batch))),
+                         ('detect', detect),
+                         ('write', write)],
+                        queue_size=args.queue_size)
+    elapsed_time = pipeline.run(loader)
+    for tsv_writer in tsv_writers:
+        tsv_writer.commit()
+    print(pipeline.report())
+    print(f"Fin. Extracted features from {len(indices)} images in {elapsed_time/60:.2f} mins "
+          f"({len(indices)/elapsed_time:.2f} images/sec)..")
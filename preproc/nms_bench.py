@@ -0,0 +1,78 @@
+import time
+import numpy as np
+import torch
+from detectron2.layers import nms
+
+from pp_utils import batched_max_conf, select_boxes
+
+
+def per_class_max_conf(cls_boxes, cls_prob, nms_thresh):
+    """Reference: the previous per image, per class loop in Extractor.__call__"""
+    max_conf = torch.zeros((cls_boxes.shape[0]))
+    for cls_ind in range(0, cls_prob.shape[1]-1):   # cls_prob.shape == 1000,81
+        cls_scores = cls_prob[:, cls_ind+1]  # cls_prob[,i+1] <-> cls_boxes[,i] indexing offset
+        det_boxes = cls_boxes[:,cls_ind,:]
+        keep = np.array(nms(det_boxes, cls_scores, nms_thresh).cpu())
+        max_conf[keep] = torch.where(cls_scores[keep].cpu() > max_conf[keep].cpu(), cls_scores[keep].cpu(), max_conf[keep].cpu())
+    return max_conf
+
+
+def synthetic_detections(batch_size, num_proposals=1000, num_classes=80, seed=808, device='cpu'):
+    """Overlapping per class boxes around a few objects and softmax class scores"""
+    g = torch.Generator().manual_seed(seed)
+    centres = torch.rand(batch_size, 10, 2, generator=g) * 800
+    obj = torch.randint(0, 10, (batch_size, num_proposals), generator=g)
+    xy = torch.gather(centres, 1, obj.unsqueeze(-1).expand(-1, -1, 2)).unsqueeze(2) \
+        + 30*torch.randn(batch_size, num_proposals, num_classes, 2, generator=g)
+    wh = 50 + 200*torch.rand(batch_size, num_proposals, num_classes, 2, generator=g)
+    cls_boxes = torch.cat([xy - wh/2, xy + wh/2], dim=-1).clamp(0, 1024)
+    cls_prob = torch.softmax(4*torch.randn(batch_size, num_proposals, num_classes+1, generator=g), dim=-1)
+    return cls_boxes.to(device), cls_prob.to(device)
+
+
+# Per image time of the NMS / box selection in Extractor.__call__: previous per class loop
+# vs batched class-aware NMS of the pairs above --score_floor. Checks that both select the
+# same proposals.
+#   cd preproc && python nms_bench.py
+if __name__=='__main__':
+
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('--batch_size', default=4, type=int)
+    parser.add_argument('--num_proposals', default=1000, type=int)
+    parser.add_argument('--num_boxes', default=36, type=int)
+    parser.add_argument('--nms_thresh', default=0.5, type=float)
+    parser.add_argument('--score_floor', default=0.01, type=float)
+    parser.add_argument('--repeats', default=5, type=int)
+    args = parser.parse_args()
+
+    devices = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+    for device in devices:
+        cls_boxes, cls_prob = synthetic_detections(args.batch_size, args.num_proposals, device=device)
+
+        def sync():
+            if device == 'cuda':
+                torch.cuda.synchronize()
+
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            reference = torch.stack([per_class_max_conf(b, p, args.nms_thresh) for b, p in zip(cls_boxes, cls_prob)])
+            reference_keep = [np.argsort(m).numpy()[::-1][:args.num_boxes] for m in reference]
+        sync()
+        loop_time = (time.perf_counter()-start)/(args.repeats*args.batch_size)
+
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            max_conf = batched_max_conf(cls_boxes, cls_prob, args.nms_thresh, score_floor=args.score_floor)
+            keep = select_boxes(max_conf, None, args.num_boxes, args.num_boxes)
+        sync()
+        batched_time = (time.perf_counter()-start)/(args.repeats*args.batch_size)
+
+        # Exact above the floor (see batched_max_conf)
+        above = reference >= args.score_floor
+        max_diff = float((max_conf.cpu() - reference)[above].abs().max())
+        same = all(set(k.tolist()) == set(r.tolist()) for k, r in zip(keep, reference_keep))
+        pairs = int((cls_prob[..., 1:] >= args.score_floor).sum()) // args.batch_size
+        print(f"{device}: per class loop {1000*loop_time:.1f} ms/image, batched {1000*batched_time:.1f} ms/image "
+              f"({loop_time/batched_time:.1f}x, {pairs} pairs per image above the floor), "
+              f"max_conf diff {max_diff:.1e}, same boxes kept: {same}")
@@ -1,17 +1,18 @@
-import torch, os, csv, base64, time
+import torch, os, io, csv, base64, hashlib, time, queue, threading
+from torch.nn import functional as F
 import cv2
 import json
 import matplotlib.pyplot as plt
 import numpy as np
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
+from concurrent.futures import ThreadPoolExecutor
 from detectron2.modeling import build_model
 from detectron2.checkpoint import DetectionCheckpointer
 from detectron2.structures.image_list import ImageList
 from detectron2.data import transforms as T
 from detectron2.modeling.box_regression import Box2BoxTransform
-from detectron2.modeling.roi_heads.fast_rcnn import FastRCNNOutputs
 from detectron2.structures.boxes import Boxes
-from detectron2.layers import nms
+from detectron2.layers import batched_nms
 from detectron2 import model_zoo
 from detectron2.config import get_cfg
 from detectron2.utils.visualizer import Visualizer
@@ -34,17 +35,81 @@ def collate_func(batch, dset='coco'):
     
     return collated_batch
 
+def batched_max_conf(cls_boxes, cls_prob, nms_thresh, score_floor=0.01):
+    """Class-aware NMS (one group per image and class) of the (proposal, class) pairs scoring
+    at least score_floor, then the max score of each proposal over its boxes kept by NMS.
+
+    NMS only removes lower scoring boxes, so the pairs below score_floor cannot change what
+    happens to the others: max_conf is exact where it is >= score_floor, and 0 for proposals
+    without a kept pair above the floor. The floor also keeps the NMS input small: from 80
+    classes x num_proposals boxes per image down to the plausible ones, so batched_nms loops
+    over small groups, or uses its coordinate offset path when few pairs are left.
+
+    Args:
+        cls_boxes (torch.Tensor): (batch_size, num_proposals, num_classes, 4) per class boxes
+        cls_prob (torch.Tensor): (batch_size, num_proposals, num_classes+1) class probabilities
+        nms_thresh (float): IoU threshold
+        score_floor (float): pairs below this score are left out of NMS, at most the lowest
+            score threshold the proposals are then selected with
+
+    Returns:
+        (torch.Tensor): (batch_size, num_proposals) max_conf
+    """
+    num_classes = cls_boxes.shape[2]
+    # cls_prob[,i+1] <-> cls_boxes[,i] indexing offset
+    cls_scores = cls_prob[..., 1:num_classes+1]
+    # Syncs with the host (number of pairs above the floor)
+    image, proposal, cls = torch.nonzero(cls_scores >= score_floor, as_tuple=True)
+    kept = torch.zeros_like(cls_scores, dtype=torch.bool)
+    if len(image) > 0:
+        keep = batched_nms(cls_boxes[image, proposal, cls], cls_scores[image, proposal, cls],
+                           image*num_classes + cls, nms_thresh)
+        kept[image[keep], proposal[keep], cls[keep]] = True
+    # Scores are >= 0, so boxes removed by NMS (or below the floor) contribute 0
+    return (cls_scores * kept).max(dim=2).values
+
+
+def select_boxes(max_conf, score_thresh, min_boxes, max_boxes):
+    """Proposals with max_conf above score_thresh, at least min_boxes and at most max_boxes
+    of them (the highest max_conf fill up / are kept), sorted by max_conf.
+
+    Args:
+        max_conf (torch.Tensor): (batch_size, num_proposals) from batched_max_conf
+        score_thresh (float): None for a fixed number of boxes (min_boxes == max_boxes)
+
+    Returns:
+        (list): per image index tensor of the kept proposals
+    """
+    top = max_conf.topk(min(max_boxes, max_conf.shape[1]), dim=1).indices
+    if score_thresh is None or min_boxes == max_boxes:
+        return list(top)
+    counts = (max_conf >= score_thresh).sum(dim=1).tolist()
+    return [top[i, :min(max(count, min_boxes), max_boxes)] for i, count in enumerate(counts)]
+
+
 class Extractor:
-    def __init__(self, cfg_path, batch_size,num_proposals=36,custom_model=False):
+    """Region features, boxes and class probabilities from a detectron2 model.
+
+    Args:
+        output_configs (list, optional): dicts with 'min_boxes', 'max_boxes' and 'score_thresh'
+            (see select_boxes), one output per config from the same backbone / RPN / box head
+            pass (see extract_all). Default: a fixed num_proposals boxes.
+    """
+    def __init__(self, cfg_path, batch_size,num_proposals=36,custom_model=False,output_configs=None):
         # TODO: args params
         # NMS params - Use 36 features
-        self.min_boxes = num_proposals
-        self.max_boxes = num_proposals
+        self.output_configs = output_configs or [{'min_boxes': num_proposals, 'max_boxes': num_proposals,
+                                                  'score_thresh': None}]
+        self.min_boxes = self.output_configs[0]['min_boxes']
+        self.max_boxes = self.output_configs[0]['max_boxes']
+        # (proposal, class) pairs below this score are left out of the NMS (see batched_max_conf)
+        self.score_floor = min([0.01] + [config['score_thresh'] for config in self.output_configs
+                                         if config['score_thresh'] is not None])
         
         # Start with copy of default config
         self.cfg = get_cfg()
         self.cfg.merge_from_file(model_zoo.get_config_file(cfg_path))
-        self.cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = 0.5
+        self.cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST = self.score_floor
         if not custom_model:
             self.cfg.MODEL.WEIGHTS = model_zoo.get_checkpoint_url(cfg_path)
         else:
@@ -60,12 +125,25 @@ class Extractor:
         self.model.eval()
 
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        # Decodes the box head deltas to per class boxes
+        self.box2box_transform = Box2BoxTransform(weights=self.cfg.MODEL.ROI_BOX_HEAD.BBOX_REG_WEIGHTS)
 
     def __call__(self, samples):
+        """Outputs of the first output config (see extract_all)"""
+        return self.extract_all(samples)[0]
+
+    @torch.no_grad()
+    def extract_all(self, samples):
         """The ResNet model in combination with FPN generates five features 
         for an image at different levels of complexity. 
         For more details, refer to the FPN paper or this 
         (https://medium.com/@hirotoschwert/digging-into-detectron-2-47b2e794fabd).
+
+        Features, proposals, box head and NMS are computed once; the boxes are then
+        selected for every output config.
+
+        Returns:
+            (list): per output config (visual_embeds, output_boxes, num_boxes, cls_probs)
         """
         # features.keys() = [`p2`, `p3`, `p4`, `p5`, `p6`]
         # each are featres needed by RPN. Then p2-5 + RPN proposals fed to ROI
@@ -83,87 +161,62 @@ class Extractor:
             print(f"Only {num_proposals} generated in this batch")
             proposals = [p[:num_proposals] for p in proposals]
 
-        # We want box_features to be the fc2 outputs of the regions, 
-        # so only use the layers that are needed up to that step
+        # We want box_features to be the fc2 outputs of the regions (before the last relu),
+        # the class logits / box deltas use the same fc2 outputs, so the box head runs once
         features_list = [features[f] for f in ['p2', 'p3', 'p4', 'p5']]
         box_features_1 = self.model.roi_heads.box_pooler(features_list, 
                                                       [x.proposal_boxes for x in proposals])
-        box_features = self.model.roi_heads.box_head.flatten(box_features_1)
-        box_features = self.model.roi_heads.box_head.fc1(box_features)
-        box_features = self.model.roi_heads.box_head.fc_relu1(box_features)
-        box_features = self.model.roi_heads.box_head.fc2(box_features)
-        # Depends on config and batch size of images.
-        # Might not be 1000 proposals
-        box_features = box_features.reshape(self.batch_size, -1, 1024)
-
-        # To get the boxes and scores from the FastRCNNOutputs 
-        # we want the prediction logits and boxes:  
-        cls_features = self.model.roi_heads.box_head(box_features_1)
+        box_head = self.model.roi_heads.box_head
+        box_features = box_head.flatten(box_features_1)
+        box_features = box_head.fc1(box_features)
+        box_features = box_head.fc_relu1(box_features)
+        box_features = box_head.fc2(box_features)
+        cls_features = box_head.fc_relu2(box_features)
+        # All images have num_proposals proposals (any batch size)
+        box_features = box_features.reshape(len(proposals), num_proposals, -1)
+
+        # Softmax scores and per class boxes, as FastRCNNOutputs.predict_probs / predict_boxes
         pred_class_logits, pred_proposal_deltas = self.model.roi_heads.box_predictor(cls_features)
-        
-        # To get the FastRCNN scores and boxes (softmax) we need to do this
-        box2box_transform = Box2BoxTransform(weights=self.cfg.MODEL.ROI_BOX_HEAD.BBOX_REG_WEIGHTS)
-        smooth_l1_beta = self.cfg.MODEL.ROI_BOX_HEAD.SMOOTH_L1_BETA
-
-        outputs = FastRCNNOutputs(
-            box2box_transform,
-            pred_class_logits,
-            pred_proposal_deltas,
-            proposals,
-            smooth_l1_beta,
-        )
-
-        boxes = outputs.predict_boxes() 
-        scores = outputs.predict_probs()
-        image_shapes = outputs.image_shapes
+        scores = F.softmax(pred_class_logits, dim=-1).reshape(len(proposals), num_proposals, -1)
+        boxes = self.box2box_transform.apply_deltas(
+            pred_proposal_deltas, torch.cat([p.proposal_boxes.tensor for p in proposals])
+            ).reshape(len(proposals), num_proposals, -1)
 
         # boxes need to be rescaled to original image size
-        def get_output_boxes(boxes, batched_inputs, image_size, scores):
+        def get_output_boxes(boxes, batched_inputs, image_size):
             proposal_boxes = boxes.reshape(-1, 4).clone()
             scale_x, scale_y = (batched_inputs["width"] / image_size[1], batched_inputs["height"] / image_size[0])
             output_boxes = Boxes(proposal_boxes)
 
             output_boxes.scale(scale_x, scale_y)
             output_boxes.clip(image_size)
+            # Expect 1000x80x4 but might be less
+            return output_boxes.tensor.detach().reshape(-1,80,4)
+
+        # (batch_size, num_proposals, 80, 4) and (batch_size, num_proposals, 81)
+        cls_boxes = torch.stack([get_output_boxes(boxes[i], batched_inputs[i], proposals[i].image_size)
+                                 for i in range(len(proposals))])
+        cls_prob = scores.detach()
+
+        # Select the Boxes using NMS
+        # We need two thresholds - NMS threshold for the NMS box section, and score threshold for the score based section.
+        # First NMS is performed for all the classes and the max scores of each proposal box and each class is updated.
+        # Then the class score threshold is used to select the boxes from those.
+        max_conf = batched_max_conf(cls_boxes, cls_prob, self.cfg.MODEL.ROI_HEADS.NMS_THRESH_TEST,
+                                    score_floor=self.score_floor)
+        return [self.select_outputs(box_features, cls_boxes, cls_prob, max_conf, config)
+                for config in self.output_configs]
+
+    def select_outputs(self, box_features, cls_boxes, cls_prob, max_conf, config):
+        """Features, max class boxes and class probabilities of the boxes kept for one output config"""
+        keep_boxes = select_boxes(max_conf, config['score_thresh'], config['min_boxes'], config['max_boxes'])
 
-            # Select the Boxes using NMS
-            # We need two thresholds - NMS threshold for the NMS box section, and score threshold for the score based section.
-            # First NMS is performed for all the classes and the max scores of each proposal box and each class is updated.
-            # Then the class score threshold is used to select the boxes from those.
-            test_score_thresh = self.cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST
-            test_nms_thresh = self.cfg.MODEL.ROI_HEADS.NMS_THRESH_TEST
-            cls_prob = scores.detach()
-            # Expect 1000x80x40 but might be less
-            cls_boxes = output_boxes.tensor.detach().reshape(-1,80,4)
-            
-            max_conf = torch.zeros((cls_boxes.shape[0]))
-
-            for cls_ind in range(0, cls_prob.shape[1]-1):   # cls_prob.shape == 1000,81
-                cls_scores = cls_prob[:, cls_ind+1]  # cls_prob[,i+1] <-> cls_boxes[,i] indexing offset
-                det_boxes = cls_boxes[:,cls_ind,:]
-                keep = np.array(nms(det_boxes, cls_scores, test_nms_thresh).cpu())
-                max_conf[keep] = torch.where(cls_scores[keep].cpu() > max_conf[keep].cpu(), cls_scores[keep].cpu(), max_conf[keep].cpu())
-            # Return max_conf above score threshold
-            keep_boxes = torch.where(max_conf >= test_score_thresh)[0]
-            # Limit total number of pboxes, to the best few proposals and limit the sequence length. set min and max
-            if len(keep_boxes) < self.min_boxes:
-                keep_boxes = np.argsort(max_conf).numpy()[::-1][:self.min_boxes]
-            elif len(keep_boxes) > self.max_boxes:
-                keep_boxes = np.argsort(max_conf).numpy()[::-1][:self.max_boxes]
-
-            # keep_boxes is idx of >nms. cls_boxes is all boxes (80 per each region/feature) sorted by objectness confidence.
-            return keep_boxes, cls_boxes, cls_prob#, objects, objects_conf
-        # Loop through for each image in batch; len(proposals) == batch len
-        keep_boxes,output_boxes,cls_probs = zip(*[get_output_boxes(boxes[i], batched_inputs[i], proposals[i].image_size, scores[i]) 
-                                        for i in range(len(proposals))])
-        
         # Return 
-        visual_embeds,output_boxes, cls_probs = zip(*[ (box_feature[keep_box.copy()],
-                                            output_box[keep_box.copy()],
-                                            cls_prob[keep_box.copy(),:-1])  
+        visual_embeds, output_boxes, cls_probs = zip(*[(box_feature[keep_box],
+                                                        output_box[keep_box],
+                                                        cls_prob[keep_box,:-1])
                          for box_feature, keep_box, output_box, cls_prob
-                         in zip(box_features,keep_boxes, output_boxes, cls_probs)])
-
+                         in zip(box_features, keep_boxes, cls_boxes, cls_prob)])
 
         # output_boxes.shape is 36,80,4 (e.g. 80 boxes per feature, and 80=#classes; one box per class),
         #  sorted by confidence.
@@ -171,14 +224,10 @@ class Extractor:
         for i,ob in enumerate(output_boxes):
             # Find box corresponding to max prob - (36,)
             max_box_idxs = torch.argmax(cls_probs[i][:,:-1], dim=1)
-            
-            # rather ugly multi-dimensional indexing
-            max_ob = torch.stack([ob[i,idx,:4] for i,idx in enumerate(max_box_idxs)])
-
-            max_output_boxes.append(max_ob)
-        output_boxes = [ob[:,0,:] for ob in output_boxes]
-        # cls_probs = [p[:,0]]
-        return visual_embeds, max_output_boxes, len(keep_boxes[0]), cls_probs #, objects, objects_conf
+            max_output_boxes.append(ob[torch.arange(len(ob), device=ob.device), max_box_idxs])
+        # Per image number of boxes (varies with a score_thresh)
+        num_boxes = [len(keep_box) for keep_box in keep_boxes]
+        return visual_embeds, max_output_boxes, num_boxes, cls_probs #, objects, objects_conf
 
     def visualise_features(self, samples):
         """Takes a sample input (generated from calling PrepareImageInputs)
@@ -220,55 +269,304 @@ class Extractor:
             out = v.draw_instance_predictions(output["instances"].to("cpu"))
             cv2.imshow('',out.get_image()) 
 
+class ResizeImage(object):
+    """ResizeShortestEdge as configured for the detector (INPUT.MIN_SIZE_TEST / MAX_SIZE_TEST),
+    returning a (C,H,W) tensor. Used as the transform of the Raw* datasets, so decoding and
+    resizing run in the DataLoader worker processes. uint8 images stay uint8 (4x less to
+    move between processes than float32).
+    """
+    def __init__(self, cfg):
+        self.short_edge, self.max_size = cfg.INPUT.MIN_SIZE_TEST, cfg.INPUT.MAX_SIZE_TEST
+        self.transform_gen = T.ResizeShortestEdge(
+            [self.short_edge, self.short_edge], self.max_size
+        )
+
+    def __call__(self, image):
+        image = self.transform_gen.get_transform(image).apply_image(image)
+        return torch.from_numpy(np.ascontiguousarray(image.transpose(2, 0, 1)))
+
+    def output_shape(self, h, w):
+        """(H,W) after resizing an h x w image (same rounding as ResizeShortestEdge)"""
+        scale = self.short_edge / min(h, w)
+        new_h, new_w = (self.short_edge, scale * w) if h < w else (scale * h, self.short_edge)
+        if max(new_h, new_w) > self.max_size:
+            scale = self.max_size / max(new_h, new_w)
+            new_h, new_w = new_h * scale, new_w * scale
+        return int(new_h + 0.5), int(new_w + 0.5)
+
+
+def read_image_sizes(dataset, indices=None, num_workers=8, fallback=None):
+    """(H,W) of the images in a Raw* dataset (dataset.image_size, headers only).
+    As in the Raw* datasets' __getitem__, unreadable images are reported and skipped:
+    they get the fallback shape (default: a square of the resize short edge).
+
+    Returns:
+        (dict): dataset index -> (H,W), for indices (default: all)
+    """
+    indices = range(len(dataset)) if indices is None else indices
+    if fallback is None:
+        short_edge = getattr(getattr(dataset, 'transform', None), 'short_edge', 800)
+        fallback = (short_edge, short_edge)
+
+    def image_size(idx):
+        try:
+            return dataset.image_size(idx)
+        except Exception as e:
+            print(f"Error reading image size: \n{e}\n Index: {idx}")
+            return fallback
+
+    with ThreadPoolExecutor(max(1, num_workers)) as pool:
+        return dict(zip(indices, pool.map(image_size, indices)))
+
+
+def padded_shape(shape, size_divisibility=0):
+    h, w = shape
+    if size_divisibility > 1:
+        h = (h + size_divisibility - 1) // size_divisibility * size_divisibility
+        w = (w + size_divisibility - 1) // size_divisibility * size_divisibility
+    return h, w
+
+
+def padding_fraction(shapes, batches, size_divisibility=0):
+    """Fraction of the batched (ImageList) pixels that are padding
+
+    Args:
+        shapes (dict): dataset index -> resized (H,W)
+        batches (iterable): lists of dataset indices
+        size_divisibility (int): backbone size_divisibility
+
+    Returns:
+        (float)
+    """
+    image_px, batch_px = 0, 0
+    for batch in batches:
+        h, w = padded_shape((max(shapes[i][0] for i in batch), max(shapes[i][1] for i in batch)),
+                            size_divisibility)
+        image_px += sum(shapes[i][0] * shapes[i][1] for i in batch)
+        batch_px += len(batch) * h * w
+    return 1 - image_px / batch_px
+
+
+class AspectRatioBatchSampler(Sampler):
+    """Batches images with the same padded resized shape, so ImageList adds (almost) no padding.
+    Each shape group is split into batches; the left over partial batches are pooled, sorted
+    by aspect ratio and batched again. Batches follow the dataset order of their first image.
+
+    Args:
+        shapes (dict): dataset index -> resized (H,W) (ResizeImage.output_shape), only
+            these indices are batched
+        batch_size (int)
+        size_divisibility (int): backbone size_divisibility
+    """
+    def __init__(self, shapes, batch_size, size_divisibility=0):
+        groups = {}
+        for idx, shape in shapes.items():
+            groups.setdefault(padded_shape(shape, size_divisibility), []).append(idx)
+
+        batches, leftover = [], []
+        for indices in groups.values():
+            full = len(indices) - len(indices) % batch_size
+            batches += [indices[i:i+batch_size] for i in range(0, full, batch_size)]
+            leftover += indices[full:]
+        leftover.sort(key=lambda i: shapes[i][0] / shapes[i][1])
+        batches += [leftover[i:i+batch_size] for i in range(0, len(leftover), batch_size)]
+        self.batches = sorted(batches, key=lambda batch: batch[0])
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+class ImageCache(object):
+    """Resized images (ResizeImage output) stored back to back in one memory mapped file
+    (images.bin), keyed by image id in index.json: id -> [byte offset, dtype, C, H, W].
+    The index also records the resize config it was built with.
+
+    Args:
+        cache_dir (str)
+        resize (ResizeImage, optional): checked against (or recorded in) the index
+    """
+    def __init__(self, cache_dir, resize=None):
+        self.data_path = os.path.join(cache_dir, 'images.bin')
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.index, self.resize_cfg = {}, None
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                saved = json.load(f)
+            self.index, self.resize_cfg = saved['images'], saved['resize']
+        if resize is not None:
+            resize_cfg = [resize.short_edge, resize.max_size]
+            assert self.resize_cfg in (None, resize_cfg), \
+                f"{cache_dir} was built for resize {self.resize_cfg}, detector uses {resize_cfg}"
+            self.resize_cfg = resize_cfg
+        os.makedirs(cache_dir, exist_ok=True)
+        self._data = None
+
+    def __getstate__(self):
+        # DataLoader workers open their own memmap
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, img_id):
+        return str(img_id) in self.index
+
+    def __getitem__(self, img_id):
+        offset, dtype, *shape = self.index[str(img_id)]
+        if self._data is None:
+            self._data = np.memmap(self.data_path, dtype=np.uint8, mode='r')
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        image = np.frombuffer(self._data[offset:offset+size], dtype=dtype).reshape(shape)
+        return torch.from_numpy(image.copy())
+
+    def shape(self, img_id):
+        return tuple(self.index[str(img_id)][2:])
+
+    def write(self, img_ids, images):
+        """Appends (C,H,W) tensors to images.bin (call save to commit the index)"""
+        with open(self.data_path, 'ab') as f:
+            offset = f.tell()
+            for img_id, image in zip(img_ids, images):
+                image = image.numpy()
+                f.write(image.tobytes())
+                self.index[str(img_id)] = [offset, image.dtype.str, *image.shape]
+                offset += image.nbytes
+        self._data = None
+
+    def save(self):
+        # Replaced atomically, readers see the previous or the new index
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'resize': self.resize_cfg, 'images': self.index}, f)
+        os.replace(tmp_path, self.index_path)
+
+
 class PrepareImageInputs(object):
     """Convert an image to a model input
     The detectron uses resizing and normalization based on
     the configuration parameters and the input is to be provided using ImageList. 
     The model.backbone.size_divisibility handles the sizes (padding) such 
     that the FPN lateral and output convolutional features have same dimensions.
+
+    Images can be already resized (C,H,W) tensors (ResizeImage in the dataset) or
+    (H,W,C) arrays, which are resized here.
     """
     def __init__(self, extractor):
         # model cfg for resize config. 
         self.cfg = extractor.cfg
         self.size_divisibility = extractor.model.backbone.size_divisibility
 
-        self.transform_gen = T.ResizeShortestEdge(
-            [self.cfg.INPUT.MIN_SIZE_TEST, self.cfg.INPUT.MIN_SIZE_TEST], self.cfg.INPUT.MAX_SIZE_TEST
-        )
+        self.resize = ResizeImage(self.cfg)
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
+        num_channels = len(self.cfg.MODEL.PIXEL_MEAN)
+        self.pixel_mean = torch.Tensor(self.cfg.MODEL.PIXEL_MEAN).view(1, num_channels, 1, 1).to(self.device)
+        self.pixel_std = torch.Tensor(self.cfg.MODEL.PIXEL_STD).view(1, num_channels, 1, 1).to(self.device)
+
     def __call__(self, batch):
         # detectron expects BGR images.
+        img_list = [img if torch.is_tensor(img) else self.resize(img) for img in batch['images']]
+        img_list = [img.to(self.device, non_blocking=True) for img in img_list]
 
-        img_list = [self.transform_gen.get_transform(img).apply_image(img)
-                    for img in batch['images']] 
-         # Convert to C,H,W format 
-        convert_to_tensor = lambda x: torch.Tensor(x.astype("float32").transpose(2, 0, 1)).to(self.device)
+        batched_inputs = [{"image":img, "height": img.shape[1], "width": img.shape[2]} for img in img_list]
 
-        batched_inputs = [{"image":convert_to_tensor(img), "height": img.shape[0], "width": img.shape[1]} for img in img_list]
+        return self.normalize(img_list), batched_inputs
 
-        # Normalizing the image
-        num_channels = len(self.cfg.MODEL.PIXEL_MEAN)
-        pixel_mean = torch.Tensor(self.cfg.MODEL.PIXEL_MEAN).view(num_channels, 1, 1).to(self.device)
-        pixel_std = torch.Tensor(self.cfg.MODEL.PIXEL_STD).view(num_channels, 1, 1).to(self.device)
-        normalizer = lambda x: (x - pixel_mean) / pixel_std
-        images = [normalizer(x["image"]) for x in batched_inputs]
+    def normalize(self, img_list):
+        """Pads the batch (to size_divisibility) and normalizes it in one op; padding is 0
+        after normalization, as ImageList.from_tensors on normalized images.
 
-        # Convert to ImageList
-        images =  ImageList.from_tensors(images,self.size_divisibility)
-        
-        return images, batched_inputs
+        Returns:
+            (ImageList)
+        """
+        image_sizes = [tuple(img.shape[-2:]) for img in img_list]
+        max_h, max_w = padded_shape((max(s[0] for s in image_sizes), max(s[1] for s in image_sizes)),
+                                    self.size_divisibility)
+
+        images = torch.zeros((len(img_list), img_list[0].shape[0], max_h, max_w), device=self.device)
+        for img, pad in zip(img_list, images):
+            pad[:, :img.shape[1], :img.shape[2]].copy_(img)
+        images = (images - self.pixel_mean) / self.pixel_std
+        for (h, w), pad in zip(image_sizes, images):
+            pad[:, h:, :] = 0
+            pad[:, :, w:] = 0
+        return ImageList(images, image_sizes)
         
 
+def image_hash(image, method='exact'):
+    """Content hash of a (C,H,W) image tensor
+
+    Args:
+        method (str): 'exact' (blake2b of the pixels) or 'phash' (64 bit difference hash
+            of the 9x8 grayscale thumbnail, also matches near duplicates e.g. re-encoded exports)
+
+    Returns:
+        (str): hex digest
+    """
+    if method == 'exact':
+        digest = hashlib.blake2b(str(tuple(image.shape)).encode(), digest_size=16)
+        digest.update(image.contiguous().numpy().tobytes())
+        return digest.hexdigest()
+    thumbnail = F.interpolate(image.float().mean(dim=0)[None, None], size=(8, 9), mode='area')[0, 0]
+    bits = (thumbnail[:, 1:] > thumbnail[:, :-1]).flatten().tolist()
+    return f"{int(''.join('1' if bit else '0' for bit in bits), 2):016x}"
+
+
+def load_store_index(fname):
+    """Index of a .tsv feature store ([fname].index.json): committed size (bytes) of the
+    .tsv, img_id -> byte offset of its row, aliases (duplicate img_id -> img_id of the row)
+    and content hash -> img_id. A .tsv without an index (written before indexing) is
+    scanned once.
+    """
+    index_path = fname + '.index.json'
+    if os.path.exists(fname) and os.path.exists(index_path):
+        with open(index_path) as f:
+            return json.load(f)
+    index = {'size': 0, 'ids': {}, 'aliases': {}, 'hashes': {}}
+    if os.path.exists(fname):
+        with open(fname, 'rb') as tsv:
+            for line in tsv:
+                # A last row without a line end was not fully written
+                if not line.endswith(b'\n'):
+                    break
+                index['ids'][line.split(b'\t', 1)[0].decode()] = index['size']
+                index['size'] += len(line)
+    return index
+
+
 class FeatureWriterTSV(object):
-    def __init__(self, fname):
+    """Appends rows to a .tsv feature store and keeps its index (see load_store_index).
+    The index is replaced atomically every commit_every batches and by commit(), so readers
+    (src.utils.load_tsv) only see committed rows. Rows written after the last commit
+    (an interrupted run) are truncated when the store is reopened, and ids already in the
+    store are not written again.
+    """
+    def __init__(self, fname, commit_every=100):
         ## full fieldnames as per butd
         # self.fieldnames = ["img_id", "img_h", "img_w", "objects_id", "objects_conf",
         #       "attrs_id", "attrs_conf", "num_boxes", "boxes", "features"]    
         self.fieldnames = ["img_id", "img_h", "img_w", 
                            "num_boxes", "boxes", "features", "cls_probs"]
         self.fname = fname
+        self.index_path = fname + '.index.json'
+        self.commit_every = commit_every
+        self.uncommitted = 0
+
+        self.index = load_store_index(fname)
+        if os.path.exists(fname) and os.path.getsize(fname) > self.index['size']:
+            print(f"Dropping {os.path.getsize(fname) - self.index['size']} uncommitted bytes from {fname}")
+            os.truncate(fname, self.index['size'])
 
+    def __contains__(self, img_id):
+        return str(img_id) in self.index['ids'] or str(img_id) in self.index.get('aliases', {})
+
+    def __len__(self):
+        return len(self.index['ids'])
 
     def __call__(self, items_dict):
         """items_dict contains list of dicts (each an image)
@@ -276,10 +574,146 @@ class FeatureWriterTSV(object):
         
         # open in append mode for batch writing- 
         # make sure new file name for each dataset
-        with open(self.fname, 'a+') as tsv:
-            writer = csv.DictWriter(tsv, fieldnames=self.fieldnames, delimiter='\t')
+        row = io.StringIO()
+        writer = csv.DictWriter(row, fieldnames=self.fieldnames, delimiter='\t')
+        with open(self.fname, 'ab') as tsv:
+            offset = tsv.tell()
             for item in items_dict:
+                if item['img_id'] in self:
+                    continue
                 writer.writerow(item)
+                line = row.getvalue().encode()
+                row.seek(0)
+                row.truncate()
+                tsv.write(line)
+                self.index['ids'][str(item['img_id'])] = offset
+                offset += len(line)
+
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.commit()
+
+    def add_aliases(self, aliases, hashes=None):
+        """Records duplicate img_id -> extracted img_id (and content hash -> img_id),
+        visible to readers from the next commit"""
+        self.index.setdefault('aliases', {}).update(aliases)
+        self.index.setdefault('hashes', {}).update(hashes or {})
+
+    def commit(self):
+        """Makes the rows written so far visible to readers"""
+        if os.path.exists(self.fname):
+            with open(self.fname, 'ab') as tsv:
+                os.fsync(tsv.fileno())
+            self.index['size'] = os.path.getsize(self.fname)
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+        self.uncommitted = 0
+
+class Pipeline(object):
+    """Runs stages in threads connected by bounded queues, so e.g. input preparation,
+    the detector and output serialization / disk writes of consecutive batches overlap.
+    The iteration of the source (the DataLoader) is timed as the 'load' stage.
+
+    Args:
+        stages (list): (name, fn) pairs, fn(item) -> item for the next stage
+        queue_size (int): max items waiting in front of each stage
+    """
+    _done = object()
+
+    def __init__(self, stages, queue_size=4):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.stats = {name: {'busy': 0., 'items': 0} for name in ['load'] + [name for name, _ in stages]}
+        self.start_time = None
+
+    def run(self, source):
+        """Processes every item of source, re-raises the first stage error
+
+        Returns:
+            (float): wall time (seconds)
+        """
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        errors, stop = [], threading.Event()
+
+        def put(q, item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def get(q):
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+            return self._done
+
+        def timed(name, fn, *args):
+            start = time.perf_counter()
+            out = fn(*args)
+            self.stats[name]['busy'] += time.perf_counter()-start
+            self.stats[name]['items'] += 1
+            return out
+
+        def load():
+            try:
+                iterator = iter(source)
+                # Stop reading the source as soon as a downstream stage has failed
+                while not stop.is_set():
+                    try:
+                        item = timed('load', next, iterator)
+                    except StopIteration:
+                        break
+                    put(queues[0], item)
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+            finally:
+                put(queues[0], self._done)
+
+        def run_stage(i, name, fn):
+            out_queue = queues[i+1] if i+1 < len(queues) else None
+            try:
+                while True:
+                    item = get(queues[i])
+                    if item is self._done:
+                        break
+                    out = timed(name, fn, item)
+                    if out_queue is not None:
+                        put(out_queue, out)
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+            finally:
+                if out_queue is not None:
+                    put(out_queue, self._done)
+
+        self.start_time = time.perf_counter()
+        threads = [threading.Thread(target=load, daemon=True)] + \
+                  [threading.Thread(target=run_stage, args=(i, name, fn), daemon=True)
+                   for i, (name, fn) in enumerate(self.stages)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return time.perf_counter()-self.start_time
+
+    def report(self):
+        """Per stage busy time, utilization (busy / wall time) and batches/sec"""
+        wall = time.perf_counter()-self.start_time
+        lines = [f"{'Stage':<10} {'busy (s)':>10} {'util':>7} {'batches/s':>10}"]
+        for name, stats in self.stats.items():
+            rate = stats['items']/stats['busy'] if stats['busy'] > 0 else 0.
+            lines.append(f"{name:<10} {stats['busy']:>10.1f} {stats['busy']/wall:>7.1%} {rate:>10.2f}")
+        return "\n".join(lines)
+
 
 # def load_tsv(fname, topk=None):
 #     """Load object features from tsv file.
@@ -1,4 +1,5 @@
 import os, json
+import torch
 import pytorch_lightning as pl
 import wandb
 from pytorch_lightning.loggers import WandbLogger
@@ -7,6 +8,7 @@ from pytorch_lightning.callbacks import ModelCheckpoint, LearningRateMonitor
 from src.model import MMRadForPretraining
 from src.data import MMRadDM
 from src.parameters import parse_args
+from src.memory import find_batch_size
 ##
 # TODO: This can be removed once pytorch-lightning issue #10408 is merged
 # https://github.com/PyTorchLightning/pytorch-lightning/pull/10408
@@ -61,6 +63,7 @@ if __name__=='__main__':
     # Layers: {args.num_tx_layers} 
     Training for max steps / epochs: {args.steps} / {args.epochs}
     Batch size: {args.batch_size} 
+    Gradient checkpointing: {args.grad_checkpointing}
     Max sequence length: {args.max_seq_len} 
     Dataset: {args.train}
     Subset?: {args.topk}
@@ -107,6 +110,14 @@ if __name__=='__main__':
                 args=args, 
                 train_size=dm.train_size)
     
+    if args.memory_budget_gb > 0:
+        print(f"Finding the largest batch size for {args.tasks} in {args.memory_budget_gb} GB")
+        batch_size, probed = find_batch_size(model, dm.train_dset, model.hparams.tasks, args.memory_budget_gb)
+        print(f"Using batch size {batch_size} (was {args.batch_size})")
+        args.batch_size = dm.hparams.batch_size = model.hparams.batch_size = batch_size
+        wandb_logger.experiment.config.update({'batch_size':batch_size, 'batch_size_probe_gb':probed},
+                                              allow_val_change=True)
+
     wandb_logger.watch(model)
 
     cp_path = os.path.join(args.save_cp_path,'PT',args.run_name,'pl_framework')
@@ -126,7 +137,7 @@ if __name__=='__main__':
     # Training
     trainer = pl.Trainer.from_argparse_args(
         args,
-        gpus=1, 
+        gpus=int(torch.cuda.is_available()),
         callbacks=callbacks,
         logger=wandb_logger, 
         log_every_n_steps=10, 
@@ -0,0 +1,108 @@
+import os
+import torch
+import pytorch_lightning as pl
+from pytorch_lightning.loggers import WandbLogger
+from pytorch_lightning.callbacks import LearningRateMonitor
+
+from src.data import MMRadDM
+from src.parameters import parse_args
+from src.utils import MetricsCallback, load_paths_dict
+from src.inference import load_classifier, ClassifierGraph, predict_dataloader, auroc_scores, time_fn, module_size_mb
+from src.pruning import importance_scores, prune_encoder
+
+import warnings
+
+warnings.filterwarnings(
+    "ignore", ".*Trying to infer the `batch_size` from an ambiguous collection.*"
+)
+warnings.filterwarnings(
+    "ignore", ".*DataModule.setup has already been called.*"
+)
+
+def evaluate(model, loader, inputs, repeats):
+    graph = ClassifierGraph(model).eval()
+    preds, labels = predict_dataloader(graph, loader, model.pp, device=model.device)
+    _, avg_auc = auroc_scores(preds, labels)
+    return {'size_mb':module_size_mb(graph), 'avg_auc':avg_auc,
+            'latency_s':time_fn(graph, *inputs, repeats=repeats)}
+
+# Score heads / FFN neurons of a fine tuned classifier on the validation split, remove the
+# lowest scoring ones and (optionally) recover with a short fine tune:
+#   python prune.py --load_cp_path [FT pl_framework checkpoint] --head_prune_ratio 0.3 \
+#       --ffn_prune_ratio 0.3 --recovery_epochs 1
+# The pruned encoder is saved to [save_cp_path]/FT/prune-[name]/encoder, to fine tune it again:
+#   python finetune.py --load_model [save_cp_path]/FT/prune-[name]/encoder ...
+if __name__=='__main__':
+
+    args = parse_args(stage='prune')
+    pl.seed_everything(808, workers=True)
+    assert args.load_cp_path is not None, "--load_cp_path (fine tuned checkpoint) is required"
+
+    # Needed if using TokenizerFast:
+    os.environ["TOKENIZERS_PARALLELISM"] = "true"
+
+    path_dict = load_paths_dict()
+    log_run_name = f"prune-{args.run_name}"
+
+    dm = MMRadDM(args, path_dict)
+    dm.setup()
+    model = load_classifier(args, labelset=dm.labelset)
+
+    test_loader = dm.test_dataloader()
+    batch = model.pp.tokenize_pad_vectorize(next(iter(test_loader)))
+    inputs = (batch['txt']['input_ids'].to(model.device), batch['txt']['att_mask'].to(model.device),
+              batch['img']['features'].to(model.device), batch['img']['boxes'].to(model.device))
+
+    results = {'original': evaluate(model, test_loader, inputs, args.bench_repeats)}
+
+    print(f"Scoring heads and FFN neurons on {dm.valid_size} validation studies")
+    head_scores, ffn_scores = importance_scores(model, dm.val_dataloader(), max_batches=args.prune_batches)
+    pruned_heads = prune_encoder(model, head_scores, ffn_scores,
+                                 head_ratio=args.head_prune_ratio, ffn_ratio=args.ffn_prune_ratio)
+    print(f"Pruned {sum(len(h) for h in pruned_heads.values())} heads: {pruned_heads}")
+    print(f"FFN intermediate size: {model.config.intermediate_size}")
+    results['pruned'] = evaluate(model, test_loader, inputs, args.bench_repeats)
+
+    if args.recovery_epochs > 0:
+        wandb_logger = WandbLogger(
+            name=log_run_name,
+            project=args.project,
+            offline=args.log_offline,
+            log_model=False,
+            )
+        wandb_logger.experiment.config.update(args)
+        auroc_metrics = MetricsCallback(
+            train_size=dm.train_size,
+            valid_size=dm.valid_size,
+            n_classes=dm.num_classes)
+        model.hparams.epochs = args.recovery_epochs
+        trainer = pl.Trainer.from_argparse_args(
+            args,
+            gpus=int(torch.cuda.is_available()),
+            callbacks=[LearningRateMonitor(logging_interval='step'), auroc_metrics],
+            logger=wandb_logger,
+            log_every_n_steps=10,
+            max_epochs=args.recovery_epochs,
+            max_steps=args.steps,
+            deterministic=True,
+            )
+        trainer.fit(model, dm)
+        model.eval()
+        results['recovered'] = evaluate(model, test_loader, inputs, args.bench_repeats)
+
+    if args.save_cp_path != "none":
+        encoder_path = os.path.join(args.save_cp_path,'FT',log_run_name,'encoder')
+        model.model.save_pretrained(save_directory=encoder_path)
+        print(f"Pruned encoder saved to {encoder_path}")
+        if args.recovery_epochs > 0:
+            # Reload with --load_model [encoder_path] so the pruned architecture is rebuilt
+            model.hparams.load_model = encoder_path
+            cp_path = os.path.join(args.save_cp_path,'FT',log_run_name,'pl_framework')
+            trainer.save_checkpoint(cp_path)
+            print(f"Recovered checkpoint saved to {cp_path}")
+
+    base = results['original']
+    print(f"\n{'Model':<10}{'Size (MB)':>11}{'Avg AUROC':>12}{'dAUROC':>9}{'Latency (ms)':>14}{'Speedup':>10}")
+    for name, r in results.items():
+        print(f"{name:<10}{r['size_mb']:>11.1f}{r['avg_auc']:>12.4f}{r['avg_auc']-base['avg_auc']:>+9.4f}"
+              f"{1000*r['latency_s']:>14.1f}{base['latency_s']/r['latency_s']:>9.2f}x")
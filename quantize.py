@@ -0,0 +1,79 @@
+import os, sys
+import torch
+
+from src.data import MMRadDM
+from src.parameters import parse_args
+from src.inference import (
+    ClassifierGraph,
+    load_classifier,
+    quantize_classifier,
+    save_quantized,
+    load_quantized,
+    module_size_mb,
+    predict_dataloader,
+    auroc_scores,
+    time_fn
+)
+from src.utils import load_paths_dict
+
+# Dynamic int8 quantization of a fine tuned classifier for CPU inference.
+# Compares AUROC, latency and size against fp32 on the --test split, then saves the int8 model:
+#   python quantize.py --load_cp_path [pl_framework checkpoint] --test mimic --quantized_path classifier_int8.pt
+# Evaluate a previously saved int8 model only (no --load_cp_path, the fp32 model is not built):
+#   python quantize.py --quantized_path classifier_int8.pt
+if __name__=='__main__':
+
+    args = parse_args(stage='quantize')
+    path_dict = load_paths_dict()
+
+    # Needed if using TokenizerFast:
+    os.environ["TOKENIZERS_PARALLELISM"] = "true"
+    # Quantized kernels are CPU only
+    device = torch.device('cpu')
+
+    dm = MMRadDM(args, path_dict)
+    dm.setup(stage='test')
+    loader = dm.test_dataloader()
+
+    if args.load_cp_path is None and args.quantized_path is not None and os.path.exists(args.quantized_path):
+        from transformers import BertTokenizerFast
+        from src.tasks import PretextProcessor
+
+        q_graph = load_quantized(args.quantized_path)
+        pp = PretextProcessor(BertTokenizerFast.from_pretrained(args.tokenizer, do_lower_case=True),
+                              max_seq_len=args.max_seq_len)
+        preds, labels = predict_dataloader(q_graph, loader, pp, device=device)
+        auc, avg_auc = auroc_scores(preds, labels)
+        print(f"int8 classifier from {args.quantized_path}: Avg AUROC {avg_auc:.4f}")
+        sys.exit(0)
+
+    model = load_classifier(args, labelset=dm.labelset).to(device)
+    fp32_graph = ClassifierGraph(model).eval()
+    q_graph = quantize_classifier(model)
+
+    # Time both on the same (first) test batch
+    batch = model.pp.tokenize_pad_vectorize(next(iter(loader)))
+    inputs = (batch['txt']['input_ids'].to(device), batch['txt']['att_mask'].to(device),
+              batch['img']['features'].to(device), batch['img']['boxes'].to(device))
+
+    results = {}
+    for name, graph in [('fp32', fp32_graph), ('int8', q_graph)]:
+        preds, labels = predict_dataloader(graph, loader, model.pp, device=device)
+        auc, avg_auc = auroc_scores(preds, labels)
+        results[name] = {'auc':auc, 'avg_auc':avg_auc,
+                         'size_mb':module_size_mb(graph),
+                         'latency_s':time_fn(graph, *inputs, repeats=args.bench_repeats)}
+
+    print(f"\n{'Label':<28}{'fp32 AUC':>10}{'int8 AUC':>10}")
+    for i, name in enumerate(dm.labelset):
+        print(f"{name:<28}{results['fp32']['auc'][i]:>10.4f}{results['int8']['auc'][i]:>10.4f}")
+
+    fp32, int8 = results['fp32'], results['int8']
+    print(f"""\n
+    Avg AUROC fp32 / int8: {fp32['avg_auc']:.4f} / {int8['avg_auc']:.4f} (delta {int8['avg_auc']-fp32['avg_auc']:+.4f})
+    Batch latency fp32 / int8 (bs={inputs[0].shape[0]}, {torch.get_num_threads()} threads): {1000*fp32['latency_s']:.1f} / {1000*int8['latency_s']:.1f} ms
+    Speedup: {fp32['latency_s']/int8['latency_s']:.2f}x
+    Model size fp32 / int8: {fp32['size_mb']:.1f} / {int8['size_mb']:.1f} MB ({fp32['size_mb']/int8['size_mb']:.2f}x smaller)\n""")
+
+    if args.quantized_path is not None:
+        save_quantized(q_graph, args.quantized_path)
@@ -0,0 +1,70 @@
+import os, time
+import torch
+
+from src.data import MMRadDM
+from src.parameters import parse_args
+from src.inference import load_classifier, auroc_scores
+from src.utils import load_paths_dict
+
+# AUROC and throughput of a fine tuned classifier on the --test split against the
+# number of regions kept by select_regions (detector confidence by default):
+#   python region_sweep.py --load_cp_path [FT pl_framework checkpoint] --region_sweep 5,10,20,36 --region_score conf
+# Add --region_threshold 0.5 to sweep the max k of the adaptive (per study) selection.
+if __name__=='__main__':
+
+    args = parse_args(stage='region_sweep')
+    path_dict = load_paths_dict()
+    sweep = [int(k) for k in args.region_sweep.split(',')]
+
+    # Needed if using TokenizerFast:
+    os.environ["TOKENIZERS_PARALLELISM"] = "true"
+
+    # Setting num_regions makes the datamodule keep cls_probs when scoring by confidence
+    args.num_regions = max(sweep)
+    dm = MMRadDM(args, path_dict)
+    dm.setup(stage='test')
+    loader = dm.test_dataloader()
+
+    model = load_classifier(args, labelset=dm.labelset)
+    device = model.device
+
+    # Tokenise once, so the timed loop only covers region selection and the forward pass
+    batches = []
+    for batch in loader:
+        batch = model.pp.tokenize_pad_vectorize(batch)
+        batches.append(batch)
+
+    results = []
+    for k in sweep:
+        model.hparams.num_regions = k
+        preds, labels, kept = [], [], []
+        elapsed = 0.
+        with torch.no_grad():
+            for batch in batches:
+                inputs = {'input_ids':batch['txt']['input_ids'].to(device),
+                          'attention_mask':batch['txt']['att_mask'].to(device),
+                          'img_ft':batch['img']['features'].to(device),
+                          'img_box':batch['img']['boxes'].to(device),
+                          'cls_probs':batch['img']['cls_probs'].to(device) if 'cls_probs' in batch['img'] else None}
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+                start = time.perf_counter()
+                logits = model.classify(**inputs)
+                if torch.cuda.is_available():
+                    torch.cuda.synchronize()
+                elapsed += time.perf_counter()-start
+
+                _, _, mask = model.select_regions(inputs['img_ft'], inputs['img_box'], inputs['cls_probs'])
+                kept.append(mask.sum(dim=1).cpu())
+                preds.append(torch.sigmoid(logits).cpu())
+                labels.append(batch['label'].cpu())
+
+        _, avg_auc = auroc_scores(torch.cat(preds), torch.cat(labels))
+        results.append({'k':k, 'avg_auc':avg_auc,
+                        'mean_regions':float(torch.cat(kept).mean()),
+                        'throughput':sum(len(p) for p in preds)/elapsed})
+
+    print(f"\nRegion selection sweep ({args.region_score}, threshold {args.region_threshold}) on {args.test}:")
+    print(f"{'k':>5}{'Mean regions':>14}{'Avg AUROC':>12}{'Studies/s':>12}")
+    for r in results:
+        print(f"{r['k']:>5}{r['mean_regions']:>14.1f}{r['avg_auc']:>12.4f}{r['throughput']:>12.1f}")
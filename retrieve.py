@@ -0,0 +1,82 @@
+import os, time
+import torch
+from torch.utils.data import DataLoader
+
+from src.model import MMRadForPretraining
+from src.data import MMRadDM, MimicDataset
+from src.parameters import parse_args
+from src.inference import LatencyStats
+from src.retrieval import RetrievalIndex, encode_corpus, pooled_embeddings, itm_rerank
+from src.utils import load_paths_dict
+
+# "Find similar prior cases": encodes the --train split into pooled multimodal embeddings,
+# builds an on-disk index (once) and queries it with --test split studies:
+#   python retrieve.py --load_cp_path [pretraining pl_framework checkpoint] --index_type ivf --retrieve_k 10 --rerank_k 50
+# With --rerank_k > 0, the top rerank_k candidates are re-ranked by the ITM head in one batch
+# (ahead of the other retrieve_k candidates, in index order).
+if __name__=='__main__':
+
+    args = parse_args(stage='retrieve')
+    path_dict = load_paths_dict()
+
+    # Needed if using TokenizerFast:
+    os.environ["TOKENIZERS_PARALLELISM"] = "true"
+
+    if args.load_cp_path is None:
+        print("Warning: no --load_cp_path given, ITM head is untrained")
+        model = MMRadForPretraining(args=args, train_size=0, tokenizer=args.tokenizer)
+    else:
+        print(f'Loading saved model from {args.load_cp_path}')
+        model = MMRadForPretraining.load_from_checkpoint(args.load_cp_path, args=args, train_size=0)
+    model.eval()
+    model.to(torch.device('cuda' if torch.cuda.is_available() else 'cpu'))
+
+    # Only used for its file paths
+    dm = MMRadDM(args, path_dict)
+    corpus = MimicDataset(dm.train_txt_path, dm.train_img_path, topk=args.topk)
+
+    if os.path.exists(os.path.join(args.index_dir, 'meta.json')):
+        index = RetrievalIndex.load(args.index_dir)
+        print(f"Loaded {index.index_type} index of {len(index)} studies from {args.index_dir}")
+    else:
+        start = time.time()
+        loader = DataLoader(corpus, batch_size=args.valid_batch_size, shuffle=False,
+                            num_workers=dm.num_workers)
+        ids, embeddings = encode_corpus(model, loader)
+        print(f"Encoded {len(ids)} studies in {time.time()-start:.1f}s")
+        index = RetrievalIndex.build(args.index_dir, ids, embeddings,
+                                     index_type=args.index_type, n_lists=args.n_lists)
+
+    # Queries are run one study at a time, as they would arrive from a viewer
+    queries = MimicDataset(dm.test_txt_path, dm.test_img_path, topk=args.num_queries)
+    loader = DataLoader(queries, batch_size=1, shuffle=False)
+    encode_latency, rerank_latency, total_latency = LatencyStats(), LatencyStats(), LatencyStats()
+
+    with torch.no_grad():
+        for i, batch in enumerate(loader):
+            start = time.perf_counter()
+            report = batch['txt']['raw'][0]
+            query = pooled_embeddings(model, batch).float().cpu().numpy()
+            encode_latency.record(time.perf_counter()-start)
+
+            _, candidates = index.search(query, k=max(args.retrieve_k, args.rerank_k), n_probe=args.n_probe)
+            candidates = list(candidates[0])
+            if args.rerank_k > 0:
+                # Only the top rerank_k are re-ranked, the rest keep their index order after them
+                rerank_start = time.perf_counter()
+                reranked = itm_rerank(model, report, candidates[:args.rerank_k], corpus.img_data)
+                candidates = [c for c,_ in reranked] + candidates[args.rerank_k:]
+                rerank_latency.record(time.perf_counter()-rerank_start)
+            candidates = candidates[:args.retrieve_k]
+            total_latency.record(time.perf_counter()-start)
+
+            if i == 0:
+                print(f"\nQuery {batch['img']['id'][0]}: {report}\nTop {args.retrieve_k}: {candidates}\n")
+
+    print(f"\nLatency over {len(queries)} queries ({torch.get_num_threads()} threads, "
+          f"{index.index_type} index of {len(index)}):")
+    for name, stats in [('encode', encode_latency), ('search', index.latency),
+                        ('ITM re-rank', rerank_latency), ('total', total_latency)]:
+        summary = stats.summary()
+        if summary['count']:
+            print(f"    {name:<12} p50 {summary['p50_ms']:.2f} ms, p99 {summary['p99_ms']:.2f} ms")
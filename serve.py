@@ -0,0 +1,53 @@
+import os, json, sys, asyncio, base64
+
+from src.parameters import parse_args
+from src.utils import load_paths_dict
+
+
+# Serve a fine tuned classifier:
+#   python serve.py --load_cp_path [pl_framework checkpoint] --max_batch_size 32 --max_wait_ms 5
+# Benchmark it with the local load generator (samples from the --test split):
+#   python serve.py --loadgen True --bench_requests 2000 --bench_concurrency 64 --topk 256
+if __name__=='__main__':
+
+    args = parse_args(stage='serve')
+    path_dict = load_paths_dict()
+
+    if args.loadgen:
+        from src.data import MimicDataset
+        from src.serving import load_generator
+
+        test_txt_path = os.path.join(path_dict[args.test+'_root'], path_dict[args.test+'_txt'])
+        test_img_path = os.path.join(path_dict[args.test+'_root'], path_dict[args.test+'_test'])
+        dset = MimicDataset(test_txt_path, test_img_path, topk=args.topk or 256)
+
+        requests = []
+        for idx in range(len(dset)):
+            sample = dset[idx]
+            requests.append({'id': str(sample['img']['id']),
+                             'report': sample['txt']['raw'],
+                             'features': base64.b64encode(sample['img']['features'].tobytes()).decode(),
+                             'boxes': base64.b64encode(sample['img']['boxes'].tobytes()).decode()})
+
+        print(f"Sending {args.bench_requests} requests with concurrency {args.bench_concurrency}")
+        results = asyncio.run(load_generator(requests,
+                                             num_requests=args.bench_requests,
+                                             concurrency=args.bench_concurrency,
+                                             host=args.host, port=args.port, socket=args.socket))
+        print(json.dumps(results, indent=2))
+        sys.exit(0)
+
+    from src.inference import load_classifier
+    from src.serving import ClassifierWorker, MicroBatcher, InferenceServer
+
+    # Needed if using TokenizerFast:
+    os.environ["TOKENIZERS_PARALLELISM"] = "true"
+
+    model = load_classifier(args)
+    batcher = MicroBatcher(ClassifierWorker(model),
+                           max_batch_size=args.max_batch_size,
+                           max_wait_ms=args.max_wait_ms)
+    server = InferenceServer(batcher, ft_dim=model.visual_features_dim)
+
+    print(f"Micro-batching with max batch size {args.max_batch_size}, max wait {args.max_wait_ms}ms")
+    asyncio.run(server.serve(host=args.host, port=args.port, socket=args.socket))
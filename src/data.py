@@ -8,6 +8,15 @@ import pandas as pd
 
 from src.utils import load_tsv
 
+# Chexpert labels as processed by preproc/stratified_split.ipynb
+MIMIC_LABELSET = ['Atelectasis', 'Cardiomegaly', 'Consolidation',
+                  'Edema', 'Enlarged Cardiomediastinum', 'Fracture',
+                  'Lung Lesion', 'Lung Opacity',
+                  'Pleural Effusion', 'Pleural Other', 'Pneumonia',
+                  'Pneumothorax', 'Support Devices']
+# Open-I labels present in both datasets
+OPENI_LABELSET = ['Atelectasis','Cardiomegaly', 'Consolidation', 
+                  'Edema', 'Pneumonia', 'Pneumothorax', 'Pleural Effusion']
 
 class MMRadDM(pl.LightningDataModule):
     def __init__(self, args, path_dict, dataset=None):
@@ -31,6 +40,9 @@ class MMRadDM(pl.LightningDataModule):
         self.test_img_path = os.path.join(self.pd[test_ds+'_root'],self.pd[test_ds+'_test'])
 
         self.train_ds, self.test_ds = train_ds, test_ds
+        # Detector class probabilities are only kept in memory if needed
+        self.load_cls_probs = ('mrc' in self.hparams.tasks) or \
+            (self.hparams.num_regions > 0 and self.hparams.region_score == 'conf')
 
         
 
@@ -39,12 +51,14 @@ class MMRadDM(pl.LightningDataModule):
         pass
 
     def setup(self, stage=None):
-        # Called on every GPU
-        self.test_size = 0  
+        # Called on every GPU. Each split is loaded once, so the DataModule
+        # can be shared by several runs (finetune.py sweeps)
+        if not hasattr(self, 'test_dset'):
+            self.test_size = 0  
 
 
         
-        if stage=='fit' or stage is None:
+        if (stage=='fit' or stage is None) and not hasattr(self, 'valid_dset'):
             
             if self.hparams.train=='mscoco':
                 # Temporary/quick:
@@ -57,14 +71,16 @@ class MMRadDM(pl.LightningDataModule):
                 mimic_data = MimicDataset(self.train_txt_path, self.train_img_path,
                                             topk=self.hparams.topk,
                                             binary_task=self.hparams.easy_classification,
-                                            useOpenILabels=(self.test_ds=='openI'))
+                                            useOpenILabels=(self.test_ds=='openI'),
+                                            load_cls_probs=self.load_cls_probs)
                 
 
                 if self.hparams.use_val_split:
                     # self.train_dset = mimic_data
                     self.valid_dset = MimicDataset(self.train_txt_path, self.val_img_path,
                                             topk=self.hparams.val_topk,
-                                            binary_task=self.hparams.easy_classification)
+                                            binary_task=self.hparams.easy_classification,
+                                            load_cls_probs=self.load_cls_probs)
                 
                 else:
                     split_ratio=0.98
@@ -81,13 +97,14 @@ class MMRadDM(pl.LightningDataModule):
             print(f"Size of train / val / test splits: {self.train_size} / {self.valid_size} / {self.test_size}")
         
 
-        if stage=='test' or stage is None:
+        if (stage=='test' or stage is None) and not hasattr(self, 'test_dset'):
              
             Dset = MimicDataset if self.hparams.test=='mimic' else OpenIDataset
 
             print(f"Loading test data from {self.test_img_path}")
             self.test_dset = Dset(self.test_txt_path, self.test_img_path,
-                                    binary_task=self.hparams.easy_classification)
+                                    binary_task=self.hparams.easy_classification,
+                                    load_cls_probs=self.load_cls_probs)
             self.test_size = len(self.test_dset)
             self.labelset = self.test_dset.labelset
             print(f"Finished loading.. Size of test set: {self.test_size}")
@@ -138,15 +155,15 @@ class OpenIDataset(Dataset):
     and labels. For evaluation purpose only.
     Processed (frontal) images and labels from https://github.com/YIKUAN8/Transformers-VQA"""
 
-    def __init__(self, txt_path, img_path, binary_task=False):
+    def __init__(self, txt_path, img_path, binary_task=False, load_cls_probs=False):
         super().__init__()
         self.binary_task = binary_task
-        self.img_data = load_tsv(img_path, topk=0)
+        self.load_cls_probs = load_cls_probs
+        self.img_data = load_tsv(img_path, topk=0, load_cls_probs=load_cls_probs)
         self.txt_data = pd.read_csv(txt_path)
         
         # Labelset is different to MIMIC, filter to those present in both.
-        self.labelset = ['Atelectasis','Cardiomegaly', 'Consolidation', 
-                         'Edema', 'Pneumonia', 'Pneumothorax', 'Pleural Effusion']
+        self.labelset = OPENI_LABELSET
         if self.binary_task:
             # TODO: Use txt_data above not separate file
             self.label_data = (self.label_data.sum(axis=1)>0).astype(int)
@@ -172,30 +189,24 @@ class OpenIDataset(Dataset):
                           },
                   'label': np.asarray(selected[self.labelset].astype(float))
                  }
+        if self.load_cls_probs:
+            sample['img']['cls_probs'] = img_data['cls_probs']
         return sample
 
 class MimicDataset(Dataset):
     """Mimic-cxr dataset with extracted visual features,
     captions (from impressions), ID, view, ..."""
     def __init__(self, txt_path, img_path, 
-                 topk=0, binary_task=False, useOpenILabels=False):
+                 topk=0, binary_task=False, useOpenILabels=False, load_cls_probs=False):
         super().__init__()
         self.binary_task = binary_task
+        self.load_cls_probs = load_cls_probs
         
-        self.img_data = load_tsv(img_path, topk=topk)
+        self.img_data = load_tsv(img_path, topk=topk, load_cls_probs=load_cls_probs)
         self.txt_data = pd.read_csv(txt_path)
         
 
-        if useOpenILabels:
-            self.labelset = ['Atelectasis','Cardiomegaly', 'Consolidation', 
-                         'Edema', 'Pneumonia', 'Pneumothorax', 
-                         'Pleural Effusion']
-        else:
-            self.labelset = ['Atelectasis', 'Cardiomegaly', 'Consolidation',
-                         'Edema', 'Enlarged Cardiomediastinum', 'Fracture',
-                         'Lung Lesion', 'Lung Opacity',
-                         'Pleural Effusion', 'Pleural Other', 'Pneumonia',
-                         'Pneumothorax', 'Support Devices']
+        self.labelset = OPENI_LABELSET if useOpenILabels else MIMIC_LABELSET
 
         self.txt_data = self.txt_data[self.txt_data['dicom_id'].isin(self.img_data.keys())]
         self.txt_data.reset_index(inplace=True)
@@ -227,10 +238,11 @@ class MimicDataset(Dataset):
                           'num_boxes' : img_data['num_boxes'], 
                           'img_h' : img_data['img_h'],
                           'img_w' : img_data['img_w'],
-                        #   'cls_probs' : img_data['cls_probs']
                           },
                   'label': np.asarray(selected[self.labelset].astype(float))#self.label_data.iloc[idx]
                  }
+        if self.load_cls_probs:
+            sample['img']['cls_probs'] = img_data['cls_probs']
         return sample
 
 class CocoDataset(Dataset):
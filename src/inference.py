@@ -0,0 +1,263 @@
+import io, time, inspect, contextlib
+import numpy as np
+import torch, torchmetrics
+from torch import nn
+
+from src.model import MMRadForClassification
+from src.data import MIMIC_LABELSET, OPENI_LABELSET
+
+
+def load_classifier(args, labelset=None):
+    """Build a MMRadForClassification for inference (eval mode, on the available device)
+
+    Args:
+        args (namespace): see parameters.py. The fine tuned PL checkpoint is loaded from
+            args.load_cp_path, otherwise only the encoder in args.load_model is loaded
+            (cls head is randomly initialised).
+        labelset (list, optional): ordered label names. Defaults to the labels of args.test
+
+    Returns:
+        (MMRadForClassification)
+    """
+    if labelset is None:
+        labelset = OPENI_LABELSET if args.test=='openI' else MIMIC_LABELSET
+    n_classes = 1 if args.easy_classification else len(labelset)
+
+    if args.load_cp_path is None:
+        print("Warning: no --load_cp_path given, classification head is untrained")
+        model = MMRadForClassification(args=args, train_size=0, n_classes=n_classes, labelset=labelset)
+    else:
+        print(f'Loading saved checkpoint from {args.load_cp_path}')
+        model = MMRadForClassification.load_from_checkpoint(
+            args.load_cp_path,
+            args=args,
+            train_size=0,
+            n_classes=n_classes,
+            labelset=labelset
+            )
+    model.eval()
+    model.to(torch.device('cuda' if torch.cuda.is_available() else 'cpu'))
+    return model
+
+
+class LatencyStats:
+    """Rolling window of latencies (seconds) with percentile summaries in ms"""
+    def __init__(self, window=10000):
+        self.window = window
+        self.latencies = []
+        self.count = 0
+
+    def record(self, latency):
+        self.latencies.append(latency)
+        self.count += 1
+        if len(self.latencies) > self.window:
+            self.latencies = self.latencies[-self.window:]
+
+    def summary(self):
+        if not self.latencies:
+            return {'count':self.count, 'p50_ms':None, 'p99_ms':None, 'mean_ms':None}
+        lat_ms = 1000*np.asarray(self.latencies)
+        return {'count':self.count,
+                'p50_ms':float(np.percentile(lat_ms, 50)),
+                'p99_ms':float(np.percentile(lat_ms, 99)),
+                'mean_ms':float(lat_ms.mean())}
+
+
+
+class ClassifierGraph(nn.Module):
+    """The tensor part of MMRadForClassification (visual projections, encoder and cls head)
+    as a plain nn.Module, i.e. without the tokenizer, PL trainer state or logging.
+    forward(input_ids, attention_mask, img_ft, img_box) -> logits (or sigmoid probabilities)
+    """
+    def __init__(self, model, output_probs=False):
+        super().__init__()
+        self.transform_img_ft = model.transform_img_ft
+        self.transform_img_box = model.transform_img_box
+        self.encoder = model.model
+        self.cls = model.cls
+        self.labelset = model.labelset
+        self.output_probs = output_probs
+
+    def forward(self, input_ids, attention_mask, img_ft, img_box):
+        # As MMRad.vis_pos_embeds
+        visual_embeds = torch.div(torch.add(self.transform_img_ft(img_ft), self.transform_img_box(img_box)), 2)
+        visual_attention_mask = torch.ones(visual_embeds.shape[:2], dtype=attention_mask.dtype,
+                                           device=visual_embeds.device)
+        outputs = self.encoder(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            visual_embeds=visual_embeds,
+            visual_attention_mask=visual_attention_mask,
+            return_dict=False,
+        )
+        logits = self.cls(outputs[1])
+        return torch.sigmoid(logits) if self.output_probs else logits
+
+
+def quantize_classifier(model):
+    """Dynamic int8 quantization (weights int8, activations quantized on the fly) of every
+    nn.Linear in the encoder, the visual projections and the cls head. CPU only.
+
+    Args:
+        model (MMRadForClassification)
+
+    Returns:
+        (ClassifierGraph): quantized copy, the fp32 model is left untouched
+    """
+    graph = ClassifierGraph(model).cpu().eval()
+    return torch.quantization.quantize_dynamic(graph, {nn.Linear}, dtype=torch.qint8, inplace=False)
+
+
+def save_quantized(graph, path):
+    """Pickles the whole quantized module so it can be reloaded with load_quantized
+    without building (or downloading) the fp32 model first"""
+    torch.save(graph, path)
+    print(f"Quantized classifier saved to {path}")
+
+
+def load_quantized(path):
+    # A full module (not a state_dict) needs weights_only=False on newer torch
+    kwargs = {'weights_only':False} if 'weights_only' in inspect.signature(torch.load).parameters else {}
+    return torch.load(path, map_location='cpu', **kwargs).eval()
+
+
+EXPORT_INPUT_NAMES = ['input_ids', 'attention_mask', 'img_ft', 'img_box']
+EXPORT_DYNAMIC_AXES = {'input_ids':{0:'batch', 1:'seq_len'},
+                       'attention_mask':{0:'batch', 1:'seq_len'},
+                       'img_ft':{0:'batch', 1:'num_boxes'},
+                       'img_box':{0:'batch', 1:'num_boxes'},
+                       'probs':{0:'batch'}}
+
+
+def example_inputs(batch_size=2, seq_len=16, num_boxes=36, ft_dim=1024, vocab_size=30522):
+    """Random (input_ids, attention_mask, img_ft, img_box) used for tracing and parity checks"""
+    return (torch.randint(1000, vocab_size, (batch_size, seq_len)),
+            torch.ones((batch_size, seq_len), dtype=torch.long),
+            torch.rand((batch_size, num_boxes, ft_dim)),
+            torch.rand((batch_size, num_boxes, 4)))
+
+
+def export_torchscript(graph, path, inputs):
+    """Traces the graph (token ids, attention mask, features, boxes -> probabilities)
+    to a TorchScript file, loadable with torch.jit.load only.
+    Batch, sequence and box dims stay dynamic as the encoder only uses traced tensor sizes."""
+    with torch.no_grad():
+        traced = torch.jit.trace(graph.eval(), inputs)
+    torch.jit.save(traced, path)
+    print(f"TorchScript graph saved to {path}")
+    return traced
+
+
+def export_onnx(graph, path, inputs, opset_version=13):
+    """Exports the graph to ONNX with dynamic batch/sequence/box axes"""
+    with torch.no_grad():
+        torch.onnx.export(
+            graph.eval(), inputs, path,
+            input_names=EXPORT_INPUT_NAMES,
+            output_names=['probs'],
+            dynamic_axes=EXPORT_DYNAMIC_AXES,
+            opset_version=opset_version,
+            do_constant_folding=True,
+        )
+    print(f"ONNX graph saved to {path}")
+
+
+def check_parity(reference, exported, shapes, atol=1e-4, **input_kwargs):
+    """Compares reference and exported graphs on random inputs of several
+    (batch_size, seq_len) shapes, including ones not seen at trace time.
+
+    Returns:
+        (float): the max abs difference across all shapes
+    """
+    max_diff = 0.
+    with torch.no_grad():
+        for batch_size, seq_len in shapes:
+            inputs = example_inputs(batch_size, seq_len, **input_kwargs)
+            diff = (reference(*inputs) - torch.as_tensor(exported(*inputs))).abs().max().item()
+            print(f"Parity (batch {batch_size}, seq len {seq_len}): max abs diff {diff:.2e}")
+            max_diff = max(max_diff, diff)
+    assert max_diff <= atol, f"Exported graph differs from the reference by {max_diff:.2e} > {atol}"
+    return max_diff
+
+
+def module_size_mb(module):
+    """Serialized size of the module's state_dict in MB"""
+    buffer = io.BytesIO()
+    torch.save(module.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / 1e6
+
+
+def autocast(precision, device='cpu'):
+    """bf16 autocast context if precision is 'bf16' (as pl.Trainer --precision), else a no-op"""
+    if str(precision) == 'bf16':
+        if not hasattr(torch, 'autocast'):
+            raise RuntimeError(f"bf16 autocast needs torch>=1.10, found {torch.__version__}")
+        return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def predict_dataloader(forward, loader, pp, device='cpu', precision=32):
+    """Runs forward(input_ids, attention_mask, img_ft, img_box) -> logits over a
+    (test) dataloader, tokenising with the PretextProcessor pp. With precision 'bf16'
+    forward runs under bf16 autocast.
+
+    Returns:
+        (torch.Tensor, torch.Tensor): sigmoid predictions and labels, (num_samples, n_classes)
+    """
+    preds, labels = [], []
+    with torch.no_grad():
+        for batch in loader:
+            batch = pp.tokenize_pad_vectorize(batch)
+            with autocast(precision, device):
+                logits = forward(batch['txt']['input_ids'].to(device),
+                                 batch['txt']['att_mask'].to(device),
+                                 batch['img']['features'].to(device),
+                                 batch['img']['boxes'].to(device))
+            preds.append(torch.sigmoid(logits).float().cpu())
+            labels.append(batch['label'].cpu())
+    return torch.cat(preds), torch.cat(labels)
+
+
+def test_predictions(model, loader):
+    """Sigmoid predictions of a MMRadForClassification over a (test) dataloader, via its
+    test shared_step (so hparams.test_on applies), without a Trainer.
+
+    Returns:
+        (torch.Tensor, torch.Tensor): predictions and labels, (num_samples, n_classes)
+    """
+    model.eval()
+    preds, labels = [], []
+    with torch.inference_mode():
+        for batch_idx, batch in enumerate(loader):
+            batch['label'] = batch['label'].to(model.device)
+            for key in ['features', 'boxes', 'cls_probs']:
+                if key in batch['img']:
+                    batch['img'][key] = batch['img'][key].to(model.device)
+            preds.append(model.shared_step(batch, batch_idx, stage='test')['preds'].cpu())
+            labels.append(batch['label'].cpu())
+    return torch.cat(preds), torch.cat(labels)
+
+
+def auroc_scores(preds, labels):
+    """Per label and macro average AUROC. As MetricsCallback, labels without
+    positive cases are skipped (left at 0) and excluded from the average.
+
+    Returns:
+        (torch.Tensor, float): (n_classes,) AUROC and the macro average
+    """
+    mask = torch.sum(labels, dim=0) > 0
+    result_auc = torch.zeros((labels.shape[1],))
+    auroc = torchmetrics.AUROC(num_classes=int(torch.sum(mask)), average=None)
+    result_auc[mask] = torch.as_tensor(auroc(preds[:,mask], labels[:,mask].type(torch.int))).float()
+    return result_auc, float(result_auc[mask].mean())
+
+
+def time_fn(fn, *inputs, repeats=20, warmup=3):
+    """Mean wall time (seconds) of fn(*inputs) over repeats, after warmup calls"""
+    with torch.no_grad():
+        for _ in range(warmup):
+            fn(*inputs)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            fn(*inputs)
+    return (time.perf_counter()-start)/repeats
@@ -0,0 +1,133 @@
+import torch
+from torch.utils.data import DataLoader, Subset
+
+
+def sample_batch(dataset, batch_size):
+    """Collates the first batch_size samples of dataset (repeated if it is smaller)"""
+    indices = [i % len(dataset) for i in range(batch_size)]
+    return next(iter(DataLoader(Subset(dataset, indices), batch_size=batch_size)))
+
+
+def training_step_memory(model, batch, task):
+    """Peak memory (bytes) of one training step of a pretraining task (forward + backward),
+       including the weights, gradients and AdamW states.
+
+       On GPU this is the allocator peak. On CPU it is estimated as the tensors saved
+       for backward (activations) plus 4x the trainable weights. Saved tensors are counted
+       with saved_tensors_hooks (torch>=1.10), otherwise approximated by the outputs of
+       every leaf module that take part in the backward pass (forward hooks).
+
+    Args:
+        model (MMRadForPretraining): in train mode, on the device to measure
+        batch (dict): collated batch (see sample_batch)
+        task (str): one of model.task_step
+
+    Returns:
+        (int): bytes
+    """
+    params = [p for p in model.parameters() if p.requires_grad]
+    param_bytes = sum(p.numel()*p.element_size() for p in params)
+    model.zero_grad(set_to_none=True)
+
+    if model.device.type == 'cuda':
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(model.device)
+        batch = model.pp.tokenize_pad_vectorize(batch, return_word_ids=(task=='oovm'))
+        model.task_step[task](batch, 0)['loss'].backward()
+        peak = torch.cuda.max_memory_allocated(model.device)
+        model.zero_grad(set_to_none=True)
+        # AdamW exp_avg / exp_avg_sq are allocated at the first optimiser step
+        return peak + 2*param_bytes
+
+    if not hasattr(torch.autograd, 'graph'):
+        return output_activation_bytes(model, batch, task) + 4*param_bytes
+
+    param_ptrs = {p.data_ptr() for p in model.parameters()}
+    saved = {}
+    def pack(tensor):
+        if tensor.data_ptr() not in param_ptrs:
+            saved[tensor.data_ptr()] = tensor.numel()*tensor.element_size()
+        return tensor
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        batch = model.pp.tokenize_pad_vectorize(batch, return_word_ids=(task=='oovm'))
+        loss = model.task_step[task](batch, 0)['loss']
+    loss.backward()
+    model.zero_grad(set_to_none=True)
+    return sum(saved.values()) + 4*param_bytes
+
+
+def tensor_bytes(output):
+    """Bytes of the tensors (in nested tuples / lists / dicts) that require grad"""
+    if torch.is_tensor(output):
+        return output.numel()*output.element_size() if output.requires_grad else 0
+    if isinstance(output, (tuple, list)):
+        return sum(tensor_bytes(o) for o in output)
+    if isinstance(output, dict):
+        return sum(tensor_bytes(o) for o in output.values())
+    return 0
+
+
+def output_activation_bytes(model, batch, task):
+    """Activations of one training step (CPU, torch<1.10): the summed output sizes of
+       every leaf module (nn.Linear, LayerNorm, dropout, ...) that require grad
+    """
+    sizes = []
+    hooks = [module.register_forward_hook(lambda module, inputs, output: sizes.append(tensor_bytes(output)))
+             for module in model.modules() if not list(module.children())]
+    try:
+        batch = model.pp.tokenize_pad_vectorize(batch, return_word_ids=(task=='oovm'))
+        loss = model.task_step[task](batch, 0)['loss']
+    finally:
+        for hook in hooks:
+            hook.remove()
+    loss.backward()
+    model.zero_grad(set_to_none=True)
+    return sum(sizes)
+
+
+def find_batch_size(model, dataset, tasks, budget_gb, max_batch_size=4096):
+    """Largest batch size whose training step fits in budget_gb for every task in tasks
+       (training_step samples any of them). Doubles the batch size until it no longer
+       fits, then binary searches between the last two sizes.
+
+    Args:
+        model (MMRadForPretraining): model to probe (moved to GPU if available, then back)
+        dataset (Dataset): training dataset, batches are built from its first samples
+        tasks (list): pretraining tasks, e.g. ['mlm', 'itm']
+        budget_gb (float): memory budget
+        max_batch_size (int, optional): upper bound of the search
+
+    Returns:
+        (int, dict): batch size and the peak memory (GB) measured per probed batch size
+    """
+    device = model.device
+    was_training = model.training
+    model.to('cuda' if torch.cuda.is_available() else 'cpu').train()
+    probed = {}
+
+    def fits(batch_size):
+        try:
+            peak = max(training_step_memory(model, sample_batch(dataset, batch_size), task) for task in tasks)
+        except RuntimeError as e:
+            if 'out of memory' not in str(e):
+                raise
+            model.zero_grad(set_to_none=True)
+            torch.cuda.empty_cache()
+            peak = float('inf')
+        probed[batch_size] = peak/1024**3
+        print(f"Batch size {batch_size}: {probed[batch_size]:.2f} GB")
+        return probed[batch_size] <= budget_gb
+
+    low, high = 0, 1
+    while high <= max_batch_size and fits(high):
+        low, high = high, high*2
+    high = min(high, max_batch_size+1)
+    while high - low > 1:
+        mid = (low + high) // 2
+        low, high = (mid, high) if fits(mid) else (low, mid)
+
+    model.to(device).train(was_training)
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    assert low > 0, f"A batch of 1 does not fit in {budget_gb} GB"
+    return low, probed
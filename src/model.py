@@ -1,4 +1,4 @@
-import os, random
+import os, random, copy
 import torch
 from torch import nn
 from torch.nn import functional as F
@@ -17,6 +17,69 @@ from transformers.models.visual_bert.modeling_visual_bert import VisualBertLMPre
 
 from src.tasks import PretextProcessor
 
+# Tokenizers loaded in this process, shared by every model built in it (e.g. finetune.py sweeps)
+_tokenizers = {}
+
+def load_tokenizer(tok):
+    """Load (once per process) a fast tokenizer, from the local copy in ./huggingface/
+    if there is one, otherwise downloaded and saved there.
+
+    Args:
+        tok (str): either path to local tokeniser or 
+        HF compatible model e.g. 'bert-base-uncased'
+    """
+    if tok not in _tokenizers:
+        if not os.path.exists('./huggingface/'+tok+'/'):
+            # Local copy for the next runs
+            BertTokenizerFast.from_pretrained(tok, do_lower_case=True).save_pretrained('./huggingface/'+tok)
+        else:
+            print("Local Tokenizer exists")
+        # Always loaded from the local copy, so name_or_path is the same in every process
+        _tokenizers[tok] = BertTokenizerFast.from_pretrained(
+            './huggingface/'+tok+'/',
+            do_lower_case=True
+        )
+    return _tokenizers[tok]
+
+class TracedForward:
+    """torch<2.0 stand-in for torch.compile, set as module.forward: the module is traced
+    (torch.jit.trace) on its first call and the TorchScript graph runs the next calls.
+    Tensor arguments are the graph inputs; the other arguments (None, bool, ...) and the
+    train/eval mode are baked into the graph, so there is one graph per combination.
+    Traced graphs share the module's parameters, so training and state_dict are unchanged.
+    """
+    def __init__(self, module):
+        self.module = module
+        self.eager_forward = module.forward
+        self.graphs = {}
+
+    def __call__(self, *args, **kwargs):
+        names = list(kwargs)
+        values = list(args) + [kwargs[k] for k in names]
+        is_input = [isinstance(v, torch.Tensor) for v in values]
+        key = (self.module.training, tuple(names),
+               tuple('tensor' if t else repr(v) for v, t in zip(values, is_input)))
+        inputs = tuple(v for v, t in zip(values, is_input) if t)
+        if key not in self.graphs:
+            graph = _BoundForward(self.module, self.eager_forward, values, is_input, len(args), names)
+            self.graphs[key] = torch.jit.trace(graph.train(self.module.training), inputs, check_trace=False)
+        return self.graphs[key](*inputs)
+
+class _BoundForward(nn.Module):
+    """forward(*tensors) of a module, with the non tensor arguments of a call fixed"""
+    def __init__(self, module, forward, values, is_input, num_args, names):
+        super().__init__()
+        self.module = module
+        self.eager_forward = forward
+        self.constants = [None if t else v for v, t in zip(values, is_input)]
+        self.is_input = is_input
+        self.num_args, self.names = num_args, names
+
+    def forward(self, *tensors):
+        tensors = iter(tensors)
+        values = [next(tensors) if t else v for v, t in zip(self.constants, self.is_input)]
+        return self.eager_forward(*values[:self.num_args], **dict(zip(self.names, values[self.num_args:])))
+
 class MLPWithLayerNorm(nn.Module):
     # Taken from SpanBERT / Fairseq
     def __init__(self, config, input_size):
@@ -76,6 +139,9 @@ class MMRad(pl.LightningModule):
        relevant linear heads and visual input transforms,
        and setup the optimiser with scheduler (wadam with LR scheduler by default)
     """
+    # Modules run in forward / shared_step, compiled with hparams.compile
+    compile_targets = ('model', 'transform_img_ft', 'transform_img_box')
+
   
     def __init__(self, args, train_size, tokenizer='bert-base-uncased'):
         """
@@ -106,8 +172,18 @@ class MMRad(pl.LightningModule):
         else:
             model_path = self.hparams.load_model
             print(f"Loading transformer encoder from {model_path}\n")
+            # Encoders saved by prune.py have fewer heads / FFN neurons than args describe
+            if os.path.isfile(os.path.join(model_path, 'config.json')):
+                saved_config = VisualBertConfig.from_pretrained(model_path)
+                self.config.pruned_heads = saved_config.pruned_heads
+                self.config.intermediate_size = saved_config.intermediate_size
             self.model = VisualBertModel(self.config).from_pretrained(model_path, config=self.config)
 
+        if self.hparams.grad_checkpointing:
+            # Recompute layer activations in the backward pass (all forward passes through self.model)
+            print("Gradient checkpointing encoder layers..")
+            self.model.gradient_checkpointing_enable()
+
         if self.hparams.freeze:
             print("Freezing encoder layers..")
             for param in self.model.parameters():
@@ -151,6 +227,76 @@ class MMRad(pl.LightningModule):
         embed_pos = self.transform_img_box(img_box)
         return torch.div(torch.add(embed_ft, embed_pos), 2)
     
+    def select_regions(self, img_ft, img_box, cls_probs=None):
+        """Keeps the hparams.num_regions most salient regions of each study, in front of
+           vis_pos_embeds. Saliency is the detector confidence (max class prob in cls_probs)
+           or, with region_score 'norm' / no cls_probs, the feature L2 norm.
+           With hparams.region_threshold > 0, k is adaptive per study: regions scoring below
+           the threshold are masked (keeping at least min_regions) and the batch is trimmed
+           to the largest number of regions kept by any study.
+
+        Args:
+            img_ft (torch.Tensor): (batch_size, num_boxes, extracted_ft_dim)
+            img_box (torch.Tensor): (batch_size, num_boxes, 4)
+            cls_probs (torch.Tensor, optional): (batch_size, num_boxes, num_classes)
+
+        Returns:
+            (torch.Tensor, torch.Tensor, torch.Tensor): selected features, boxes and
+            the visual attention mask, sorted by descending saliency
+        """
+        k = min(self.hparams.num_regions, img_ft.shape[1])
+        if self.hparams.region_score == 'conf' and cls_probs is not None:
+            scores = cls_probs.max(dim=-1).values
+        else:
+            scores = img_ft.norm(dim=-1)
+
+        scores, order = scores.topk(k, dim=1)
+        img_ft = torch.gather(img_ft, 1, order.unsqueeze(-1).expand(-1, -1, img_ft.shape[-1]))
+        img_box = torch.gather(img_box, 1, order.unsqueeze(-1).expand(-1, -1, img_box.shape[-1]))
+        visual_attention_mask = torch.ones_like(scores)
+
+        if self.hparams.region_threshold > 0:
+            keep = scores >= self.hparams.region_threshold
+            keep[:, :self.hparams.min_regions] = True
+            # Sorted, so kept regions are a prefix of each row
+            k = int(keep.sum(dim=1).max())
+            img_ft, img_box = img_ft[:, :k], img_box[:, :k]
+            visual_attention_mask = keep[:, :k].type_as(scores)
+        return img_ft, img_box, visual_attention_mask
+
+    def compile_modules(self):
+        """Opt-in (hparams.compile) graph capture of the encoder, input transforms and heads
+           (compile_targets) with torch.compile. Modules are compiled in place, so state_dict
+           keys (checkpoints) are unchanged. Text is padded to max_seq_len and the number of
+           regions is fixed, so the encoder sees one input shape per batch size. Other children
+           (e.g. exit heads, a distillation teacher) stay eager.
+
+           On torch<2.0 (no torch.compile) the transformer layers of the encoder and the other
+           targets are traced with torch.jit.trace instead (TracedForward); the HF embeddings and
+           attention mask code around the layers stay eager.
+        """
+        if not hasattr(torch, 'compile'):
+            print("torch.compile requires torch>=2.0, tracing encoder layers and heads with torch.jit.trace..")
+            for name in self.compile_targets:
+                module = getattr(self, name, None)
+                if module is None:
+                    continue
+                # The encoder takes keyword / optional arguments and returns a ModelOutput,
+                # its layers take tensors (and None / bool flags) and return tuples
+                for traced in (module.encoder.layer if name == 'model' else [module]):
+                    traced.forward = TracedForward(traced)
+            return
+        print("Compiling encoder and heads..")
+        for name in self.compile_targets:
+            module = getattr(self, name, None)
+            if module is None:
+                continue
+            if hasattr(module, 'compile'):
+                module.compile()
+            else:
+                # torch<2.2: no nn.Module.compile
+                module.forward = torch.compile(module.forward)
+
     def _init_tokenizer(self, tok):
         """Load the tokenizer
 
@@ -158,16 +304,7 @@ class MMRad(pl.LightningModule):
             tok (str): either path to local tokeniser or 
             HF compatible model e.g. 'bert-base-uncased'
         """
-        if os.path.exists('./huggingface/'+tok+'/'):
-            tok_path = './huggingface/'+tok+'/'
-            print("Local Tokenizer exists")
-        else:
-            tok_path = tok
-        self.tokenizer = BertTokenizerFast.from_pretrained(
-            tok_path,
-            do_lower_case=True
-        )
-        self.tokenizer.save_pretrained('./huggingface/'+tok_path)
+        self.tokenizer = load_tokenizer(tok)
         print(f"Using tokenizer: {self.hparams.tokenizer}")
 
     def init_weights(self, module):
@@ -201,7 +338,8 @@ class MMRad(pl.LightningModule):
         total_epochs = self.hparams.epochs
 
         # optimizer = AdamW(self.model.parameters(), lr=self.hparams.lr)
-        optimizer = AdamW(self.parameters(), 
+        # Frozen parameters (e.g. a distillation teacher) are left out
+        optimizer = AdamW([p for p in self.parameters() if p.requires_grad], 
                           lr=self.hparams.lr, 
                           weight_decay=self.hparams.weight_decay)
 
@@ -227,6 +365,9 @@ class MMRadForPretraining(MMRad):
        Contains methods to make predictions on specified SSL pretext tasks (e.g. MLM, MFR)
        and logs results to logger (e.g. wandb)
     """
+    compile_targets = MMRad.compile_targets + ('text_prediction_head', 'seq_relationship_head',
+                                              'patch_relationship_head', 'image_mfr_head',
+                                              'image_mrc_head', 'span_head')
     def __init__(self, args, train_size, tokenizer='bert-base-uncased'):
         super().__init__(args, train_size, tokenizer=tokenizer)
 
@@ -235,6 +376,8 @@ class MMRadForPretraining(MMRad):
                           'pc':self.pc_step, 'mrc':self.mrc_step}
         self.hparams.tasks = self.hparams.tasks.split(',')
         self.__init_pretraining_heads()
+        if self.hparams.compile:
+            self.compile_modules()
 
 
     def __init_pretraining_heads(self):
@@ -271,6 +414,32 @@ class MMRadForPretraining(MMRad):
 
             head.apply(self.init_weights)
 
+    def encode(self, batch, input_ids=None):
+        """Encoder forward pass shared by the pretext task steps
+
+        Args:
+            batch (dict): batch after img_vectorize
+            input_ids (torch.Tensor, optional): e.g. masked input ids. Defaults to batch['txt']['input_ids']
+
+        Returns:
+            (BaseModelOutputWithPooling): sequence_output, pooled_output = outputs[:2]
+        """
+        return self(
+            input_ids=batch['txt']['input_ids'] if input_ids is None else input_ids,
+            attention_mask=batch['txt']['att_mask'],
+            # token_type_ids=batch['txt']['type_ids'],    # Let model auto-compute
+            # position_ids=batch['txt']['pos_ids'],       # let model auto (use absolute pos)
+            head_mask=None,
+            inputs_embeds=None,
+            visual_embeds=batch['img']['visual_embeds'],
+            visual_attention_mask=batch['img']['att_mask'],
+            visual_token_type_ids=None,
+            image_text_alignment=None,
+            output_attentions=False,
+            output_hidden_states=False,
+            return_dict=True,
+        )
+
     def mlm_step(self, batch, batch_idx):
         # called mlm as per literature but is token masking
         batch = self.pp.mask_token(batch)
@@ -295,7 +464,8 @@ class MMRadForPretraining(MMRad):
                                                 dim=1)
         
         # logits: (bs * num_pairs, max_targets, dim)
-        text_logits = self.span_head(txt_sequence,pairs)
+        # Losses are computed in fp32 (bf16 autocast)
+        text_logits = self.span_head(txt_sequence,pairs).float()
         txt_labels = batch['txt']['masked_labels']
         # Need labels to be bs*num_pairs, e.g. each elem in batch is a span.
 
@@ -326,21 +496,7 @@ class MMRadForPretraining(MMRad):
         #Dummy visual labels (ignored in loss)
         img_labels = torch.full((txt_labels.size()[0],36),-100, device=self.device)
         
-        outputs = self(
-            input_ids=batch['txt']['masked_input_ids'],
-            attention_mask=batch['txt']['att_mask'],
-            # token_type_ids=batch['txt']['type_ids'],    # Let model auto-compute
-            # position_ids=batch['txt']['pos_ids'],       # let model auto (use absolute pos)
-            head_mask=None,
-            inputs_embeds=None,
-            visual_embeds=batch['img']['visual_embeds'],
-            visual_attention_mask=batch['img']['att_mask'],
-            visual_token_type_ids=None,
-            image_text_alignment=None,
-            output_attentions=False,
-            output_hidden_states=False,
-            return_dict=True,
-        )
+        outputs = self.encode(batch, input_ids=batch['txt']['masked_input_ids'])
 
         sequence_output, pooled_output = outputs[:2]
 
@@ -349,7 +505,15 @@ class MMRadForPretraining(MMRad):
 
         txt_sequence, img_sequence = torch.split(sequence_output, [txt_labels.shape[1], img_labels.shape[1]], dim=1)
 
-        text_logits = self.text_prediction_head(txt_sequence)
+        # Vocab logits for the masked positions only (the rest are ignored by the loss).
+        # Compiled, the head runs on every position instead: the number of masked tokens
+        # changes every batch, the text length does not
+        masked = txt_labels != -100
+        if self.hparams.compile:
+            text_logits = self.text_prediction_head(txt_sequence)[masked].float()
+        else:
+            text_logits = self.text_prediction_head(txt_sequence[masked]).float()
+        txt_labels = txt_labels[masked]
 
         # text ouput only
         text_preds = text_logits[(txt_labels > 0), :].argmax(1)
@@ -372,21 +536,7 @@ class MMRadForPretraining(MMRad):
         label_mask = batch['img']['label_mask'] # filter to masked idx only
         img_labels = batch['img']['cls_probs']      
         
-        outputs = self(
-            input_ids=batch['txt']['input_ids'],
-            attention_mask=batch['txt']['att_mask'],
-            # token_type_ids=batch['txt']['type_ids'],    # Let model auto-compute
-            # position_ids=batch['txt']['pos_ids'],       # let model auto (use absolute pos)
-            head_mask=None,
-            inputs_embeds=None,
-            visual_embeds=batch['img']['visual_embeds'],
-            visual_attention_mask=batch['img']['att_mask'],
-            visual_token_type_ids=None,
-            image_text_alignment=None,
-            output_attentions=False,
-            output_hidden_states=False,
-            return_dict=True,
-        )
+        outputs = self.encode(batch)
         # Most code borrowed from HF visualbertforpretraining
         sequence_output, pooled_output = outputs[:2]
         txt_sequence, img_sequence = torch.split(
@@ -395,10 +545,11 @@ class MMRadForPretraining(MMRad):
             dim=1
             )
 
-        prediction_soft_label = self.image_mrc_head(img_sequence)
+        # KL in fp32 (bf16 autocast)
+        prediction_soft_label = self.image_mrc_head(img_sequence).float()
         prediction_soft_label = F.log_softmax(
                 prediction_soft_label, dim=-1)
-        loss = F.kl_div(prediction_soft_label[label_mask], img_labels[label_mask], reduction='mean',log_target=True)
+        loss = F.kl_div(prediction_soft_label[label_mask], img_labels[label_mask].float(), reduction='mean',log_target=True)
         return {'loss':loss}
 
     def mfr_step(self, batch, batch_idx):
@@ -415,27 +566,13 @@ class MMRadForPretraining(MMRad):
         # update labels with features that were masked
         img_labels = batch['img']['features']
 
-        outputs = self(
-            input_ids=batch['txt']['input_ids'],
-            attention_mask=batch['txt']['att_mask'],
-            # token_type_ids=batch['txt']['type_ids'],    # Let model auto-compute
-            # position_ids=batch['txt']['pos_ids'],       # let model auto (use absolute pos)
-            head_mask=None,
-            inputs_embeds=None,
-            visual_embeds=batch['img']['visual_embeds'],
-            visual_attention_mask=batch['img']['att_mask'],
-            visual_token_type_ids=None,
-            image_text_alignment=None,
-            output_attentions=False,
-            output_hidden_states=False,
-            return_dict=True,
-        )
+        outputs = self.encode(batch)
 
         # Most code borrowed from HF visualbertforpretraining
         sequence_output, pooled_output = outputs[:2]
         txt_sequence, img_sequence = torch.split(sequence_output, [txt_labels.shape[1], img_labels.shape[1]], dim=1)
 
-        img_projected = self.image_mfr_head(img_sequence)
+        img_projected = self.image_mfr_head(img_sequence).float()
         loss_fct = MSELoss()
         
         loss = loss_fct(img_projected[label_mask], img_labels[label_mask])
@@ -450,24 +587,10 @@ class MMRadForPretraining(MMRad):
         batch = self.pp.itm_sampling(batch)        
         batch = self.pp.img_vectorize(batch, model=self)     
         
-        outputs = self(
-            input_ids=batch['txt']['input_ids'],
-            attention_mask=batch['txt']['att_mask'],
-            # token_type_ids=batch['txt']['type_ids'],    # Let model auto-compute
-            # position_ids=batch['txt']['pos_ids'],       # let model auto (use absolute pos)
-            head_mask=None,
-            inputs_embeds=None,
-            visual_embeds=batch['img']['visual_embeds'],
-            visual_attention_mask=batch['img']['att_mask'],
-            visual_token_type_ids=None,
-            image_text_alignment=None,
-            output_attentions=False,
-            output_hidden_states=False,
-            return_dict=True,
-        )
+        outputs = self.encode(batch)
 
         sequence_output, pooled_output = outputs[:2]
-        seq_relationship_score = self.seq_relationship_head(pooled_output)
+        seq_relationship_score = self.seq_relationship_head(pooled_output).float()
         loss_fct = nn.CrossEntropyLoss()
         loss = loss_fct(seq_relationship_score.view(-1,2), batch['is_matched'].view(-1))
         acc = (batch['is_matched'].view(-1) == seq_relationship_score.argmax(1).view(-1)).type(torch.float).mean()*100
@@ -479,24 +602,10 @@ class MMRadForPretraining(MMRad):
         batch = self.pp.img_vectorize(batch, model=self)
         
         # Below is same as ITM step
-        outputs = self(
-            input_ids=batch['txt']['input_ids'],
-            attention_mask=batch['txt']['att_mask'],
-            # token_type_ids=batch['txt']['type_ids'],    # Let model auto-compute
-            # position_ids=batch['txt']['pos_ids'],       # let model auto (use absolute pos)
-            head_mask=None,
-            inputs_embeds=None,
-            visual_embeds=batch['img']['visual_embeds'],
-            visual_attention_mask=batch['img']['att_mask'],
-            visual_token_type_ids=None,
-            image_text_alignment=None,
-            output_attentions=False,
-            output_hidden_states=False,
-            return_dict=True,
-        )
+        outputs = self.encode(batch)
 
         sequence_output, pooled_output = outputs[:2]
-        seq_relationship_score = self.patch_relationship_head(pooled_output)
+        seq_relationship_score = self.patch_relationship_head(pooled_output).float()
         loss_fct = nn.CrossEntropyLoss()
         loss = loss_fct(seq_relationship_score.view(-1,4), batch['is_matched'].view(-1))
         acc = (batch['is_matched'].view(-1) == seq_relationship_score.argmax(1).view(-1)).type(torch.float).mean()*100
@@ -560,6 +669,7 @@ class MMRadForClassification(MMRad):
     Args:
         MMRad ([type]): [description]
     """
+    compile_targets = MMRad.compile_targets + ('cls',)
     def __init__(self, args, train_size, n_classes, labelset=None, n_hidden=512, 
                  tokenizer='bert-base-uncased'):
         """
@@ -587,6 +697,20 @@ class MMRadForClassification(MMRad):
         )
         self.cls.apply(self.init_weights)
 
+        # Early exit heads on the [CLS] state after each of hparams.exit_layers (1-indexed)
+        self.exit_layers = [int(l) for l in str(self.hparams.exit_layers).split(',') if l.strip()]
+        assert all(0 < l < self.config.num_hidden_layers for l in self.exit_layers), \
+            f"exit_layers must be in [1, {self.config.num_hidden_layers-1}]"
+        if self.exit_layers:
+            self.exit_heads = nn.ModuleDict({str(l): nn.Sequential(
+                nn.Linear(self.config.hidden_size, self.config.hidden_size),
+                nn.Tanh(),
+                nn.Linear(self.config.hidden_size, n_classes)
+                ) for l in self.exit_layers})
+            self.exit_heads.apply(self.init_weights)
+        if self.hparams.compile:
+            self.compile_modules()
+
         if self.hparams.tune_on=='image':
             print(f"Image only fine tuning- Setting text inputs to 0 / Masking")
         elif self.hparams.tune_on=='text':
@@ -635,10 +759,14 @@ class MMRadForClassification(MMRad):
         #   - visual_embeds
         #   - visual_attention_mask
         
-        num_features = batch['img']['num_boxes'][0]
+        img_ft, img_box = batch['img']['features'], batch['img']['boxes']
+        visual_attention_mask = torch.ones(img_ft.shape[:2], device=self.device)
+        if self.hparams.num_regions > 0:
+            img_ft, img_box, visual_attention_mask = self.select_regions(img_ft, img_box,
+                                                                         batch['img'].get('cls_probs'))
+        num_features = img_ft.shape[1]
         ## img input to tx dim and add positions
-        visual_embeds = self.vis_pos_embeds(img_ft=batch['img']['features'],
-                                            img_box=batch['img']['boxes'])
+        visual_embeds = self.vis_pos_embeds(img_ft=img_ft, img_box=img_box)
         
         # process txt
         # if self.hparams.img_only:
@@ -658,8 +786,6 @@ class MMRadForClassification(MMRad):
         if self.hparams.tune_on == 'text' or (stage=='test' and self.hparams.test_on=='text'):
             visual_attention_mask=torch.zeros((len(batch['img']['id']), num_features), device=self.device)
             visual_embeds = torch.zeros_like(visual_embeds, device=self.device)
-        else:
-            visual_attention_mask=torch.ones((len(batch['img']['id']), num_features), device=self.device)
 
         labels = batch['label']
 
@@ -675,7 +801,7 @@ class MMRadForClassification(MMRad):
             visual_token_type_ids=None,
             image_text_alignment=None,
             output_attentions=False,
-            output_hidden_states=False,
+            output_hidden_states=bool(self.exit_layers),
             return_dict=True,
         )
 
@@ -683,7 +809,8 @@ class MMRadForClassification(MMRad):
         # pooled_output.shape = (batch_size, 768)
         sequence_output, pooled_output = outputs[:2]
           
-        logits = self.cls(pooled_output)
+        # fp32 for the loss and metrics (bf16 autocast)
+        logits = self.cls(pooled_output).float()
         preds = nn.Sigmoid()(logits) 
         
         loss_fct = nn.BCEWithLogitsLoss()
@@ -697,4 +824,212 @@ class MMRadForClassification(MMRad):
             acc = ((preds > 0.5) == labels).type(torch.float).mean(dim=0)
 
         metrics = {'loss':loss, 'acc':acc, 'preds':preds}
-        return metrics
\ No newline at end of file
+
+        if self.exit_layers:
+            # Exit heads are trained jointly; hidden_states[l] is the output of layer l
+            exit_loss = sum(loss_fct(self.exit_heads[str(l)](outputs.hidden_states[l][:, 0]).float().view(logits.shape), labels)
+                            for l in self.exit_layers) / len(self.exit_layers)
+            metrics['loss'] = loss + self.hparams.exit_loss_weight*exit_loss
+            metrics['exit_loss'] = exit_loss
+        return metrics
+
+    @staticmethod
+    def exit_confident(probs, threshold, criterion='entropy'):
+        """Per sample early exit decision from (multilabel) sigmoid probabilities
+
+        Args:
+            probs (torch.Tensor): (batch_size, n_classes)
+            threshold (float): 'entropy': exit if the mean binary entropy (bits, 0-1) <= threshold
+                               'margin': exit if every label's |2p-1| >= threshold
+        Returns:
+            (torch.Tensor): (batch_size,) bool
+        """
+        if criterion == 'margin':
+            return (2*probs-1).abs().min(dim=1).values >= threshold
+        p = probs.clamp(1e-6, 1-1e-6)
+        entropy = -(p*torch.log2(p) + (1-p)*torch.log2(1-p))
+        return entropy.mean(dim=1) <= threshold
+
+    def early_exit_classify(self, input_ids, attention_mask, img_ft, img_box, threshold, criterion='entropy',
+                            visual_attention_mask=None, cls_probs=None):
+        """Runs the encoder layer by layer and stops each sample at the first exit head
+           whose prediction clears the threshold (see exit_confident). Samples that exit
+           are removed from the batch, the rest continue to the final cls head.
+           Inputs are as for classify.
+
+        Returns:
+            (torch.Tensor, torch.Tensor): (batch_size, n_classes) sigmoid probabilities and
+            (batch_size,) the number of encoder layers run for each sample
+        """
+        if self.hparams.num_regions > 0:
+            img_ft, img_box, visual_attention_mask = self.select_regions(img_ft, img_box, cls_probs)
+        visual_embeds = self.vis_pos_embeds(img_ft=img_ft, img_box=img_box)
+        if visual_attention_mask is None:
+            visual_attention_mask = torch.ones(visual_embeds.shape[:2], device=visual_embeds.device)
+        hidden = self.model.embeddings(input_ids=input_ids, visual_embeds=visual_embeds)
+        # Text then regions, as in the encoder forward: (batch_size, 1, 1, seq_len) additive mask
+        mask = torch.cat((attention_mask.type_as(visual_attention_mask), visual_attention_mask), dim=-1)
+        extended_mask = self.model.get_extended_attention_mask(mask, mask.shape, mask.device)
+
+        num_layers = len(self.model.encoder.layer)
+        probs = torch.zeros((input_ids.shape[0], self.cls[-1].out_features), device=hidden.device)
+        layers_run = torch.full((input_ids.shape[0],), num_layers, device=hidden.device)
+        active = torch.arange(input_ids.shape[0], device=hidden.device)
+
+        for i, layer in enumerate(self.model.encoder.layer):
+            hidden = layer(hidden, extended_mask)[0]
+            if str(i+1) not in getattr(self, 'exit_heads', {}):
+                continue
+            exit_probs = torch.sigmoid(self.exit_heads[str(i+1)](hidden[:, 0]))
+            done = self.exit_confident(exit_probs, threshold, criterion)
+            probs[active[done]] = exit_probs[done]
+            layers_run[active[done]] = i+1
+            active, hidden, extended_mask = active[~done], hidden[~done], extended_mask[~done]
+            if len(active) == 0:
+                return probs, layers_run
+
+        probs[active] = torch.sigmoid(self.cls(self.model.pooler(hidden)))
+        return probs, layers_run
+
+    def classify(self, input_ids, attention_mask, img_ft, img_box, visual_attention_mask=None, cls_probs=None):
+        """Tensor-only forward pass (no tokenisation, loss or logging) used for inference.
+           Runs (select_regions ->) vis_pos_embeds -> encoder -> cls once for the whole batch.
+
+        Args:
+            input_ids (torch.Tensor): (batch_size, seq_len) token ids
+            attention_mask (torch.Tensor): (batch_size, seq_len) text attention mask
+            img_ft (torch.Tensor): (batch_size, num_boxes, extracted_ft_dim) region features
+            img_box (torch.Tensor): (batch_size, num_boxes, 4) region boxes
+            visual_attention_mask (torch.Tensor, optional): (batch_size, num_boxes),
+                all regions attended to if None.
+            cls_probs (torch.Tensor, optional): (batch_size, num_boxes, num_classes) detector
+                class probabilities, scores regions if hparams.num_regions > 0
+
+        Returns:
+            (torch.Tensor): (batch_size, n_classes) logits
+        """
+        if self.hparams.num_regions > 0:
+            img_ft, img_box, visual_attention_mask = self.select_regions(img_ft, img_box, cls_probs)
+        visual_embeds = self.vis_pos_embeds(img_ft=img_ft, img_box=img_box)
+        if visual_attention_mask is None:
+            visual_attention_mask = torch.ones(visual_embeds.shape[:2], device=visual_embeds.device)
+
+        outputs = self(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            visual_embeds=visual_embeds,
+            visual_attention_mask=visual_attention_mask,
+            return_dict=False,
+        )
+        return self.cls(outputs[1])
+
+class MMRadForDistillation(MMRadForClassification):
+    """Knowledge distillation of a fine tuned MMRadForClassification (teacher) into a
+    shallower student with args.student_layers encoder layers.
+    Inherits from MMRadForClassification; validation/test use the student only, so the
+    MetricsCallback and save_pretrained of self.model work as for fine tuning.
+
+    - Student encoder layers are initialised from an evenly spaced subset of the teacher's
+      (always including the last), embeddings/pooler/visual transforms/cls are copied.
+    - Loss: distil_alpha * BCE(labels) + (1-distil_alpha) * T^2 * BCE(student/T, sigmoid(teacher/T))
+      + hidden_loss_weight * MSE between student and the matching teacher hidden states
+    - Multimodal (tune_on 'mm') only, without exit heads (exit_layers).
+    """
+    def __init__(self, args, train_size, n_classes, teacher, labelset=None, n_hidden=512,
+                 tokenizer='bert-base-uncased'):
+        """
+        Args:
+            args (namespace): see parameters.py, uses student_layers, distil_alpha,
+                distil_temperature and hidden_loss_weight
+            train_size (int): size of training dataset
+            n_classes (int): Number of classes/labels (multilabel)
+            teacher (MMRadForClassification): fine tuned teacher, kept frozen
+            labelset (list, optional): ordered list of the label names. Defaults to None.
+        """
+        # The distillation loss does not train exit heads
+        assert not str(args.exit_layers).strip(), "exit_layers are not supported with distillation"
+        student_args = copy.copy(args)
+        student_args.num_tx_layers = args.student_layers
+        # Weights come from the teacher
+        student_args.load_model = 'scratch'
+        super().__init__(student_args, train_size, n_classes, labelset=labelset,
+                         n_hidden=n_hidden, tokenizer=tokenizer)
+
+        self.teacher = teacher
+        self.teacher.eval()
+        for param in self.teacher.parameters():
+            param.requires_grad = False
+
+        self.layer_map = self.select_teacher_layers(teacher.config.num_hidden_layers, self.hparams.student_layers)
+        self._init_from_teacher()
+
+    @staticmethod
+    def select_teacher_layers(num_teacher_layers, num_student_layers):
+        """Evenly spaced teacher layer indices, e.g. 12 -> 4: [2, 5, 8, 11]"""
+        step = num_teacher_layers / num_student_layers
+        return [int(round((i+1)*step))-1 for i in range(num_student_layers)]
+
+    def _init_from_teacher(self):
+        print(f"Initialising {len(self.layer_map)} layer student from teacher layers {self.layer_map}")
+        self.model.embeddings.load_state_dict(self.teacher.model.embeddings.state_dict())
+        self.model.pooler.load_state_dict(self.teacher.model.pooler.state_dict())
+        for student_idx, teacher_idx in enumerate(self.layer_map):
+            self.model.encoder.layer[student_idx].load_state_dict(
+                self.teacher.model.encoder.layer[teacher_idx].state_dict())
+        for name in ('transform_img_ft', 'transform_img_box', 'cls'):
+            getattr(self, name).load_state_dict(getattr(self.teacher, name).state_dict())
+
+    @staticmethod
+    def logits_and_hidden(module, batch, output_hidden_states=False):
+        """Forward pass of a (tokenized) batch through module's projections, encoder and cls head"""
+        img_ft, img_box = batch['img']['features'], batch['img']['boxes']
+        visual_attention_mask = torch.ones(img_ft.shape[:2], device=img_ft.device)
+        if module.hparams.num_regions > 0:
+            img_ft, img_box, visual_attention_mask = module.select_regions(img_ft, img_box,
+                                                                           batch['img'].get('cls_probs'))
+        visual_embeds = module.vis_pos_embeds(img_ft=img_ft, img_box=img_box)
+        outputs = module(
+            input_ids=batch['txt']['input_ids'],
+            attention_mask=batch['txt']['att_mask'],
+            visual_embeds=visual_embeds,
+            visual_attention_mask=visual_attention_mask,
+            output_hidden_states=output_hidden_states,
+            return_dict=True,
+        )
+        return module.cls(outputs.pooler_output).float(), outputs.hidden_states
+
+    def training_step(self, batch, batch_idx):
+        batch = self.pp.tokenize_pad_vectorize(batch)
+        match_hidden = self.hparams.hidden_loss_weight > 0
+
+        logits, hidden = self.logits_and_hidden(self, batch, output_hidden_states=match_hidden)
+        # Lightning puts the whole module (incl. teacher) in train mode each epoch
+        self.teacher.eval()
+        with torch.no_grad():
+            teacher_logits, teacher_hidden = self.logits_and_hidden(self.teacher, batch,
+                                                                    output_hidden_states=match_hidden)
+
+        labels = batch['label'].type_as(logits)
+        T, alpha = self.hparams.distil_temperature, self.hparams.distil_alpha
+        loss_fct = nn.BCEWithLogitsLoss()
+        label_loss = loss_fct(logits, labels)
+        kd_loss = loss_fct(logits/T, torch.sigmoid(teacher_logits/T)) * T**2
+        loss = alpha*label_loss + (1-alpha)*kd_loss
+
+        logs = {'train_label_loss':label_loss, 'train_kd_loss':kd_loss}
+        if match_hidden:
+            # hidden[0] is the embedding output, layer i output is hidden[i+1]
+            hidden_loss = sum(F.mse_loss(hidden[s+1].float(), teacher_hidden[t+1].float())
+                              for s,t in enumerate(self.layer_map)) / len(self.layer_map)
+            loss = loss + self.hparams.hidden_loss_weight*hidden_loss
+            logs['train_hidden_loss'] = hidden_loss
+        logs['train_loss'] = loss
+
+        self.log_dict(logs, on_step = False, on_epoch = True,
+                      prog_bar = True, logger = True, batch_size = self.hparams.batch_size)
+        return loss
+
+    def on_save_checkpoint(self, checkpoint):
+        # Only keep the student, so checkpoints load as MMRadForClassification
+        checkpoint['state_dict'] = {k:v for k,v in checkpoint['state_dict'].items()
+                                    if not k.startswith('teacher.')}
@@ -43,6 +43,12 @@ def parse_args(stage):
     parser.add_argument('--visual_embedding_dim', dest='visual_embedding_dim', default=2048, type=int)
     parser.add_argument('--extracted_ft_dim', default=1024, type=int)
     parser.add_argument('--dropout', default=0.3, type=float)
+    # Memory / execution
+    parser.add_argument('--grad_checkpointing', default=False, type=bool,
+                        help='Recompute encoder layer activations in the backward pass')
+    parser.add_argument('--compile', default=False, type=bool, help='torch.compile the encoder and heads')
+    parser.add_argument('--memory_budget_gb', default=0., type=float,
+                        help='Largest batch size whose training step (any of --tasks) fits (0: use --batch_size)')
     
     
 
@@ -52,6 +58,29 @@ def parse_args(stage):
     # parser.add_argument('--img_only', dest='img_only', default=False, type=bool)
     # parser.add_argument('--txt_only', dest='txt_only', default=False, type=bool)
     parser.add_argument('--easy_classification', default=False)
+    # Region selection (in front of vis_pos_embeds)
+    parser.add_argument('--num_regions', default=0, type=int, help='Keep the top-k regions per study (0: all)')
+    parser.add_argument('--region_score', default='conf', help='conf (detector max class prob) or norm (feature L2 norm)')
+    parser.add_argument('--region_threshold', default=0., type=float,
+                        help='Adaptive k: also drop regions scoring below this (0: fixed k)')
+    parser.add_argument('--min_regions', default=5, type=int, help='Regions always kept with adaptive k')
+    parser.add_argument('--region_sweep', default='5,10,20,36', help='k values for region_sweep.py')
+    # Early exit
+    parser.add_argument('--exit_layers', default='', help='Comma separated layers (1-indexed) with exit heads, e.g. 4,8')
+    parser.add_argument('--exit_loss_weight', default=1., type=float)
+    parser.add_argument('--exit_criterion', default='entropy', help='entropy or margin')
+    parser.add_argument('--exit_thresholds', default='0.05,0.1,0.2,0.3', help='Thresholds for early_exit.py')
+    # Distillation
+    parser.add_argument('--teacher_cp_path', default=None, help='Fine tuned (pl_framework) teacher checkpoint')
+    parser.add_argument('--student_layers', default=6, type=int)
+    parser.add_argument('--distil_alpha', default=0.5, type=float, help='Weight of the label loss vs. soft label loss')
+    parser.add_argument('--distil_temperature', default=2., type=float)
+    parser.add_argument('--hidden_loss_weight', default=0., type=float, help='Hidden state matching (0: off)')
+    # Structured pruning
+    parser.add_argument('--head_prune_ratio', default=0.3, type=float, help='Fraction of attention heads to remove')
+    parser.add_argument('--ffn_prune_ratio', default=0.3, type=float, help='Fraction of FFN neurons to remove')
+    parser.add_argument('--prune_batches', default=0, type=int, help='Validation batches to score on (0: all)')
+    parser.add_argument('--recovery_epochs', default=0, type=int, help='Fine tune after pruning (0: off)')
 
     ##### DATA #####
 
@@ -71,7 +100,49 @@ def parse_args(stage):
     parser.add_argument('--valid_batch_size', dest='valid_batch_size', type=int, default=64)
     # Data path
     # parser.add_argument('--data_path', dest='data_path', default="/media/matt/data21/mmRad/MIMIC")
-    
+
+    ##### SERVING #####
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=8080, type=int)
+    parser.add_argument('--socket', default=None, help='Serve on a unix socket instead of host:port')
+    parser.add_argument('--max_batch_size', default=32, type=int, help='Upper bound of a dynamic micro-batch')
+    parser.add_argument('--max_wait_ms', default=5., type=float,
+                        help='Max time the first request in a micro-batch waits for others')
+    parser.add_argument('--loadgen', default=False, type=bool, help='Run the load generator against a server')
+    parser.add_argument('--bench_requests', default=1000, type=int)
+    parser.add_argument('--bench_concurrency', default=32, type=int)
+    parser.add_argument('--bench_repeats', default=20, type=int, help='Timed forward passes per benchmark')
+    # Quantization
+    parser.add_argument('--quantized_path', default=None, help='Where to save (or load) an int8 classifier')
+    # bf16 (precision_bench.py, compared against fp32)
+    parser.add_argument('--bench_steps', default=20, type=int, help='Timed training steps (precision / compile benchmarks)')
+    parser.add_argument('--loss_tolerance', default=0.05, type=float,
+                        help='Max mean relative difference of the bf16 and fp32 loss curves')
+    parser.add_argument('--auc_tolerance', default=0.01, type=float, help='Max avg AUROC difference')
+    # Export
+    parser.add_argument('--export_path', default='classifier', help='Export file path, without extension')
+    parser.add_argument('--export_format', default='torchscript,onnx', help='Comma separated: torchscript,onnx')
+    parser.add_argument('--skip_parity', default=False, type=bool,
+                        help='Export without checking the graphs against the PL model')
+    # Retrieval
+    parser.add_argument('--index_dir', default='retrieval_index')
+    parser.add_argument('--index_type', default='exact', help='exact (blocked matmul) or ivf (k-means partitions)')
+    parser.add_argument('--n_lists', default=256, type=int, help='Number of ivf partitions')
+    parser.add_argument('--n_probe', default=8, type=int, help='ivf partitions scanned per query')
+    parser.add_argument('--retrieve_k', default=10, type=int)
+    parser.add_argument('--rerank_k', default=0, type=int, help='Re-rank the top candidates with the ITM head (0: off)')
+    parser.add_argument('--num_queries', default=100, type=int)
+
+    ##### SWEEP (sweep.py) #####
+    parser.add_argument('--sweep_models', default='all_and_baseline',
+                        help='Comma separated encoders (names in pt_checkpoint_root or paths), all or all_and_baseline')
+    parser.add_argument('--sweep_seeds', default='808', help='Comma separated seeds')
+    parser.add_argument('--sweep_trains', default='mimic_5', help='Comma separated --train splits')
+    parser.add_argument('--threads_per_job', default=4, type=int, help='Intra-op threads of each job')
+    parser.add_argument('--max_jobs', default=0, type=int, help='Concurrent jobs (0: cpu count // threads_per_job)')
+    parser.add_argument('--token_cache', default='token_cache', help='Directory of the pre-tokenized reports')
+    parser.add_argument('--results_table', default='sweep_results.csv', help='Results of every job are appended here')
+
     ##### PL #####
     parser = pl.Trainer.add_argparse_args(parser)
     
@@ -0,0 +1,140 @@
+import torch
+from torch import nn
+try:
+    # transformers<4.19 (env.yml pins 4.11.3)
+    from transformers.modeling_utils import prune_linear_layer
+except ImportError:
+    from transformers.pytorch_utils import prune_linear_layer
+
+
+def importance_scores(model, loader, max_batches=0):
+    """First order (Taylor) importance of each attention head and FFN neuron in the encoder,
+       accumulated over the loader (e.g. the validation split). A head's score is
+       |sum(context * dL/dcontext)| over its slice of the attention output, which equals the
+       gradient of the loss w.r.t. a head mask (Michel et al. 2019); FFN neurons are scored
+       the same way on the intermediate activations.
+
+    Args:
+        model (MMRadForClassification): fine tuned classifier
+        loader (DataLoader): labelled batches from one of the datasets in data.py
+        max_batches (int, optional): stop after this many batches (0: whole loader)
+
+    Returns:
+        (list, list): per layer tensors of head scores (remaining heads, L2 normalised
+        within the layer) and FFN neuron scores (intermediate_size,)
+    """
+    layers = model.model.encoder.layer
+    head_scores = [torch.zeros(layer.attention.self.num_attention_heads) for layer in layers]
+    ffn_scores = [torch.zeros(layer.intermediate.dense.out_features) for layer in layers]
+    activations = {}
+
+    def keep_activation(name):
+        def hook(module, inputs, output):
+            output = output[0] if isinstance(output, tuple) else output
+            output.retain_grad()
+            activations[name] = output
+        return hook
+
+    handles = []
+    for i, layer in enumerate(layers):
+        handles.append(layer.attention.self.register_forward_hook(keep_activation(('head', i))))
+        handles.append(layer.intermediate.register_forward_hook(keep_activation(('ffn', i))))
+
+    was_training = model.training
+    model.eval()
+    loss_fct = nn.BCEWithLogitsLoss()
+    for batch_idx, batch in enumerate(loader):
+        if max_batches and batch_idx >= max_batches:
+            break
+        batch = model.pp.tokenize_pad_vectorize(batch)
+        cls_probs = batch['img'].get('cls_probs')
+        logits = model.classify(batch['txt']['input_ids'].to(model.device),
+                                batch['txt']['att_mask'].to(model.device),
+                                batch['img']['features'].to(model.device),
+                                batch['img']['boxes'].to(model.device),
+                                cls_probs=None if cls_probs is None else cls_probs.to(model.device))
+        loss = loss_fct(logits.view(-1), batch['label'].to(model.device).type_as(logits).view(-1))
+        model.zero_grad()
+        loss.backward()
+
+        for i, layer in enumerate(layers):
+            context = activations[('head', i)]
+            taylor = (context * context.grad).view(*context.shape[:2], head_scores[i].numel(), -1)
+            head_scores[i] += taylor.sum(dim=(0, 1, 3)).abs().detach().cpu()
+            hidden = activations[('ffn', i)]
+            ffn_scores[i] += (hidden * hidden.grad).sum(dim=(0, 1)).abs().detach().cpu()
+
+    for handle in handles:
+        handle.remove()
+    model.zero_grad()
+    model.train(was_training)
+    head_scores = [s / (s.norm() + 1e-12) for s in head_scores]
+    return head_scores, ffn_scores
+
+
+def select_heads(model, head_scores, ratio):
+    """Lowest scoring heads across all layers (at least one head is kept per layer)
+
+    Args:
+        model (MMRad): model the scores were computed on
+        head_scores (list): from importance_scores
+        ratio (float): fraction of the remaining heads to prune
+
+    Returns:
+        (dict): layer -> list of (original) head indices, as expected by prune_heads
+    """
+    # Score index -> original head index, for encoders that were already pruned
+    remaining = [sorted(set(range(model.config.num_attention_heads)) - layer.attention.pruned_heads)
+                 for layer in model.model.encoder.layer]
+    candidates = sorted((float(score), layer, remaining[layer][head])
+                        for layer, scores in enumerate(head_scores) for head, score in enumerate(scores))
+    n_prune = int(ratio * len(candidates))
+
+    to_prune, kept = {}, {layer: len(heads) for layer, heads in enumerate(remaining)}
+    for _, layer, head in candidates:
+        if n_prune == 0:
+            break
+        if kept[layer] > 1:
+            to_prune.setdefault(layer, []).append(head)
+            kept[layer] -= 1
+            n_prune -= 1
+    return to_prune
+
+
+def prune_ffn(model, ffn_scores, ratio):
+    """Removes the lowest scoring neurons of every FFN (intermediate) layer. The same number
+       is kept in each layer so the result is described by config.intermediate_size.
+
+    Args:
+        model (MMRad): model the scores were computed on
+        ffn_scores (list): from importance_scores
+        ratio (float): fraction of the neurons to prune
+
+    Returns:
+        (int): new intermediate size
+    """
+    intermediate_size = model.model.config.intermediate_size
+    keep = max(1, int(round(intermediate_size * (1-ratio))))
+    for layer, scores in zip(model.model.encoder.layer, ffn_scores):
+        index = scores.topk(keep).indices.sort().values.to(model.device)
+        layer.intermediate.dense = prune_linear_layer(layer.intermediate.dense, index, dim=0)
+        layer.output.dense = prune_linear_layer(layer.output.dense, index, dim=1)
+    model.model.config.intermediate_size = keep
+    model.config.intermediate_size = keep
+    return keep
+
+
+def prune_encoder(model, head_scores, ffn_scores, head_ratio=0., ffn_ratio=0.):
+    """Physically removes heads (prune_heads, recorded in config.pruned_heads) and FFN neurons
+       so that model.model.save_pretrained can be reloaded through MMRad.__init__
+
+    Returns:
+        (dict): layer -> pruned heads
+    """
+    heads = select_heads(model, head_scores, head_ratio) if head_ratio > 0 else {}
+    if heads:
+        model.model.prune_heads(heads)
+        model.config.pruned_heads = model.model.config.pruned_heads
+    if ffn_ratio > 0:
+        prune_ffn(model, ffn_scores, ffn_ratio)
+    return heads
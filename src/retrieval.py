@@ -0,0 +1,200 @@
+import os, json, time
+import numpy as np
+import torch
+from torch.nn import functional as F
+
+from src.inference import LatencyStats
+
+
+def pooled_embeddings(model, batch):
+    """Encodes a batch of studies (report + region features) to L2 normalised
+    pooled encoder outputs, the representation the ITM head is trained on.
+
+    Args:
+        model (MMRad): any MMRad module (e.g. MMRadForPretraining)
+        batch (dict): collated batch from one of the datasets in data.py
+
+    Returns:
+        (torch.Tensor): (batch_size, hidden_size)
+    """
+    batch = model.pp.tokenize_pad_vectorize(batch)
+    visual_embeds = model.vis_pos_embeds(img_ft=batch['img']['features'].to(model.device),
+                                         img_box=batch['img']['boxes'].to(model.device))
+    outputs = model(
+        input_ids=batch['txt']['input_ids'].to(model.device),
+        attention_mask=batch['txt']['att_mask'].to(model.device),
+        visual_embeds=visual_embeds,
+        visual_attention_mask=torch.ones(visual_embeds.shape[:2], device=model.device),
+        return_dict=False,
+    )
+    return F.normalize(outputs[1], dim=-1)
+
+
+def encode_corpus(model, loader):
+    """Returns ids (list) and pooled embeddings (np.array (N, hidden_size), float32)"""
+    ids, embeddings = [], []
+    with torch.no_grad():
+        for batch in loader:
+            ids += [str(i) for i in batch['img']['id']]
+            embeddings.append(pooled_embeddings(model, batch).float().cpu().numpy())
+    return ids, np.concatenate(embeddings)
+
+
+class RetrievalIndex:
+    """On-disk nearest neighbour index over normalised embeddings (inner product = cosine).
+
+    index_type:
+        'exact': blocked matrix multiply over the memory-mapped embeddings,
+                 keeping a running top-k per block
+        'ivf': spherical k-means partitions (n_lists), embeddings stored contiguously per
+               partition; a query only scans the n_probe partitions with the closest centroids
+
+    Files in index_dir: embeddings.npy (memory-mapped at load), ids.json, meta.json
+    and for ivf centroids.npy, offsets.npy
+    """
+    def __init__(self, index_dir, embeddings, ids, index_type='exact',
+                 centroids=None, offsets=None, block_size=16384):
+        self.index_dir = index_dir
+        self.embeddings = embeddings
+        self.ids = ids
+        self.index_type = index_type
+        self.centroids = centroids
+        self.offsets = offsets
+        self.block_size = block_size
+        self.latency = LatencyStats()
+
+    @classmethod
+    def build(cls, index_dir, ids, embeddings, index_type='exact', n_lists=256, kmeans_iters=20, seed=808):
+        os.makedirs(index_dir, exist_ok=True)
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        ids = list(ids)
+        meta = {'index_type':index_type, 'size':len(ids), 'dim':embeddings.shape[1]}
+
+        if index_type == 'ivf':
+            n_lists = min(n_lists, len(ids))
+            centroids, assignment = spherical_kmeans(embeddings, n_lists, kmeans_iters, seed)
+            # Store each partition contiguously so a probe is a single slice
+            order = np.argsort(assignment, kind='stable')
+            embeddings, ids = embeddings[order], [ids[i] for i in order]
+            offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=n_lists))])
+            np.save(os.path.join(index_dir, 'centroids.npy'), centroids)
+            np.save(os.path.join(index_dir, 'offsets.npy'), offsets)
+            meta['n_lists'] = n_lists
+
+        np.save(os.path.join(index_dir, 'embeddings.npy'), embeddings)
+        with open(os.path.join(index_dir, 'ids.json'), 'w') as f:
+            json.dump(ids, f)
+        with open(os.path.join(index_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        print(f"Built {index_type} index of {len(ids)} studies in {index_dir}")
+        return cls.load(index_dir)
+
+    @classmethod
+    def load(cls, index_dir):
+        with open(os.path.join(index_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        with open(os.path.join(index_dir, 'ids.json')) as f:
+            ids = json.load(f)
+        embeddings = np.load(os.path.join(index_dir, 'embeddings.npy'), mmap_mode='r')
+        centroids, offsets = None, None
+        if meta['index_type'] == 'ivf':
+            centroids = np.load(os.path.join(index_dir, 'centroids.npy'))
+            offsets = np.load(os.path.join(index_dir, 'offsets.npy'))
+        return cls(index_dir, embeddings, ids, meta['index_type'], centroids, offsets)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, queries, k=10, n_probe=8):
+        """Top-k most similar studies for each query embedding
+
+        Args:
+            queries (np.array): (num_queries, dim) normalised embeddings
+            k (int): number of neighbours
+            n_probe (int): partitions scanned per query (ivf only)
+
+        Returns:
+            (np.array, list): (num_queries, k) scores and the matching lists of ids
+        """
+        start = time.perf_counter()
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        if self.index_type == 'ivf':
+            scores, idxs = self._search_ivf(queries, k, n_probe)
+        else:
+            scores, idxs = self._search_blocks(queries, k, [(0, len(self))])
+        self.latency.record(time.perf_counter()-start)
+        return scores, [[self.ids[i] for i in row if i >= 0] for row in idxs]
+
+    def _search_blocks(self, queries, k, ranges):
+        """Running top-k over the rows in ranges, scanned in blocks of block_size"""
+        best_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        best_idxs = np.full((len(queries), k), -1, dtype=np.int64)
+        for range_start, range_end in ranges:
+            for block_start in range(range_start, range_end, self.block_size):
+                block_end = min(block_start+self.block_size, range_end)
+                scores = queries @ np.asarray(self.embeddings[block_start:block_end]).T
+                idxs = np.broadcast_to(np.arange(block_start, block_end), scores.shape)
+                # Merge block candidates into the running top-k
+                scores = np.concatenate([best_scores, scores], axis=1)
+                idxs = np.concatenate([best_idxs, idxs], axis=1)
+                top = np.argpartition(-scores, k-1, axis=1)[:, :k]
+                best_scores = np.take_along_axis(scores, top, axis=1)
+                best_idxs = np.take_along_axis(idxs, top, axis=1)
+        order = np.argsort(-best_scores, axis=1)
+        return np.take_along_axis(best_scores, order, axis=1), np.take_along_axis(best_idxs, order, axis=1)
+
+    def _search_ivf(self, queries, k, n_probe):
+        n_probe = min(n_probe, len(self.centroids))
+        probes = np.argpartition(-(queries @ self.centroids.T), n_probe-1, axis=1)[:, :n_probe]
+        results = [self._search_blocks(q[None], k, [(self.offsets[p], self.offsets[p+1]) for p in sorted(probe)])
+                   for q, probe in zip(queries, probes)]
+        return np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results])
+
+
+def spherical_kmeans(embeddings, n_clusters, iters=20, seed=808):
+    """K-means on the unit sphere (cosine similarity). Returns centroids and assignments"""
+    rng = np.random.default_rng(seed)
+    centroids = embeddings[rng.choice(len(embeddings), n_clusters, replace=False)].copy()
+    for _ in range(iters):
+        assignment = np.argmax(embeddings @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, embeddings)
+        # Re-seed empty clusters with a random point
+        empty = np.bincount(assignment, minlength=n_clusters) == 0
+        sums[empty] = embeddings[rng.integers(len(embeddings), size=int(empty.sum()))]
+        centroids = sums
+        centroids /= np.linalg.norm(centroids, axis=1, keepdims=True) + 1e-12
+    return centroids, np.argmax(embeddings @ centroids.T, axis=1)
+
+
+def itm_rerank(model, report, candidate_ids, img_data):
+    """Re-ranks candidates by the ITM head (seq_relationship_head) probability that the
+    query report matches each candidate's image. All candidates run as one batch.
+
+    Args:
+        model (MMRadForPretraining): with a trained seq_relationship_head
+        report (str): query report text
+        candidate_ids (list): ids from RetrievalIndex.search
+        img_data (dict): id -> {'features', 'boxes'} as returned by load_tsv
+
+    Returns:
+        (list): (id, match probability) sorted by descending probability
+    """
+    batch = {'txt': {'raw': [report]*len(candidate_ids)},
+             'img': {'features': torch.from_numpy(np.stack([img_data[i]['features'] for i in candidate_ids])),
+                     'boxes': torch.from_numpy(np.stack([img_data[i]['boxes'] for i in candidate_ids]))}}
+    with torch.no_grad():
+        batch = model.pp.tokenize_pad_vectorize(batch)
+        visual_embeds = model.vis_pos_embeds(img_ft=batch['img']['features'].to(model.device),
+                                             img_box=batch['img']['boxes'].to(model.device))
+        outputs = model(
+            input_ids=batch['txt']['input_ids'],
+            attention_mask=batch['txt']['att_mask'],
+            visual_embeds=visual_embeds,
+            visual_attention_mask=torch.ones(visual_embeds.shape[:2], device=model.device),
+            return_dict=False,
+        )
+        # itm_sampling labels matched pairs as 1
+        match_probs = F.softmax(model.seq_relationship_head(outputs[1]), dim=-1)[:, 1].cpu().numpy()
+    order = np.argsort(-match_probs)
+    return [(candidate_ids[i], float(match_probs[i])) for i in order]
@@ -0,0 +1,223 @@
+import asyncio, base64, json, time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+
+from src.inference import LatencyStats
+
+
+def decode_array(value, num_cols):
+    """Decode features/boxes sent as either a nested list or a base64 float32
+    string (as written by extract_features.py) into a (num_boxes, num_cols) array"""
+    if isinstance(value, str):
+        # Strip the b'' wrapper if copied straight from a .tsv file
+        value = value[2:-1] if value.startswith("b'") else value
+        arr = np.frombuffer(base64.b64decode(value), dtype=np.float32)
+    else:
+        arr = np.asarray(value, dtype=np.float32)
+    return arr.reshape(-1, num_cols)
+
+
+class ClassifierWorker:
+    """Runs a micro-batch of requests through MMRadForClassification.classify
+    (vis_pos_embeds + VisualBert + cls) in a single forward pass."""
+    def __init__(self, model):
+        self.model = model
+        self.device = model.device
+        self.ft_dim = model.visual_features_dim
+
+    def __call__(self, requests):
+        num_boxes = max(len(r['features']) for r in requests)
+        bs = len(requests)
+        # Pad regions to the largest in the micro-batch and mask out the padding
+        img_ft = np.zeros((bs, num_boxes, self.ft_dim), dtype=np.float32)
+        img_box = np.zeros((bs, num_boxes, 4), dtype=np.float32)
+        visual_attention_mask = np.zeros((bs, num_boxes), dtype=np.float32)
+        for i,r in enumerate(requests):
+            n = len(r['features'])
+            img_ft[i,:n], img_box[i,:n], visual_attention_mask[i,:n] = r['features'], r['boxes'], 1.
+
+        batch = self.model.pp.tokenize_pad_vectorize({'txt': {'raw': [r['report'] for r in requests]}})
+        with torch.no_grad():
+            logits = self.model.classify(
+                input_ids=batch['txt']['input_ids'].to(self.device),
+                attention_mask=batch['txt']['att_mask'].to(self.device),
+                img_ft=torch.from_numpy(img_ft).to(self.device),
+                img_box=torch.from_numpy(img_box).to(self.device),
+                visual_attention_mask=torch.from_numpy(visual_attention_mask).to(self.device)
+                )
+            preds = torch.sigmoid(logits).cpu().numpy()
+        return [dict(zip(self.model.labelset, map(float, p))) for p in preds]
+
+
+class MicroBatcher:
+    """Queues incoming requests and forms dynamic micro-batches bounded by
+    max_batch_size and max_wait_ms (measured from the first request in the batch).
+    Each micro-batch is passed to predict_fn in a worker thread so the event loop
+    keeps accepting requests while the model runs.
+    """
+    def __init__(self, predict_fn, max_batch_size=32, max_wait_ms=5.):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms/1000
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+        self.latency = LatencyStats()
+        self.max_queue_depth = 0
+        self.num_batches = 0
+        self.num_batched_requests = 0
+
+    async def submit(self, request):
+        """Queue a (decoded) request and wait for its prediction"""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((request, future, time.perf_counter()))
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            requests, futures, _ = zip(*batch)
+            try:
+                results = await loop.run_in_executor(self.executor, self.predict_fn, list(requests))
+            except Exception as e:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            done = time.perf_counter()
+            for (_, future, start), result in zip(batch, results):
+                self.latency.record(done-start)
+                if not future.done():
+                    future.set_result(result)
+            self.num_batches += 1
+            self.num_batched_requests += len(batch)
+
+    def metrics(self):
+        metrics = self.latency.summary()
+        metrics.update({'queue_depth':self.queue.qsize(),
+                        'max_queue_depth':self.max_queue_depth,
+                        'batches':self.num_batches,
+                        'mean_batch_size':self.num_batched_requests/max(self.num_batches, 1)})
+        return metrics
+
+
+class InferenceServer:
+    """Minimal asyncio HTTP/1.1 server (TCP or unix socket), one request per connection:
+        POST /predict  {"id":..., "report": str, "features": [...], "boxes": [...]}
+        GET  /metrics  latency percentiles, queue depth and batch sizes
+    """
+    def __init__(self, batcher, ft_dim=1024):
+        self.batcher = batcher
+        self.ft_dim = ft_dim
+
+    async def _respond(self, writer, status, body):
+        payload = json.dumps(body).encode()
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode() + payload)
+        await writer.drain()
+        writer.close()
+
+    async def handle(self, reader, writer):
+        try:
+            method, path, _ = (await reader.readline()).decode().split(' ', 2)
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode().strip()
+                if not line:
+                    break
+                key, value = line.split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+        except (ValueError, asyncio.IncompleteReadError) as e:
+            return await self._respond(writer, '400 Bad Request', {'error':str(e)})
+
+        if method == 'GET' and path == '/metrics':
+            return await self._respond(writer, '200 OK', self.batcher.metrics())
+        if method != 'POST' or path != '/predict':
+            return await self._respond(writer, '404 Not Found', {'error':f'{method} {path}'})
+
+        try:
+            request = json.loads(body)
+            request = {'report': request.get('report', ''),
+                       'features': decode_array(request['features'], self.ft_dim),
+                       'boxes': decode_array(request['boxes'], 4),
+                       'id': request.get('id')}
+        except (ValueError, KeyError) as e:
+            return await self._respond(writer, '400 Bad Request', {'error':str(e)})
+
+        try:
+            probs = await self.batcher.submit(request)
+        except Exception as e:
+            return await self._respond(writer, '500 Internal Server Error', {'error':str(e)})
+        await self._respond(writer, '200 OK', {'id':request['id'], 'probs':probs})
+
+    async def serve(self, host='127.0.0.1', port=8080, socket=None):
+        if socket is not None:
+            server = await asyncio.start_unix_server(self.handle, path=socket)
+            print(f"Serving on unix socket {socket}")
+        else:
+            server = await asyncio.start_server(self.handle, host=host, port=port)
+            print(f"Serving on http://{host}:{port}")
+        batch_task = asyncio.ensure_future(self.batcher.run())
+        async with server:
+            await server.serve_forever()
+        batch_task.cancel()
+
+
+async def _post(request, host, port, socket, path='/predict', method='POST'):
+    if socket is not None:
+        reader, writer = await asyncio.open_unix_connection(socket)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    payload = json.dumps(request).encode() if request is not None else b''
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(payload)}\r\n\r\n".encode() + payload)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return json.loads(response.split(b'\r\n\r\n', 1)[1])
+
+
+async def load_generator(requests, num_requests=1000, concurrency=32,
+                         host='127.0.0.1', port=8080, socket=None):
+    """Local benchmark client: keeps `concurrency` requests in flight (cycling through
+    `requests`) until num_requests are answered, then reports client side throughput
+    and latency alongside the server /metrics."""
+    latency = LatencyStats(window=num_requests)
+    counter = iter(range(num_requests))
+
+    async def client():
+        for i in counter:
+            start = time.perf_counter()
+            await _post(requests[i % len(requests)], host, port, socket)
+            latency.record(time.perf_counter()-start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    elapsed = time.perf_counter()-start
+
+    results = {'client':latency.summary(),
+               'throughput_rps':num_requests/elapsed,
+               'server':await _post(None, host, port, socket, path='/metrics', method='GET')}
+    return results
@@ -1,8 +1,87 @@
-import random
+import os, json, random, hashlib
 import torch
 import numpy as np
 from collections import Counter
 
+class TokenCache:
+    """Pre-tokenized (padded to max_seq_len) input ids and attention masks of a fixed
+    set of texts, memory mapped so that several processes share one copy.
+
+    Files in cache_dir: input_ids.npy, att_mask.npy and rows.json (text digest -> row,
+    plus the tokenizer and max_seq_len used).
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, 'rows.json')) as f:
+            index = json.load(f)
+        self.tokenizer, self.max_seq_len = index['tokenizer'], index['max_seq_len']
+        self.rows = index['rows']
+        self._arrays = None
+
+    @staticmethod
+    def digest(text):
+        return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+    @classmethod
+    def build(cls, cache_dir, texts, tokenizer, max_seq_len=125, batch_size=4096):
+        """Tokenizes the unique texts (as tokenize_pad_vectorize) into cache_dir
+
+        Args:
+            texts (iterable): raw texts (e.g. every report of the train/val/test splits)
+            tokenizer: HF tokenizer, its name_or_path is recorded with the cache
+
+        Returns:
+            (TokenCache)
+        """
+        rows = {}
+        unique = []
+        for text in texts:
+            key = cls.digest(text)
+            if key not in rows:
+                rows[key] = len(unique)
+                unique.append(text)
+        os.makedirs(cache_dir, exist_ok=True)
+        arrays = {k: np.lib.format.open_memmap(os.path.join(cache_dir, k + '.npy.tmp'), mode='w+',
+                                               dtype=np.int64, shape=(max(len(unique), 1), max_seq_len))
+                  for k in ['input_ids', 'att_mask']}
+        for start in range(0, len(unique), batch_size):
+            encoded = tokenizer(
+                text=unique[start:start+batch_size],
+                add_special_tokens=True,
+                max_length=max_seq_len,
+                truncation=True,
+                padding='max_length',
+                return_attention_mask=True,
+                return_tensors='np',
+            )
+            arrays['input_ids'][start:start+batch_size] = encoded['input_ids']
+            arrays['att_mask'][start:start+batch_size] = encoded['attention_mask']
+        for array in arrays.values():
+            array.flush()
+        del arrays
+        for k in ['input_ids', 'att_mask']:
+            os.replace(os.path.join(cache_dir, k + '.npy.tmp'), os.path.join(cache_dir, k + '.npy'))
+        with open(os.path.join(cache_dir, 'rows.json'), 'w') as f:
+            json.dump({'tokenizer': tokenizer.name_or_path, 'max_seq_len': max_seq_len, 'rows': rows}, f)
+        return cls(cache_dir)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_arrays'] = None
+        return state
+
+    def lookup(self, texts):
+        """Cached (input_ids, att_mask) tensors of texts, or None if any text is missing"""
+        try:
+            rows = [self.rows[self.digest(text)] for text in texts]
+        except KeyError:
+            return None
+        if self._arrays is None:
+            self._arrays = [np.load(os.path.join(self.cache_dir, k + '.npy'), mmap_mode='r')
+                            for k in ['input_ids', 'att_mask']]
+        return tuple(torch.from_numpy(array[rows]) for array in self._arrays)
+
+
 class PretextProcessor:
     """
     Class to perform both pre-processing (tokenisation, generate att masks) and
@@ -25,6 +104,8 @@ class PretextProcessor:
 
         self.tok = tokenizer
         self.max_seq_len = max_seq_len
+        # Optional TokenCache of pre-tokenized texts (see sweep.py, use_token_cache)
+        self.token_cache = None
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
     def img_vectorize(self, batch, model):
@@ -48,18 +129,39 @@ class PretextProcessor:
         batch['img']['type_ids'] = torch.zeros((len(batch), num_features), device=self.device)
         return batch
 
+    def use_token_cache(self, token_cache):
+        """Tokenize through token_cache, if it was built with this tokenizer and max_seq_len
+
+        Returns:
+            bool: whether the cache is used
+        """
+        if (token_cache.tokenizer, token_cache.max_seq_len) != (self.tok.name_or_path, self.max_seq_len):
+            print(f"Warning: token cache {token_cache.cache_dir} ({token_cache.tokenizer}, max_seq_len "
+                  f"{token_cache.max_seq_len}) does not match the tokenizer ({self.tok.name_or_path}, "
+                  f"max_seq_len {self.max_seq_len}), tokenizing on the fly")
+            self.token_cache = None
+            return False
+        self.token_cache = token_cache
+        return True
+
     def tokenize_pad_vectorize(self, batch, return_word_ids=False):
        
-        # transformers > 4.0.0 replace
-        encoded = self.tok(
-            text=batch['txt']['raw'],
-            add_special_tokens=True,
-            max_length = self.max_seq_len,
-            truncation=True,
-            padding='max_length',
-            return_attention_mask = True,
-            return_tensors = 'pt',
-        ) 
+        cached = None
+        if self.token_cache is not None and not return_word_ids:
+            cached = self.token_cache.lookup(batch['txt']['raw'])
+        if cached is not None:
+            encoded = {'input_ids': cached[0], 'attention_mask': cached[1]}
+        else:
+            # transformers > 4.0.0 replace
+            encoded = self.tok(
+                text=batch['txt']['raw'],
+                add_special_tokens=True,
+                max_length = self.max_seq_len,
+                truncation=True,
+                padding='max_length',
+                return_attention_mask = True,
+                return_tensors = 'pt',
+            ) 
         
         batch['txt']['input_ids'] = encoded['input_ids'].to(self.device)
         batch['txt']['att_mask'] = encoded['attention_mask'].to(self.device)
@@ -1,23 +1,56 @@
-import csv, base64, time
+import os, csv, json, base64, time
+from collections.abc import Mapping
 import torch, torchmetrics
 import numpy as np
 import pytorch_lightning as pl
 import wandb
 
-def load_tsv(fname, topk=None):
+def load_paths_dict(cfg='data_paths.json'):
+    """Dataset / checkpoint file paths (see data_paths.json)"""
+    with open(cfg, 'r') as file:
+        pd = json.loads(file.read())
+    return pd
+
+
+def committed_lines(f, size=None):
+    """Decoded lines of a binary file, up to size bytes (None: all)"""
+    read = 0
+    for line in f:
+        read += len(line)
+        if size is not None and read > size:
+            break
+        yield line.decode()
+
+
+def load_tsv(fname, topk=None, load_cls_probs=False):
     """Load object features from tsv file.
 
     :param fname: The path to the tsv file.
     :param topk: Only load features for top K images (lines) in the tsv file.
         Will load all the features if topk is either -1 or None.
+    :param load_cls_probs: Also load the detector's per-region class probabilities
+        (num_boxes, num_classes), e.g. for region selection or the mrc task.
     :return: A dict of image object features where each feature is a dict.
+
+    If the file has an index ([fname].index.json, written by preproc/extract_features.py),
+    only its committed rows are read, so a store that is being appended to can be loaded,
+    and duplicate image ids (aliases) share the features of their extracted image.
+    If a fresh memory mapped copy ([fname].memmap/, see build_feature_memmap) exists,
+    it is returned instead of parsing the tsv.
     """
     import sys
     csv.field_size_limit(sys.maxsize)
+    if memmap_is_fresh(fname, load_cls_probs):
+        return MemmapFeatures(fname + '.memmap', topk=topk, load_cls_probs=load_cls_probs)
     start_time = time.time()
     print(f"\nStarting to load pre-extracted Faster-RCNN detected objects from {fname}...")
-    with open(fname, 'r') as f:
-        reader = csv.DictReader(f, ["img_id", "img_h", "img_w", 
+    committed, aliases = None, {}
+    if os.path.exists(fname + '.index.json'):
+        with open(fname + '.index.json') as f:
+            index = json.load(f)
+        committed, aliases = index['size'], index.get('aliases', {})
+    with open(fname, 'rb') as f:
+        reader = csv.DictReader(committed_lines(f, committed), ["img_id", "img_h", "img_w", 
                         "num_boxes", "boxes", "features", "cls_probs"], delimiter="\t")
         
         data = {}
@@ -29,15 +62,155 @@ def load_tsv(fname, topk=None):
             # slice from 2: to remove b' (csv.writer wraps all vals in str())
             new_item['features'] = np.frombuffer(base64.b64decode(item['features'][2:]), dtype=np.float32).reshape(num_boxes,-1).copy()
             new_item['boxes'] = np.frombuffer(base64.b64decode(item['boxes'][2:]), dtype=np.float32).reshape(num_boxes,4).copy()
-            # new_item['cls_probs'] = np.frombuffer(base64.b64decode(item['cls_probs'][2:]), dtype=np.float32).reshape(num_boxes,-1).copy()
+            if load_cls_probs:
+                new_item['cls_probs'] = np.frombuffer(base64.b64decode(item['cls_probs'][2:]), dtype=np.float32).reshape(num_boxes,-1).copy()
             data[item['img_id']] = new_item
             if topk is not None and len(data) == topk:
                 break
+    for alias, img_id in aliases.items():
+        if topk is not None and len(data) == topk:
+            break
+        if img_id in data:
+            data[alias] = data[img_id]
     elapsed_time = time.time() - start_time
     print(f"Loaded {len(data)} image features from {fname} in {elapsed_time:.2f} seconds.\n\n")
     return data
 
 
+def _tsv_stamp(fname):
+    """Identifies the committed content of a tsv store (size, mtime)"""
+    stat = os.stat(fname)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def memmap_is_fresh(fname, load_cls_probs=False):
+    """Whether [fname].memmap/ was built from the current tsv (and has cls_probs if needed)"""
+    index_fp = os.path.join(fname + '.memmap', 'index.json')
+    if not os.path.exists(index_fp):
+        return False
+    with open(index_fp) as f:
+        index = json.load(f)
+    return index['source'] == _tsv_stamp(fname) and (index['cls_probs_dim'] > 0 or not load_cls_probs)
+
+
+def build_feature_memmap(fname):
+    """Writes a memory mapped copy of a tsv feature store to [fname].memmap/, so that
+    several processes share one (page cached) copy of the features instead of each
+    decoding the tsv into its own memory.
+
+    Features, boxes and cls_probs of all images are concatenated along the box
+    dimension (features.bin, boxes.bin, cls_probs.bin); index.json holds each image's
+    row offset, num_boxes, img_h and img_w, the aliases of the store index and the
+    tsv (size, mtime) it was built from.
+
+    Returns:
+        str: path of the memmap directory
+    """
+    import sys
+    csv.field_size_limit(sys.maxsize)
+    out_dir = fname + '.memmap'
+    if memmap_is_fresh(fname, load_cls_probs=True):
+        return out_dir
+    start_time = time.time()
+    os.makedirs(out_dir, exist_ok=True)
+    source = _tsv_stamp(fname)
+    committed, aliases = None, {}
+    if os.path.exists(fname + '.index.json'):
+        with open(fname + '.index.json') as f:
+            index = json.load(f)
+        committed, aliases = index['size'], index.get('aliases', {})
+
+    index = {'ids': [], 'offsets': [], 'num_boxes': [], 'img_h': [], 'img_w': [],
+             'feature_dim': 0, 'cls_probs_dim': 0}
+    offset = 0
+    files = {k: open(os.path.join(out_dir, k + '.bin.tmp'), 'wb') for k in ['features', 'boxes', 'cls_probs']}
+    with open(fname, 'rb') as f:
+        reader = csv.DictReader(committed_lines(f, committed), ["img_id", "img_h", "img_w",
+                        "num_boxes", "boxes", "features", "cls_probs"], delimiter="\t")
+        for item in reader:
+            num_boxes = int(item['num_boxes'])
+            for key in ['features', 'boxes', 'cls_probs']:
+                if item[key]:
+                    files[key].write(base64.b64decode(item[key][2:]))
+            if not index['ids']:
+                index['feature_dim'] = len(base64.b64decode(item['features'][2:])) // (4 * num_boxes)
+                if item['cls_probs']:
+                    index['cls_probs_dim'] = len(base64.b64decode(item['cls_probs'][2:])) // (4 * num_boxes)
+            index['ids'].append(item['img_id'])
+            index['offsets'].append(offset)
+            for key in ['num_boxes', 'img_h', 'img_w']:
+                index[key].append(int(item[key]))
+            offset += num_boxes
+    for key, file in files.items():
+        file.close()
+        os.replace(file.name, os.path.join(out_dir, key + '.bin'))
+    index['total_boxes'] = offset
+    extracted = set(index['ids'])
+    index['aliases'] = {alias: img_id for alias, img_id in aliases.items() if img_id in extracted}
+    # Written last: the copy only counts as fresh once complete
+    index['source'] = source
+    with open(os.path.join(out_dir, 'index.json.tmp'), 'w') as f:
+        json.dump(index, f)
+    os.replace(os.path.join(out_dir, 'index.json.tmp'), os.path.join(out_dir, 'index.json'))
+    print(f"Wrote memory mapped features of {len(index['ids'])} images to {out_dir} "
+          f"in {time.time()-start_time:.2f} seconds.")
+    return out_dir
+
+
+class MemmapFeatures(Mapping):
+    """Read-only dict of image object features backed by a build_feature_memmap directory.
+    Items are the same dicts as load_tsv's. The memmaps are opened lazily and not
+    pickled, so DataLoader workers and sweep processes each map the same files.
+    """
+    def __init__(self, path, topk=None, load_cls_probs=False):
+        self.path = path
+        self.load_cls_probs = load_cls_probs
+        with open(os.path.join(path, 'index.json')) as f:
+            index = json.load(f)
+        self.feature_dim, self.cls_probs_dim = index['feature_dim'], index['cls_probs_dim']
+        self.total_boxes = index['total_boxes']
+        ids = index['ids'] if not topk or topk < 0 else index['ids'][:topk]
+        self.rows = {img_id: i for i, img_id in enumerate(ids)}
+        for alias, img_id in index['aliases'].items():
+            if topk and topk > 0 and len(self.rows) == topk:
+                break
+            if img_id in self.rows:
+                self.rows[alias] = self.rows[img_id]
+        self.offsets = np.asarray(index['offsets'], dtype=np.int64)
+        self.num_boxes = np.asarray(index['num_boxes'], dtype=np.int64)
+        self.img_hw = np.asarray([index['img_h'], index['img_w']], dtype=np.int64).T
+        self._maps = None
+        print(f"Mapped {len(self.rows)} image features from {path}.\n\n")
+
+    def _open(self):
+        dims = {'features': self.feature_dim, 'boxes': 4, 'cls_probs': self.cls_probs_dim}
+        keys = ['features', 'boxes', 'cls_probs'] if self.load_cls_probs else ['features', 'boxes']
+        self._maps = {k: np.memmap(os.path.join(self.path, k + '.bin'), dtype=np.float32, mode='r',
+                                   shape=(self.total_boxes, dims[k])) for k in keys}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_maps'] = None
+        return state
+
+    def __getitem__(self, img_id):
+        if self._maps is None:
+            self._open()
+        i = self.rows[img_id]
+        start, end = self.offsets[i], self.offsets[i] + self.num_boxes[i]
+        item = {'img_h': int(self.img_hw[i, 0]), 'img_w': int(self.img_hw[i, 1]),
+                'num_boxes': int(self.num_boxes[i])}
+        for key, data in self._maps.items():
+            item[key] = np.array(data[start:end])
+        return item
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+
 class MetricsCallback(pl.Callback):
     """PL Callback to Log auroc & TP,FP,TN,FP stats 
        using accumulated predictions & labels
@@ -122,30 +295,48 @@ class MetricsCallback(pl.Callback):
             self.test_labels = torch.vstack((self.test_labels, batch['label'])) 
 
     def on_test_epoch_end(self, trainer: "pl.Trainer", pl_module: "pl.LightningModule") -> None:
+        avg_AUC, wAvg_AUC, tables = self.test_tables(self.test_preds, self.test_labels, pl_module.labelset)
+
+        self.log_dict({'Avg_AUC':avg_AUC, 'wAvg_AUC':wAvg_AUC})
+        for key, (columns, data) in tables.items():
+            pl_module.logger.log_table(key=key, columns=columns, data=data)
+
+    def test_tables(self, preds, labels, labelset):
+        """AUROC & stat score tables over the accumulated test predictions & labels.
+        Also used without a Trainer (finetune.py zero epoch evaluation).
+
+        Args:
+            preds (torch.Tensor): (num_examples, n_classes) sigmoid predictions
+            labels (torch.Tensor): (num_examples, n_classes)
+            labelset (list): ordered label names
+
+        Returns:
+            avg_AUC, wAvg_AUC and a dict of tables {key: (columns, data)}
+        """
         # TODO: Check if unecessary now due larger & balanced dsets
         # Skip labels that don't have both instances (0,1); no chance of all 1's
-        mask = torch.sum(self.test_labels, dim=0) > 0
+        mask = torch.sum(labels, dim=0) > 0
         self.auroc.num_classes = torch.sum(mask)
 
         # Compute & update AUC for the others; carry over old vals (0) 
         # auroc returns (num_classes,)
-        self.result_auc[mask] = self.auroc(self.test_preds[:,mask], self.test_labels[:,mask].type(torch.int)).to(self.device)
+        self.result_auc[mask] = self.auroc(preds[:,mask], labels[:,mask].type(torch.int)).to(self.device)
         
         # Compute stat scores (TP,...) over epoch
         # StatScores returns tensor of shape (num_classes, 5)
         # When macro is used. last dim is [TP,FP,TN,FN,TP+FN]
-        statscores = self.statscores(self.test_preds, self.test_labels.type(torch.int)).type(torch.float)
+        statscores = self.statscores(preds, labels.type(torch.int)).type(torch.float)
         # num_tot_support= torch.sum(statscores,dim=0)[4]
-        num_examples = self.test_preds.size()[0]
+        num_examples = preds.size()[0]
 
-        avg_AUC = self.calc_avg_auc(self.test_preds[:,mask], self.test_labels[:,mask].type(torch.int)).to(self.device)
-        wAvg_AUC = self.calc_wavg_auc(self.test_preds[:,mask], self.test_labels[:,mask].type(torch.int)).to(self.device)
+        avg_AUC = self.calc_avg_auc(preds[:,mask], labels[:,mask].type(torch.int)).to(self.device)
+        wAvg_AUC = self.calc_wavg_auc(preds[:,mask], labels[:,mask].type(torch.int)).to(self.device)
 
 
         # Create a wandb table
         columns=['Label','AUC','# Cases','% Prev (all)', 'TP', 'FP', 'TN', 'FN']
         table_data = []
-        for name,score,stats in zip(pl_module.labelset, self.result_auc, torch.tensor_split(statscores,self.n_classes,dim=0)):
+        for name,score,stats in zip(labelset, self.result_auc, torch.tensor_split(statscores,self.n_classes,dim=0)):
             stats = stats.squeeze(0)
             s = {k:v for k,v in zip(['TP','FP','TN','FN','SUP'],stats)}
             # prev_pos = np.round((100*s['SUP']/num_tot_support).cpu().numpy(),decimals=2)
@@ -163,9 +354,9 @@ class MetricsCallback(pl.Callback):
 
         data_columns = ['Split', 'Size']
 
-        self.log_dict({'Avg_AUC':avg_AUC, 'wAvg_AUC':wAvg_AUC})
-        pl_module.logger.log_table(key="labels_table", columns=columns, data=table_data)
-        pl_module.logger.log_table(key="avg_table", columns=avg_columns, data=avg_table)
-        pl_module.logger.log_table(key="data_table", columns=data_columns, data=data_table)
+        tables = {"labels_table": (columns, table_data),
+                  "avg_table": (avg_columns, avg_table),
+                  "data_table": (data_columns, data_table)}
+        return avg_AUC, wAvg_AUC, tables
 
       
\ No newline at end of file
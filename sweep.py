@@ -0,0 +1,186 @@
+import os, csv, json, time, copy
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import torch
+import pandas as pd
+import pytorch_lightning as pl
+
+from src.model import MMRadForClassification, load_tokenizer
+from src.data import MMRadDM
+from src.parameters import parse_args
+from src.tasks import TokenCache
+from src.utils import build_feature_memmap, load_paths_dict
+from src.inference import test_predictions, auroc_scores
+
+import warnings
+
+warnings.filterwarnings(
+    "ignore", ".*Trying to infer the `batch_size` from an ambiguous collection.*"
+)
+
+def resolve_models(spec, path_dict):
+    """(name, encoder path) of each model in a comma separated --sweep_models spec,
+    as --load_model in finetune.py (all, all_and_baseline, checkpoint names or paths)"""
+    pt_root = path_dict['pt_checkpoint_root']
+    models = []
+    for name in spec.split(','):
+        if name in ['all', 'all_and_baseline']:
+            if name == 'all_and_baseline':
+                models += [('vbert', "uclanlp/visualbert-vqa-coco-pre"), ('scratch', "scratch")]
+            models += [(m, os.path.join(pt_root, m, "encoder")) for m in os.listdir(pt_root)]
+        elif os.path.isdir(pt_root) and name in os.listdir(pt_root):
+            models.append((name, os.path.join(pt_root, name, "encoder")))
+        else:
+            models.append((name[:10], name))
+    return models
+
+def init_worker(num_threads):
+    """Pool initializer: each job gets num_threads intra-op threads"""
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    torch.set_num_threads(num_threads)
+    torch.set_num_interop_threads(1)
+
+def run_job(job, args, path_dict):
+    """Fine tunes and tests one (encoder, seed, train split) job, in a pool process.
+
+    Features are read from the memory mapped stores and reports from the token cache
+    built by the parent, the DataModule loads in-process (num_workers=0) so the job
+    stays within its thread budget, and nothing is logged to W&B.
+
+    Returns:
+        dict: a row of the results table
+    """
+    start = time.time()
+    args = copy.deepcopy(args)
+    args.load_model, args.train, args.seed = job['model_path'], job['train'], job['seed']
+    pl.seed_everything(job['seed'], workers=True)
+
+    dm = MMRadDM(args, path_dict)
+    dm.num_workers = 0
+    dm.g.manual_seed(job['seed'])
+    dm.setup(stage='fit')
+    dm.setup(stage='test')
+
+    model = MMRadForClassification(
+            args=args,
+            train_size=dm.train_size,
+            n_classes=dm.num_classes,
+            labelset=dm.labelset,
+            tokenizer=args.tokenizer)
+    model.pp.use_token_cache(TokenCache(args.token_cache))
+
+    fit_start = time.time()
+    if args.epochs > 0:
+        trainer = pl.Trainer.from_argparse_args(
+            args,
+            accelerator='cpu',
+            logger=False,
+            enable_checkpointing=False,
+            enable_progress_bar=False,
+            enable_model_summary=False,
+            max_epochs=args.epochs,
+            max_steps=args.steps,
+            deterministic=True,
+            )
+        trainer.fit(model, dm)
+    fit_time = time.time()-fit_start
+
+    preds, labels = test_predictions(model, dm.test_dataloader())
+    result_auc, avg_auc = auroc_scores(preds, labels)
+    row = {'model':job['model'], 'train':job['train'], 'seed':job['seed'],
+           'train_size':dm.train_size, 'test_size':dm.test_size, 'avg_auc':round(avg_auc, 4)}
+    row.update({name:round(float(auc), 4) for name, auc in zip(dm.labelset, result_auc)})
+    row.update({'fit_time':round(fit_time, 1), 'total_time':round(time.time()-start, 1)})
+    return row
+
+def append_row(fname, row):
+    """Append a row to the csv results table (header from the first row written)"""
+    exists = os.path.exists(fname) and os.path.getsize(fname) > 0
+    if exists:
+        with open(fname, newline='') as f:
+            fieldnames = next(csv.reader(f))
+    else:
+        fieldnames = list(row.keys())
+    with open(fname, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction='ignore')
+        if not exists:
+            writer.writeheader()
+        writer.writerow(row)
+
+# Fine tune several encoders x seeds x train splits concurrently on a many-core CPU host:
+#   python sweep.py --sweep_models all_and_baseline --sweep_seeds 808,809,810 --sweep_trains mimic_5,mimic_100
+#                   --threads_per_job 4 --epochs 5 --results_table sweep_results.csv
+# Each job runs in its own process with --threads_per_job threads; --max_jobs run at once.
+if __name__=='__main__':
+
+    args = parse_args(stage='sweep')
+    path_dict = load_paths_dict()
+
+    models = resolve_models(args.sweep_models, path_dict)
+    seeds = [int(s) for s in args.sweep_seeds.split(',')]
+    trains = args.sweep_trains.split(',')
+
+    ## Shared inputs, built once by the parent: memory mapped features of each split
+    ## (read by every job through the page cache) and the tokenized reports
+    dms = {}
+    for train in trains:
+        args_t = copy.deepcopy(args)
+        args_t.train = train
+        dms[train] = MMRadDM(args_t, path_dict)
+    img_paths = {dm.train_img_path for dm in dms.values()} | {dms[trains[0]].test_img_path}
+    if args.use_val_split:
+        img_paths |= {dm.val_img_path for dm in dms.values()}
+    for img_path in sorted(img_paths):
+        build_feature_memmap(img_path)
+
+    # Same tokenizer (and local copy) as the jobs' models
+    tokenizer = load_tokenizer(args.tokenizer)
+    cache_index = os.path.join(args.token_cache, 'rows.json')
+    cached = {}
+    if os.path.exists(cache_index):
+        with open(cache_index) as f:
+            cached = json.load(f)
+    if cached.get('tokenizer') != tokenizer.name_or_path or cached.get('max_seq_len') != args.max_seq_len:
+        txt_paths = {dm.train_txt_path for dm in dms.values()} | {dms[trains[0]].test_txt_path}
+        reports = pd.concat([pd.read_csv(p)['report'] for p in sorted(txt_paths)]).astype(str).tolist()
+        start = time.time()
+        TokenCache.build(args.token_cache, reports, tokenizer, max_seq_len=args.max_seq_len)
+        print(f"Tokenized {len(reports)} reports into {args.token_cache} in {time.time()-start:.2f} seconds.")
+
+    ## Longest jobs first (cost ~ train split size x epochs), so the short jobs
+    ## fill the pool at the end instead of one long job running on its own
+    cost = {train: os.path.getsize(dms[train].train_img_path) for train in trains}
+    jobs = [{'model':name, 'model_path':path, 'seed':seed, 'train':train}
+            for train in trains for name, path in models for seed in seeds]
+    jobs.sort(key=lambda job: cost[job['train']], reverse=True)
+
+    max_jobs = args.max_jobs if args.max_jobs > 0 else max(1, os.cpu_count() // args.threads_per_job)
+    max_jobs = min(max_jobs, len(jobs))
+    print(f"\nRunning {len(jobs)} jobs ({len(models)} models x {len(seeds)} seeds x {len(trains)} train splits), "
+          f"{max_jobs} at a time with {args.threads_per_job} threads each\n")
+
+    start = time.time()
+    rows = []
+    with ProcessPoolExecutor(max_workers=max_jobs, mp_context=mp.get_context('spawn'),
+                             initializer=init_worker, initargs=(args.threads_per_job,)) as pool:
+        futures = {pool.submit(run_job, job, args, path_dict): job for job in jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                row = future.result()
+            except Exception as e:
+                print(f"Job {job['model']} / {job['train']} / seed {job['seed']} failed: {e!r}")
+                continue
+            append_row(args.results_table, row)
+            rows.append(row)
+            print(f"[{len(rows)}/{len(jobs)}] {row['model']} / {row['train']} / seed {row['seed']}: "
+                  f"Avg AUROC {row['avg_auc']:.4f} in {row['total_time']:.1f}s")
+    elapsed = time.time()-start
+
+    print(f"\nSweep results (appended to {args.results_table}):")
+    print(f"{'Model':<12}{'Train':<14}{'Seed':>6}{'Avg AUROC':>12}{'Time (s)':>10}")
+    for row in sorted(rows, key=lambda r: (r['model'], r['train'], r['seed'])):
+        print(f"{row['model']:<12}{row['train']:<14}{row['seed']:>6}{row['avg_auc']:>12.4f}{row['total_time']:>10.1f}")
+    job_time = sum(row['total_time'] for row in rows)
+    print(f"\n{len(rows)} of {len(jobs)} jobs in {elapsed:.1f}s wall time "
+          f"({job_time:.1f}s of job time, {job_time/max(elapsed, 1e-9):.1f}x concurrency)")